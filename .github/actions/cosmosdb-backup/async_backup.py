@@ -0,0 +1,140 @@
+from azure.cosmos.aio import CosmosClient
+from azure.storage.blob.aio import BlobServiceClient
+import asyncio
+import os
+from datetime import datetime
+import async_core
+from async_core import DEFAULT_BLOCK_SIZE, AsyncBlobSink
+from backup_format import resolve_compression
+from backup_index import write_backup_index
+from blob_writer import LocalSink
+from export_spec import load_export_specs, spec_for
+from parquet_format import require_pyarrow
+from storage_account import storage_account_key
+
+# Full backup of every container on the asyncio core: one event loop drives the queries of every
+# container and feed range, instead of a thread per request. Incremental backups and resumable runs
+# are handled by full_backup.py.
+
+# Cosmos DB configurations
+COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
+COSMOS_KEY = os.getenv("COSMOS_KEY")
+
+# Azure Storage configurations
+SUBSCRIPTION_ID = os.getenv("SUBSCRIPTION_ID")
+RESOURCE_GROUP = os.getenv("RESOURCE_GROUP")
+STORAGE_ACCOUNT_NAME = os.getenv("STORAGE_ACCOUNT_NAME")
+STORAGE_CONTAINER = os.getenv("STORAGE_CONTAINER")
+
+# Same settings as full_backup.py
+BACKUP_FORMAT = os.getenv("BACKUP_FORMAT", "ndjson")
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+BACKUP_COMPRESSION = resolve_compression(os.getenv("BACKUP_COMPRESSION", "gzip"), native_zstd=BACKUP_FORMAT == "parquet")
+SEGMENT_SIZE = int(os.getenv("SEGMENT_SIZE_MB", "256")) * 1024 * 1024
+BACKUP_WORKERS = int(os.getenv("BACKUP_WORKERS", "4"))
+BACKUP_CONCURRENCY = int(os.getenv("BACKUP_CONCURRENCY", "8"))
+RU_BUDGET_FRACTION = float(os.getenv("RU_BUDGET_FRACTION", "0.8"))
+BACKUP_UPLOAD = os.getenv("BACKUP_UPLOAD", "local")
+UPLOAD_BLOCK_SIZE = int(os.getenv("UPLOAD_BLOCK_SIZE_MB", "0")) * 1024 * 1024 or DEFAULT_BLOCK_SIZE
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "16"))
+EXPORT_SPECS = load_export_specs(os.getenv("EXPORT_SPECS"))
+
+if BACKUP_FORMAT not in ("ndjson", "parquet"):
+    raise ValueError(f"Unsupported BACKUP_FORMAT: {BACKUP_FORMAT}. The asyncio backup writes 'ndjson' or 'parquet'.")
+if BACKUP_FORMAT == "parquet":
+    require_pyarrow()
+if BACKUP_UPLOAD not in ("local", "direct"):
+    raise ValueError(f"Unsupported BACKUP_UPLOAD: {BACKUP_UPLOAD}. Use 'local' or 'direct'.")
+
+# Validate if all required environment variables are set
+required_env_vars = {
+    "COSMOS_ENDPOINT": COSMOS_ENDPOINT,
+    "COSMOS_KEY": COSMOS_KEY,
+    "SUBSCRIPTION_ID": SUBSCRIPTION_ID,
+    "RESOURCE_GROUP": RESOURCE_GROUP,
+    "STORAGE_ACCOUNT_NAME": STORAGE_ACCOUNT_NAME,
+    "STORAGE_CONTAINER": STORAGE_CONTAINER,
+}
+missing_vars = [key for key, value in required_env_vars.items() if not value]
+if missing_vars:
+    raise ValueError(f"The following environment variables are missing: {', '.join(missing_vars)}")
+
+# Extract the Cosmos DB account name from COSMOS_ENDPOINT
+cosmos_account_name = COSMOS_ENDPOINT.split("//")[1].split(".")[0]
+STORAGE_ACCOUNT_URL = f"https://{STORAGE_ACCOUNT_NAME}.blob.core.windows.net/"
+
+
+async def backup_container(client, sink, semaphore, backup_timestamp, database_name, container_name):
+    async with semaphore:
+        print(f"Starting backup for container: {database_name}/{container_name}")
+        database = client.get_database_client(database_name)
+        container = database.get_container_client(container_name)
+        rate_controller = await async_core.rate_controller_for(database, container, RU_BUDGET_FRACTION, max(BACKUP_WORKERS, 1))
+
+        backup_dir = f"{cosmos_account_name}/{backup_timestamp}/{database_name}/{container_name}"
+        backup_basename = f"cosmosdb_nosql_backup_{cosmos_account_name}_{database_name}_{container_name}_{backup_timestamp}"
+        try:
+            index_entry = await async_core.backup_container(
+                database,
+                container,
+                sink,
+                backup_dir,
+                backup_basename,
+                spec_for(EXPORT_SPECS, database_name, container_name),
+                workers=max(BACKUP_WORKERS, 1),
+                page_size=EXPORT_PAGE_SIZE,
+                rate_controller=rate_controller,
+                compression=BACKUP_COMPRESSION,
+                segment_size=SEGMENT_SIZE,
+                file_format=BACKUP_FORMAT
+            )
+        except Exception as e:
+            print(f"Error while backing up container {container_name}: {e}")
+            return None
+        print(f"{index_entry['document_count']} documents of container {container_name} saved at: {sink.location(backup_dir)}")
+        print(f"Rate for container {container_name}: {rate_controller.summary()}")
+        return index_entry
+
+
+async def main():
+    backup_timestamp = datetime.now().strftime('%Y-%m-%d-%H%M')
+    async with CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY) as client:
+        blob_service_client = None
+        if BACKUP_UPLOAD == "direct":
+            print("Backup files will be streamed directly to the Storage Account.")
+            blob_service_client = BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=storage_account_key(SUBSCRIPTION_ID, RESOURCE_GROUP, STORAGE_ACCOUNT_NAME))
+            sink = AsyncBlobSink(blob_service_client.get_container_client(STORAGE_CONTAINER), UPLOAD_BLOCK_SIZE, UPLOAD_CONCURRENCY)
+        else:
+            sink = LocalSink("./backup")
+
+        try:
+            print("Listing Cosmos DB databases and containers...")
+            container_names = []
+            async for database_info in client.list_databases():
+                async for container_info in client.get_database_client(database_info["id"]).list_containers():
+                    container_names.append((database_info["id"], container_info["id"]))
+            if not container_names:
+                print("No containers found in Cosmos DB.")
+                return
+
+            print(f"Backing up {len(container_names)} containers with {BACKUP_CONCURRENCY} concurrent jobs...")
+            semaphore = asyncio.Semaphore(max(BACKUP_CONCURRENCY, 1))
+            results = await asyncio.gather(*(
+                backup_container(client, sink, semaphore, backup_timestamp, database_name, container_name)
+                for database_name, container_name in container_names
+            ))
+
+            index_entries = [entry for entry in results if entry is not None]
+            index_location = write_backup_index(sink, cosmos_account_name, backup_timestamp, index_entries)
+            await async_core.wait_closed(sink)
+            print(f"Backup index with {len(index_entries)} containers saved at: {sink.location(index_location)}")
+            if len(index_entries) < len(container_names):
+                print(f"{len(container_names) - len(index_entries)} containers failed.")
+        finally:
+            if blob_service_client is not None:
+                await blob_service_client.close()
+    print("Backup completed.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,463 @@
+import asyncio
+import base64
+import json
+from collections import deque
+from contextlib import nullcontext
+from functools import partial
+from itertools import islice
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from azure.storage.blob import BlobBlock
+from backup_format import iter_backup_documents, segment_writer_for
+from backup_index import container_index_entry
+from blob_reader import DEFAULT_RANGE_CONCURRENCY, DEFAULT_RANGE_SIZE, chunk_range_slices, split_ranges
+from bulk_restore import TRANSACTIONAL_BATCH_LIMIT, RestoreStats, batch_operations, iter_partition_batches, request_hook
+from chunk_store import CHUNK_LIST_SUFFIX, DATA_EXTENSIONS, chunk_path
+from partition_index import PARTITION_INDEX_SUFFIX
+from container_settings import container_options, settings_from_properties, throughput_properties, throughput_settings
+from throttle import controller_for_throughput
+
+# Coroutine versions of the backup and restore building blocks, for azure.cosmos.aio and
+# azure.storage.blob.aio clients: one event loop keeps hundreds of requests in flight over a
+# single connection pool. The file formats, manifests and index are the ones of the threaded scripts.
+
+# Size of the blocks staged to a block blob
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Name of the per-container manifest, as written by parallel_export
+MANIFEST_FILENAME = "manifest.json"
+# Backup files larger than this are parsed while they download instead of held in memory (see full_restore.py)
+DEFAULT_STREAM_THRESHOLD = 64 * 1024 * 1024
+
+
+# Block blob writer for coroutines: write() is called from the event loop and stages full blocks in
+# background tasks, close() schedules the commit of the block list, awaited by AsyncBlobSink.wait_closed()
+class AsyncBlockBlobWriter:
+    def __init__(self, sink, blob_client, block_size=DEFAULT_BLOCK_SIZE):
+        self.sink = sink
+        self.blob_client = blob_client
+        self.block_size = block_size
+        self._buffer = bytearray()
+        self._block_ids = []
+        self._staging = []
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._stage(block)
+        return len(data)
+
+    def _stage(self, block):
+        block_id = base64.b64encode(f"{len(self._block_ids):08d}".encode()).decode()
+        self._block_ids.append(block_id)
+        task = asyncio.ensure_future(self.blob_client.stage_block(block_id, block, length=len(block)))
+        self._staging.append(task)
+        self.sink.track(task)
+
+    async def _commit(self):
+        await asyncio.gather(*self._staging)
+        await self.blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in self._block_ids])
+
+    def close(self):
+        if self._buffer:
+            self._stage(bytes(self._buffer))
+            self._buffer = bytearray()
+        self.sink.commits.append(asyncio.ensure_future(self._commit()))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave the blob uncommitted, Azure discards uncommitted blocks after a week
+            for task in self._staging:
+                task.cancel()
+
+
+# Streams backup files into block blobs through an azure.storage.blob.aio ContainerClient
+class AsyncBlobSink:
+    def __init__(self, container_client, block_size=DEFAULT_BLOCK_SIZE, max_pending_blocks=16):
+        self.container_client = container_client
+        self.block_size = block_size
+        self.max_pending_blocks = max_pending_blocks
+        self.pending = set()
+        self.commits = []
+
+    def open(self, relative_path):
+        return AsyncBlockBlobWriter(self, self.container_client.get_blob_client(relative_path), self.block_size)
+
+    def location(self, relative_path):
+        return f"{self.container_client.url}/{relative_path}"
+
+    def track(self, task):
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    # Wait until the number of blocks being staged is below the limit, bounding memory
+    async def drain(self):
+        while len(self.pending) >= self.max_pending_blocks:
+            await asyncio.wait(set(self.pending), return_when=asyncio.FIRST_COMPLETED)
+
+    # Wait for the commit of every closed file
+    async def wait_closed(self):
+        commits, self.commits = self.commits, []
+        await asyncio.gather(*commits)
+
+
+async def drain(sink):
+    if isinstance(sink, AsyncBlobSink):
+        await sink.drain()
+
+
+async def wait_closed(sink):
+    if isinstance(sink, AsyncBlobSink):
+        await sink.wait_closed()
+
+
+def request_slot(rate_controller=None):
+    return rate_controller.async_slot() if rate_controller is not None else nullcontext()
+
+
+# Collect the result of an aio SDK call that may be a coroutine or an async iterable
+async def collect(result):
+    if hasattr(result, "__aiter__"):
+        return [item async for item in result]
+    if asyncio.iscoroutine(result):
+        result = await result
+    return list(result)
+
+
+# Return the rate controller for the throughput that serves the container (shared with the threaded code)
+async def rate_controller_for(database, container, fraction, max_concurrency):
+    for owner, proxy in ((("container", database.id, container.id), container), (("database", database.id), database)):
+        try:
+            throughput = await proxy.get_throughput()
+        except Exception:
+            continue
+        return controller_for_throughput(owner, throughput.auto_scale_max_throughput or throughput.offer_throughput, fraction, max_concurrency)
+    # Serverless accounts have no provisioned throughput
+    return controller_for_throughput(("container", database.id, container.id), None, fraction, max_concurrency)
+
+
+async def read_throughput_settings(proxy):
+    try:
+        return throughput_settings(await proxy.get_throughput())
+    except Exception:
+        return None
+
+
+# Capture the settings needed to recreate a container (see container_settings.capture_container_settings)
+async def capture_container_settings(database, container):
+    properties = await container.read()
+    return settings_from_properties(properties, await read_throughput_settings(container), await read_throughput_settings(database))
+
+
+async def _next_page(pager):
+    try:
+        page = await pager.__anext__()
+    except StopAsyncIteration:
+        return None
+    return [item async for item in page]
+
+
+# Drain a single feed range (or the whole container when feed_range is None) into its own shard
+async def export_feed_range(container, feed_range, sink, shard_prefix, query, page_size, transform=None, rate_controller=None, compression="gzip", segment_size=0, query_options=None, file_format="ndjson"):
+    options = {"raw_response_hook": rate_controller.hook} if rate_controller is not None else {}
+    options.update(query_options or {})
+    if feed_range is not None:
+        options["feed_range"] = feed_range
+    pager = container.query_items(query=query, max_item_count=page_size, **options).by_page()
+
+    writer_class, write_pages = segment_writer_for(file_format)
+    with writer_class(sink, shard_prefix, compression, segment_size) as writer:
+        while True:
+            async with request_slot(rate_controller):
+                page = await _next_page(pager)
+            if page is None:
+                break
+            write_pages([page], writer, transform=transform)
+            await drain(sink)
+    return writer.segments
+
+
+# Export a container with every feed range drained concurrently (at most `workers` at once), plus a manifest
+async def export_container(container, sink, backup_dir, file_prefix, workers, page_size, transform=None, query="SELECT * FROM c", query_options=None, rate_controller=None, manifest_fields=None, compression="gzip", segment_size=0, file_format="ndjson"):
+    if (query_options or {}).get("partition_key") is not None:
+        # A single logical partition lives in one feed range
+        feed_ranges = [None]
+    else:
+        feed_ranges = await collect(container.read_feed_ranges())
+    semaphore = asyncio.Semaphore(max(workers, 1))
+
+    async def export_shard(index, feed_range):
+        shard_prefix = f"{backup_dir}/{file_prefix}.shard-{index:04d}" if feed_range is not None else f"{backup_dir}/{file_prefix}"
+        async with semaphore:
+            return await export_feed_range(container, feed_range, sink, shard_prefix, query, page_size, transform, rate_controller, compression, segment_size, query_options, file_format)
+
+    results = await asyncio.gather(*(export_shard(index, feed_range) for index, feed_range in enumerate(feed_ranges)))
+    shards = [
+        {
+            "feed_range": feed_range,
+            "document_count": sum(segment["document_count"] for segment in segments),
+            "files": segments,
+        }
+        for feed_range, segments in zip(feed_ranges, results)
+    ]
+    manifest = {
+        "format": file_format,
+        "compression": compression,
+        "query": query,
+        "document_count": sum(shard["document_count"] for shard in shards),
+        "shards": shards,
+        "backup_type": "full",
+    }
+    manifest.update(manifest_fields or {})
+    with sink.open(f"{backup_dir}/{MANIFEST_FILENAME}") as manifest_file:
+        manifest_file.write(json.dumps(manifest, indent=4).encode("utf-8"))
+    await wait_closed(sink)
+    return manifest
+
+
+# Back up one container (aio DatabaseProxy and ContainerProxy) under backup_dir, returning its backup index entry.
+# spec is an export_spec.ExportSpec; documents get the container name like in the threaded backup.
+async def backup_container(database, container, sink, backup_dir, file_prefix, spec, workers=4, page_size=1000, rate_controller=None, compression="gzip", segment_size=0, file_format="ndjson"):
+    settings = await capture_container_settings(database, container)
+    partition_key_paths = settings["partition_key"]["paths"]
+
+    def transform(doc):
+        doc = spec.transform(doc, partition_key_paths)
+        doc["container_name"] = container.id
+        return doc
+
+    manifest = await export_container(
+        container,
+        sink,
+        backup_dir,
+        file_prefix,
+        workers,
+        page_size,
+        transform=transform,
+        query=spec.query(partition_key_paths),
+        query_options=spec.query_options(),
+        rate_controller=rate_controller,
+        manifest_fields={"export_spec": spec.to_dict()},
+        compression=compression,
+        segment_size=segment_size,
+        file_format=file_format
+    )
+    return container_index_entry(database.id, container.id, backup_dir, manifest, settings)
+
+
+# Upsert documents one by one, recording the failures
+async def upsert_documents(container, docs, stats, rate_controller=None):
+    hook = request_hook(stats, rate_controller)
+    for doc in docs:
+        try:
+            async with request_slot(rate_controller):
+                await container.upsert_item(doc, raw_response_hook=hook)
+            stats.add_documents(1)
+        except Exception as e:
+            stats.add_failed(1)
+            print(f"Error restoring document {doc.get('id', 'without ID')}: {e}")
+
+
+# Write a group of documents sharing a partition key as a transactional batch (see bulk_restore.batch_operations)
+async def write_partition_batch(container, partition_key, docs, stats, rate_controller=None):
+    operations = batch_operations(partition_key, docs)
+    if operations is None:
+        await upsert_documents(container, docs, stats, rate_controller)
+        return
+
+    try:
+        async with request_slot(rate_controller):
+            await container.execute_item_batch(operations, partition_key=partition_key, raw_response_hook=request_hook(stats, rate_controller))
+        stats.add_documents(len(docs))
+    except Exception as e:
+        # Batches are atomic: fall back to single upserts so one bad document does not drop the others
+        print(f"Transactional batch for partition key {partition_key!r} failed, retrying documents individually: {e}")
+        await upsert_documents(container, docs, stats, rate_controller)
+
+
+# Restore documents with concurrent transactional batches, at most max_in_flight requests at once.
+# With parse_in_executor, documents is a lazy iterator (parsed and prepared as it is consumed) and the
+# batches are pulled from it in a worker thread, max_in_flight at a time, while the writes go on.
+async def bulk_upsert(container, documents, partition_key_paths=None, batch_size=TRANSACTIONAL_BATCH_LIMIT, max_in_flight=200, stats=None, rate_controller=None, parse_in_executor=False):
+    if partition_key_paths is None:
+        partition_key_paths = (await container.read())["partitionKey"]["paths"]
+    batch_size = max(1, min(batch_size, TRANSACTIONAL_BATCH_LIMIT))
+    stats = stats or RestoreStats()
+    batches = iter_partition_batches(documents, partition_key_paths, batch_size, max_buffered=batch_size * max_in_flight)
+    loop = asyncio.get_running_loop()
+
+    in_flight = set()
+    try:
+        while True:
+            if parse_in_executor:
+                pulled = await loop.run_in_executor(None, list, islice(batches, max_in_flight))
+            else:
+                pulled = list(islice(batches, max_in_flight))
+            if not pulled:
+                break
+            for partition_key, docs in pulled:
+                while len(in_flight) >= max_in_flight:
+                    done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+                in_flight.add(asyncio.ensure_future(write_partition_batch(container, partition_key, docs, stats, rate_controller)))
+    finally:
+        # A file that fails to parse still completes the batches already sent
+        if in_flight:
+            await asyncio.gather(*in_flight)
+    return stats
+
+
+async def read_blob(blob_container_client, blob_name, offset=None, length=None):
+    try:
+        downloader = await blob_container_client.get_blob_client(blob_name).download_blob(offset=offset, length=length)
+    except ResourceNotFoundError:
+        return None
+    return await downloader.readall()
+
+
+# Read a range of the blob or of a chunk holding part of a backup file
+async def read_backup_part(blob_container_client, blob_name, part_name, offset=None, length=None):
+    data = await read_blob(blob_container_client, part_name, offset, length)
+    if data is None:
+        raise ValueError(f"A chunk of backup file {blob_name} is missing.")
+    return data
+
+
+# Await the reads (coroutine functions returning bytes) with at most `concurrency` of them in flight and
+# yield their results in order (see blob_reader.iter_ordered)
+async def iter_ordered(reads, concurrency):
+    in_flight = deque()
+    try:
+        for read in reads:
+            in_flight.append(asyncio.ensure_future(read()))
+            if len(in_flight) >= concurrency:
+                yield await in_flight.popleft()
+        while in_flight:
+            yield await in_flight.popleft()
+    finally:
+        # An abandoned iteration does not wait for the ranges nobody will read
+        for task in in_flight:
+            task.cancel()
+
+
+async def read_chunk_list(blob_container_client, blob_name):
+    chunk_list = await read_blob(blob_container_client, blob_name + CHUNK_LIST_SUFFIX)
+    return json.loads(chunk_list) if chunk_list is not None else None
+
+
+# Open a backup file (aio ContainerClient), returning its size and an async iterator of its bytes read as
+# concurrent ranged GETs, or as chunk downloads for a deduplicated file (see blob_reader.open_backup_file).
+# Returns None when the file is missing.
+async def open_backup_file(blob_container_client, blob_name, range_size=DEFAULT_RANGE_SIZE, concurrency=DEFAULT_RANGE_CONCURRENCY):
+    try:
+        size = (await blob_container_client.get_blob_client(blob_name).get_blob_properties()).size
+    except ResourceNotFoundError:
+        chunk_list = await read_chunk_list(blob_container_client, blob_name) if blob_name.endswith(DATA_EXTENSIONS) else None
+        if chunk_list is None:
+            return None
+        account_name = blob_name.split("/", 1)[0]
+        reads = (partial(read_backup_part, blob_container_client, blob_name, chunk_path(account_name, chunk["sha256"])) for chunk in chunk_list["chunks"])
+        return chunk_list["bytes"], iter_ordered(reads, concurrency)
+    reads = (partial(read_backup_part, blob_container_client, blob_name, blob_name, offset, min(range_size, size - offset)) for offset in range(0, size, range_size))
+    return size, iter_ordered(reads, concurrency)
+
+
+# Read byte ranges (offset, length) of a backup file in order, as concurrent ranged GETs of the blob or of
+# the chunks of a deduplicated file (see blob_reader.open_backup_file_ranges). Returns None when the file is missing.
+async def open_backup_file_ranges(blob_container_client, blob_name, ranges, range_size=DEFAULT_RANGE_SIZE, concurrency=DEFAULT_RANGE_CONCURRENCY):
+    ranges = list(split_ranges(ranges, range_size))
+    try:
+        await blob_container_client.get_blob_client(blob_name).get_blob_properties()
+    except ResourceNotFoundError:
+        chunk_list = await read_chunk_list(blob_container_client, blob_name)
+        if chunk_list is None:
+            return None
+        account_name = blob_name.split("/", 1)[0]
+        reads = (
+            partial(read_backup_part, blob_container_client, blob_name, chunk_path(account_name, digest), offset, length)
+            for digest, offset, length in chunk_range_slices(chunk_list["chunks"], ranges)
+        )
+        return iter_ordered(reads, concurrency)
+    return iter_ordered((partial(read_backup_part, blob_container_client, blob_name, blob_name, offset, length) for offset, length in ranges), concurrency)
+
+
+# Open the members of an NDJSON backup file that may hold documents of a targeted restore
+# (partition_index.RestoreSelection) like open_backup_file, or return None when the file has no partition key index
+async def open_selected_ranges(blob_container_client, blob_name, selection, range_size=DEFAULT_RANGE_SIZE, concurrency=DEFAULT_RANGE_CONCURRENCY):
+    partition_index = await read_blob(blob_container_client, blob_name + PARTITION_INDEX_SUFFIX)
+    if partition_index is None:
+        print(f"Backup file {blob_name} has no partition key index, reading it whole.")
+        return None
+    partition_index = json.loads(partition_index)
+    ranges, selected = selection.ranges(partition_index)
+    size = sum(length for _, length in ranges)
+    print(f"Restoring blob: {blob_name} ({selected} of {len(partition_index['blocks'])} blocks, {size / 1024 / 1024:.1f} MB)")
+    if not ranges:
+        return 0, iter_ordered((), concurrency)
+    chunks = await open_backup_file_ranges(blob_container_client, blob_name, ranges, range_size, concurrency)
+    if chunks is None:
+        raise ValueError(f"Backup file {blob_name} not found.")
+    return size, chunks
+
+
+# Iterate an async iterator from a worker thread, each item being awaited on the event loop
+def iter_from_loop(async_iterator, loop):
+    while True:
+        try:
+            yield asyncio.run_coroutine_threadsafe(async_iterator.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+# Restore one backup file (aio ContainerClient): files up to stream_threshold bytes are downloaded whole,
+# larger ones are parsed while their ranges arrive, and the documents go through prepare
+# (restore_plan.prepare_documents) one at a time as bulk_upsert pulls them off the event loop.
+# With an active selection, only the indexed members that may hold selected documents are read.
+async def restore_blob(blob_container_client, blob_name, container, partition_key_paths=None, batch_size=TRANSACTIONAL_BATCH_LIMIT, max_in_flight=200, stats=None, rate_controller=None, prepare=None, selection=None, range_size=DEFAULT_RANGE_SIZE, range_concurrency=DEFAULT_RANGE_CONCURRENCY, stream_threshold=DEFAULT_STREAM_THRESHOLD):
+    backup_file = None
+    if selection is not None and selection.active and ".ndjson" in blob_name:
+        backup_file = await open_selected_ranges(blob_container_client, blob_name, selection, range_size, range_concurrency)
+    if backup_file is None:
+        print(f"Restoring blob: {blob_name}")
+        backup_file = await open_backup_file(blob_container_client, blob_name, range_size, range_concurrency)
+    if backup_file is None:
+        raise ValueError(f"Backup file {blob_name} not found.")
+    size, chunks = backup_file
+    # Parquet files are read whole by pyarrow, streaming them would not save memory
+    if size > stream_threshold and not blob_name.endswith(".parquet"):
+        chunks = iter_from_loop(chunks, asyncio.get_running_loop())
+    else:
+        chunks = [b"".join([chunk async for chunk in chunks])]
+    documents = iter_backup_documents(blob_name, chunks)
+    if prepare is not None:
+        documents = prepare(documents)
+    return await bulk_upsert(container, documents, partition_key_paths, batch_size, max_in_flight, stats, rate_controller, parse_in_executor=True)
+
+
+# Create a restored database and, when it does not exist yet, the container with the captured settings
+# (see container_settings.create_container_from_settings), returning the aio proxies and whether it was created
+async def create_container_from_settings(client, database_name, container_name, settings, defer_indexing=False):
+    database = await client.create_database_if_not_exists(
+        id=database_name,
+        offer_throughput=throughput_properties(settings.get("database_throughput"))
+    )
+
+    container = database.get_container_client(container_name)
+    try:
+        await container.read()
+        return database, container, False
+    except CosmosResourceNotFoundError:
+        pass
+
+    container = await database.create_container(id=container_name, **container_options(settings, defer_indexing))
+    return database, container, True
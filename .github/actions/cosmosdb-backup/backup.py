@@ -1,10 +1,13 @@
 from azure.cosmos import CosmosClient
 from azure.storage.blob import BlobServiceClient
-from azure.mgmt.storage import StorageManagementClient
 from azure.identity import DefaultAzureCredential
 import json
 import os
 from datetime import datetime
+from backup_format import NdjsonSegmentWriter, resolve_compression, write_ndjson_pages
+from blob_writer import DEFAULT_BLOCK_SIZE, BlobSink, LocalSink
+from export_spec import load_export_specs, spec_for
+from storage_account import ensure_storage_account
 
 # Configurações do Cosmos DB
 COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
@@ -18,6 +21,25 @@ RESOURCE_GROUP = os.getenv("RESOURCE_GROUP")
 STORAGE_ACCOUNT_NAME = os.getenv("STORAGE_ACCOUNT_NAME")
 STORAGE_CONTAINER = os.getenv("STORAGE_CONTAINER")
 
+# Formato do backup: "ndjson" grava um documento compacto por linha, "json" mantém o array formatado legado
+BACKUP_FORMAT = os.getenv("BACKUP_FORMAT", "ndjson")
+# Quantidade máxima de documentos por página da consulta (limita a memória usada na exportação)
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+# Compressão do NDJSON ("gzip", "zstd" quando o pacote zstandard está instalado, ou "none")
+BACKUP_COMPRESSION = resolve_compression(os.getenv("BACKUP_COMPRESSION", "gzip"))
+# Upload: "local" grava o arquivo para o step de upload da action, "direct" envia direto para block blobs
+BACKUP_UPLOAD = os.getenv("BACKUP_UPLOAD", "local")
+# Tamanho dos blocos enviados ao Blob Storage e quantidade de blocos enviados em paralelo no modo direct
+UPLOAD_BLOCK_SIZE = int(os.getenv("UPLOAD_BLOCK_SIZE_MB", "0")) * 1024 * 1024 or DEFAULT_BLOCK_SIZE
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "16"))
+# Especificações de exportação por container (filtro, projeção, partition key, propriedades de sistema), em JSON ou arquivo JSON
+EXPORT_SPECS = load_export_specs(os.getenv("EXPORT_SPECS"))
+
+if BACKUP_FORMAT not in ("ndjson", "json"):
+    raise ValueError(f"BACKUP_FORMAT não suportado: {BACKUP_FORMAT}. Use 'ndjson' ou 'json'.")
+if BACKUP_UPLOAD not in ("local", "direct"):
+    raise ValueError(f"BACKUP_UPLOAD não suportado: {BACKUP_UPLOAD}. Use 'local' ou 'direct'.")
+
 # Validar se todas as variáveis de ambiente necessárias estão definidas
 required_env_vars = {
     "COSMOS_ENDPOINT": COSMOS_ENDPOINT,
@@ -34,30 +56,9 @@ missing_vars = [key for key, value in required_env_vars.items() if not value]
 if missing_vars:
     raise ValueError(f"As seguintes variáveis de ambiente estão ausentes: {', '.join(missing_vars)}")
 
-print("Iniciando autenticação com o Azure...")
-# Autenticação com o Azure usando credenciais padrão (certifique-se de estar logado no Azure CLI)
-credential = DefaultAzureCredential()
-storage_client = StorageManagementClient(credential, SUBSCRIPTION_ID)
-
-print("Verificando se o Storage Account já existe...")
-# Verificar se o Storage Account já existe
-storage_accounts = storage_client.storage_accounts.list_by_resource_group(RESOURCE_GROUP)
-account_exists = any(account.name == STORAGE_ACCOUNT_NAME for account in storage_accounts)
-
-if not account_exists:
-    print(f"Criando Storage Account: {STORAGE_ACCOUNT_NAME}")
-    storage_client.storage_accounts.begin_create(
-        RESOURCE_GROUP,
-        STORAGE_ACCOUNT_NAME,
-        {
-            "location": "eastus",  # Escolha a região adequada
-            "sku": {"name": "Standard_LRS"},
-            "kind": "StorageV2"
-        }
-    ).result()
-    print(f"Storage Account {STORAGE_ACCOUNT_NAME} criado com sucesso.")
-else:
-    print(f"Storage Account {STORAGE_ACCOUNT_NAME} já existe. Continuando com o backup...")
+print("Verificando o Storage Account...")
+# Criar o Storage Account se ele não existir (verificado uma vez por execução, ignorado quando a chave já é conhecida)
+ensure_storage_account(SUBSCRIPTION_ID, RESOURCE_GROUP, STORAGE_ACCOUNT_NAME)
 
 STORAGE_ACCOUNT_URL = f"https://{STORAGE_ACCOUNT_NAME}.blob.core.windows.net/"
 
@@ -67,35 +68,49 @@ client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
 database = client.get_database_client(DATABASE_NAME)
 container = database.get_container_client(CONTAINER_NAME)
 
+# Destino do backup: arquivo local enviado pela action, ou direto no container do Storage
+if BACKUP_UPLOAD == "direct":
+    print("O backup será enviado diretamente para o Storage Account usando DefaultAzureCredential.")
+    blob_service_client = BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=DefaultAzureCredential())
+    container_client = blob_service_client.get_container_client(container=STORAGE_CONTAINER)
+    sink = BlobSink(container_client, UPLOAD_BLOCK_SIZE, UPLOAD_CONCURRENCY)
+else:
+    sink = LocalSink(".")
+
+# Consulta de exportação definida pela especificação do container
+spec = spec_for(EXPORT_SPECS, DATABASE_NAME, CONTAINER_NAME)
+partition_key_paths = container.read()["partitionKey"]["paths"]
+query = spec.query(partition_key_paths)
+query_options = spec.query_options()
+if spec.partition_key is None:
+    query_options["enable_cross_partition_query"] = True
+print(f"Consulta de exportação: {query}")
+
 # Criar arquivo de backup
-backup_filename = f"./backup_{DATABASE_NAME}_{CONTAINER_NAME}_{datetime.now().strftime('%Y-%m-%d-%H%M')}.json"
+backup_basename = f"backup_{DATABASE_NAME}_{CONTAINER_NAME}_{datetime.now().strftime('%Y-%m-%d-%H%M')}"
 
 print("Iniciando exportação dos documentos do Cosmos DB...")
 # Exportar os documentos do Cosmos DB para um arquivo JSON
 try:
-    docs = list(container.query_items(query="SELECT * FROM c", enable_cross_partition_query=True))
-    print(f"{len(docs)} documentos encontrados no Cosmos DB.")
-    
-    with open(backup_filename, "w") as backup_file:
-        json.dump(docs, backup_file, indent=4)
-    
-    
-    print(f"Fazendo Upload para storage account usando DefaultAzureCredential: {backup_filename}")
-    
-    # # Criar o BlobServiceClient usando DefaultAzureCredential
-    # blob_service_client = BlobServiceClient(account_url=STORAGE_ACCOUNT_URL, credential=credential)
-    
-    # # Obter o cliente do container
-    # container_client = blob_service_client.get_container_client(container=STORAGE_CONTAINER)
-    
-    # # Fazer o upload do arquivo JSON criado
-    # with open(backup_filename, "rb") as data:
-    #     container_client.upload_blob(name=os.path.basename(backup_filename), data=data, overwrite=True)
+    if BACKUP_FORMAT == "ndjson":
+        # Gravar as páginas da consulta conforme chegam, um documento por linha
+        pages = container.query_items(
+            query=query,
+            max_item_count=EXPORT_PAGE_SIZE,
+            **query_options
+        ).by_page()
+        with NdjsonSegmentWriter(sink, backup_basename, BACKUP_COMPRESSION) as writer:
+            doc_count = write_ndjson_pages(pages, writer, transform=lambda doc: spec.transform(doc, partition_key_paths))
+        backup_filename = writer.segments[0]["file"]
+        print(f"{doc_count} documentos exportados do Cosmos DB.")
+    else:
+        docs = [spec.transform(doc, partition_key_paths) for doc in container.query_items(query=query, **query_options)]
+        print(f"{len(docs)} documentos encontrados no Cosmos DB.")
 
-    # print(f"Upload concluído com sucesso: {backup_filename}")
+        backup_filename = f"{backup_basename}.json"
+        with sink.open(backup_filename) as backup_file:
+            backup_file.write(json.dumps(docs, indent=4).encode("utf-8"))
 
-    print("Removendo arquivo de backup local...")
-    #os.remove(backup_filename)
-    print("Arquivo de backup local removido com sucesso.")
+    print(f"Backup salvo em: {sink.location(backup_filename)}")
 except Exception as e:
     print(f"Erro ao realizar backup: {e}")
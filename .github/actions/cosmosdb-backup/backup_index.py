@@ -0,0 +1,61 @@
+import json
+from azure.core.exceptions import ResourceNotFoundError
+
+# Per-run index written at {account}/{timestamp}/, listing every container and file of the backup
+INDEX_FILENAME = "index.json"
+
+
+# Path of the index of a backup run, relative to the storage container
+def index_path(account_name, timestamp):
+    return f"{account_name}/{timestamp}/{INDEX_FILENAME}"
+
+
+# Build the index entry of a container from its manifest and settings (paths are relative to the storage container)
+def container_index_entry(database_name, container_name, backup_dir, manifest, settings=None):
+    files = [
+        {
+            "path": f"{backup_dir}/{segment['file']}",
+            "document_count": segment["document_count"],
+            "bytes": segment["bytes"],
+            "sha256": segment.get("sha256"),
+            **({"partition_index": f"{backup_dir}/{segment['partition_index']}"} if segment.get("partition_index") else {}),
+        }
+        for shard in manifest["shards"]
+        for segment in shard["files"]
+    ]
+    return {
+        "database": database_name,
+        "container": container_name,
+        "backup_type": manifest.get("backup_type", "full"),
+        "base_backup": manifest.get("base_backup"),
+        "previous_backup": manifest.get("previous_backup"),
+        "partition_key": settings["partition_key"] if settings else None,
+        "settings": settings,
+        "document_count": manifest["document_count"],
+        "bytes": sum(file["bytes"] for file in files),
+        "files": files,
+    }
+
+
+# Write the index of a backup run
+def write_backup_index(sink, account_name, timestamp, containers):
+    index = {
+        "account": account_name,
+        "timestamp": timestamp,
+        "document_count": sum(entry["document_count"] for entry in containers),
+        "bytes": sum(entry["bytes"] for entry in containers),
+        "containers": sorted(containers, key=lambda entry: (entry["database"], entry["container"])),
+    }
+    path = index_path(account_name, timestamp)
+    with sink.open(path) as index_file:
+        index_file.write(json.dumps(index, indent=4).encode("utf-8"))
+    return path
+
+
+# Read the index of a backup run from the storage container, or None for backups written without one
+def read_backup_index(container_client, account_name, timestamp):
+    try:
+        data = container_client.get_blob_client(index_path(account_name, timestamp)).download_blob().readall()
+    except ResourceNotFoundError:
+        return None
+    return json.loads(data)
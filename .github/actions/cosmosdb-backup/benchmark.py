@@ -0,0 +1,446 @@
+import argparse
+import json
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+from azure.storage.blob import BlobServiceClient
+from blob_writer import BlobSink, LocalSink
+from bulk_restore import RestoreStats, bulk_upsert
+from change_feed import capture_change_feed_positions, export_container_changes
+from insert_fake_data import generate_fake_data
+from parallel_export import export_container_parallel
+from restore_pipeline import run_restore_pipeline
+from throttle import RateController
+
+# Throughput benchmark of the backup and restore paths against local stand-ins: an in-process fake
+# Cosmos DB container (simulated latency, RU charges and 429s) and a local directory or Azurite as
+# blob store. Results are written as JSON and can be compared with a baseline to catch regressions.
+
+# Document counts of the predefined datasets
+DATASETS = {"10k": 10_000, "1m": 1_000_000, "10m": 10_000_000}
+
+# RU charged by the fake container: per query page, per document read and per document written
+QUERY_PAGE_RU = 2.5
+QUERY_RU_PER_DOCUMENT = 0.1
+WRITE_RU_PER_DOCUMENT = 6.0
+
+# Throttled retries made by the fake before giving up, like the SDK default
+MAX_THROTTLE_RETRIES = 9
+
+PARTITION_KEY_PATHS = ["/partitionKey"]
+
+
+# Documents generated on demand from their index, so datasets of any size take no memory
+class SyntheticDataset:
+    def __init__(self, document_count, partition_count, seed):
+        self.document_count = document_count
+        self.partition_count = max(partition_count, 1)
+        self.seed = seed
+
+    def document(self, index):
+        doc = generate_fake_data(random.Random(self.seed * 10 ** 12 + index), f"partition-{index % self.partition_count:06d}")
+        # System properties returned by Cosmos DB with every document
+        doc.update({
+            "_rid": f"{index:012x}",
+            "_self": f"dbs/benchmark/colls/benchmark/docs/{index:012x}/",
+            "_etag": f"\"{index:016x}\"",
+            "_attachments": "attachments/",
+            "_ts": 1700000000 + index,
+        })
+        return doc
+
+    # New documents, seen by the change feed of the next incremental export
+    def append(self, count):
+        self.document_count += count
+
+
+def _response(status_code, charge, retry_after=None):
+    headers = {"x-ms-request-charge": str(charge)}
+    if retry_after is not None:
+        headers["x-ms-retry-after-ms"] = str(int(retry_after * 1000))
+    return SimpleNamespace(http_response=SimpleNamespace(status_code=status_code, headers=headers))
+
+
+# Pages of a fake query or change feed: (feed range, ordinal) positions are encoded in the continuation token
+class _FakePager:
+    def __init__(self, container, ranges, page_size, hook, continuation_token, change_feed):
+        self.container = container
+        self.ranges = ranges
+        self.page_size = page_size
+        self.hook = hook
+        self.change_feed = change_feed
+        if continuation_token:
+            range_index, ordinal = (int(part) for part in continuation_token.split(":"))
+        else:
+            range_index, ordinal = ranges[0], 0
+        self._position = (range_index, ordinal)
+        self.continuation_token = continuation_token
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        range_index, ordinal = self._position
+        while True:
+            indexes = self.container.range_indexes(range_index, ordinal, self.page_size)
+            if indexes or self.change_feed or range_index == self.ranges[-1]:
+                break
+            # Cross-partition queries continue with the next feed range
+            range_index, ordinal = self.ranges[self.ranges.index(range_index) + 1], 0
+        if not indexes:
+            if not self.change_feed:
+                self.continuation_token = None
+            raise StopIteration
+        self.container.request(QUERY_PAGE_RU + QUERY_RU_PER_DOCUMENT * len(indexes), self.hook)
+        self._position = (range_index, ordinal + len(indexes))
+        self.continuation_token = f"{range_index}:{ordinal + len(indexes)}"
+        return [self.container.dataset.document(index) for index in indexes]
+
+
+class _FakeQuery:
+    def __init__(self, container, ranges, page_size, hook, continuation=None, change_feed=False):
+        self.args = (container, ranges, page_size, hook)
+        self.continuation = continuation
+        self.change_feed = change_feed
+
+    def by_page(self, continuation_token=None):
+        return _FakePager(*self.args, continuation_token or self.continuation, self.change_feed)
+
+
+# In-process stand-in for a ContainerProxy: serves a SyntheticDataset split into feed ranges by partition
+# key and accepts writes, charging RUs against an optional provisioned throughput (429s when exceeded)
+class FakeCosmosContainer:
+    def __init__(self, container_id, dataset=None, feed_range_count=4, latency=0.002, provisioned_ru=None):
+        self.id = container_id
+        self.dataset = dataset
+        self.feed_range_count = max(feed_range_count, 1)
+        self.latency = latency
+        self.provisioned_ru = provisioned_ru
+        self.documents_written = 0
+        self.request_charge = 0.0
+        self.throttled_requests = 0
+        self._tokens = provisioned_ru or 0.0
+        self._refilled = time.monotonic()
+        self._lock = threading.Lock()
+        partition_count = dataset.partition_count if dataset is not None else 1
+        # Partitions of each feed range, every partition lives in one range
+        self._range_partitions = [list(range(index, partition_count, self.feed_range_count)) for index in range(self.feed_range_count)]
+
+    # Indexes of the documents of a feed range from an ordinal position: documents are ordered by index,
+    # so the documents appended later come after every ordinal already read
+    def range_indexes(self, range_index, ordinal, count):
+        partitions = self._range_partitions[range_index]
+        indexes = []
+        while partitions and len(indexes) < count:
+            index = ordinal // len(partitions) * self.dataset.partition_count + partitions[ordinal % len(partitions)]
+            if index >= self.dataset.document_count:
+                break
+            indexes.append(index)
+            ordinal += 1
+        return indexes
+
+    # Charge a request, returning the seconds to wait when the provisioned throughput is exhausted
+    def _charge(self, charge):
+        with self._lock:
+            if self.provisioned_ru:
+                now = time.monotonic()
+                self._tokens = min(self.provisioned_ru, self._tokens + (now - self._refilled) * self.provisioned_ru)
+                self._refilled = now
+                if self._tokens <= 0:
+                    self.throttled_requests += 1
+                    return -self._tokens / self.provisioned_ru + 0.001
+                self._tokens -= charge
+            self.request_charge += charge
+            return None
+
+    # Simulate one request with its latency, retrying throttled attempts like the SDK does
+    def request(self, charge, hook=None):
+        for _ in range(MAX_THROTTLE_RETRIES + 1):
+            time.sleep(self.latency)
+            retry_after = self._charge(charge)
+            if retry_after is None:
+                if hook is not None:
+                    hook(_response(200, charge))
+                return
+            if hook is not None:
+                hook(_response(429, 0, retry_after))
+            time.sleep(retry_after)
+        raise RuntimeError("Request rate is large, the fake container throttled every retry.")
+
+    def read(self):
+        return {"id": self.id, "partitionKey": {"paths": PARTITION_KEY_PATHS, "kind": "Hash"}}
+
+    def get_throughput(self):
+        if not self.provisioned_ru:
+            raise RuntimeError("The fake container has no provisioned throughput.")
+        return SimpleNamespace(offer_throughput=self.provisioned_ru, auto_scale_max_throughput=None)
+
+    def read_feed_ranges(self):
+        return [{"range": index} for index in range(self.feed_range_count)]
+
+    def query_items(self, query, max_item_count=100, feed_range=None, raw_response_hook=None, **options):
+        ranges = [feed_range["range"]] if feed_range is not None else list(range(self.feed_range_count))
+        return _FakeQuery(self, ranges, max_item_count, raw_response_hook)
+
+    def query_items_change_feed(self, feed_range=None, start_time=None, continuation=None, max_item_count=100, raw_response_hook=None, **options):
+        if continuation is None:
+            # start_time="Now": position at the current end of the feed range
+            range_index = feed_range["range"]
+            continuation = f"{range_index}:{len(self.range_indexes(range_index, 0, self.dataset.document_count))}"
+        range_index = int(continuation.split(":")[0])
+        return _FakeQuery(self, [range_index], max_item_count, raw_response_hook, continuation, change_feed=True)
+
+    def upsert_item(self, body, raw_response_hook=None, **options):
+        self.request(WRITE_RU_PER_DOCUMENT, raw_response_hook)
+        with self._lock:
+            self.documents_written += 1
+
+    def execute_item_batch(self, batch_operations, partition_key=None, raw_response_hook=None, **options):
+        self.request(WRITE_RU_PER_DOCUMENT * len(batch_operations), raw_response_hook)
+        with self._lock:
+            self.documents_written += len(batch_operations)
+
+
+def rate_controller_for(container, args):
+    target = container.provisioned_ru * args.ru_budget_fraction if container.provisioned_ru and args.ru_budget_fraction else None
+    return RateController(target, args.max_concurrency)
+
+
+def max_rss_bytes():
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return usage * 1024 if sys.platform != "darwin" else usage
+
+
+# Run one benchmark, returning its throughput figures
+def measure(name, container, run):
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    charge, throttled = container.request_charge, container.throttled_requests
+    started = time.monotonic()
+    documents, byte_count, details = run()
+    seconds = max(time.monotonic() - started, 1e-6)
+    request_charge = container.request_charge - charge
+    result = {
+        "benchmark": name,
+        "documents": documents,
+        "bytes": byte_count,
+        "seconds": round(seconds, 3),
+        "docs_per_second": round(documents / seconds, 1),
+        "bytes_per_second": round(byte_count / seconds, 1),
+        "request_charge": round(request_charge, 1),
+        "ru_per_second": round(request_charge / seconds, 1),
+        "throttled_requests": container.throttled_requests - throttled,
+        "peak_memory_bytes": tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None,
+        "max_rss_bytes": max_rss_bytes(),
+    }
+    result.update(details)
+    print(
+        f"{name}: {documents} documents, {byte_count / 1024 / 1024:.1f} MB in {seconds:.1f}s "
+        f"({result['docs_per_second']:.0f} docs/s, {result['bytes_per_second'] / 1024 / 1024:.1f} MB/s, "
+        f"{result['ru_per_second']:.0f} RU/s, {result['throttled_requests']} throttled)"
+    )
+    return result
+
+
+def manifest_bytes(manifest):
+    return sum(segment["bytes"] for shard in manifest["shards"] for segment in shard["files"])
+
+
+def manifest_files(backup_dir, manifest):
+    return [f"{backup_dir}/{segment['file']}" for shard in manifest["shards"] for segment in shard["files"]]
+
+
+# Same per-document transform as full_backup.py
+def add_container_name(doc):
+    doc["container_name"] = "benchmark"
+    return doc
+
+
+# Partition key paths of the sidecar partition key index, as full_backup.py passes them
+def partition_index_paths(args):
+    return PARTITION_KEY_PATHS if args.partition_index and args.format == "ndjson" else None
+
+
+def benchmark_backup(source, sink, backup_dir, args):
+    rate_controller = rate_controller_for(source, args)
+    manifest = {}
+
+    def run():
+        manifest.update(export_container_parallel(
+            source,
+            sink,
+            backup_dir,
+            "benchmark",
+            args.workers,
+            args.page_size,
+            transform=add_container_name,
+            rate_controller=rate_controller,
+            compression=args.compression,
+            segment_size=args.segment_size_mb * 1024 * 1024,
+            file_format=args.format,
+            partition_key_paths=partition_index_paths(args)
+        ))
+        return manifest["document_count"], manifest_bytes(manifest), {}
+
+    return measure("backup", source, run), manifest
+
+
+# Append delta_fraction of the dataset and export it through the change feed, like an incremental run
+def benchmark_incremental_backup(source, sink, backup_dir, args):
+    positions = capture_change_feed_positions(source)
+    source.dataset.append(max(int(source.dataset.document_count * args.delta_fraction), 1))
+    rate_controller = rate_controller_for(source, args)
+
+    def run():
+        manifest = export_container_changes(
+            source,
+            sink,
+            backup_dir,
+            "benchmark",
+            positions,
+            args.workers,
+            args.page_size,
+            transform=add_container_name,
+            rate_controller=rate_controller,
+            compression=args.compression,
+            segment_size=args.segment_size_mb * 1024 * 1024,
+            file_format=args.format,
+            partition_key_paths=partition_index_paths(args)
+        )
+        return manifest["document_count"], manifest_bytes(manifest), {}
+
+    return measure("incremental_backup", source, run)
+
+
+# Restore the full backup through the full_restore.py pipeline into an empty fake container
+def benchmark_restore(sink, backup_dir, manifest, args):
+    target = FakeCosmosContainer("restore", latency=args.latency, provisioned_ru=args.provisioned_ru)
+    rate_controller = rate_controller_for(target, args)
+    stats = RestoreStats()
+
+    def write(blob_name, documents):
+        blob_stats = bulk_upsert(target, documents, PARTITION_KEY_PATHS, workers=args.restore_workers, batch_size=100, rate_controller=rate_controller)
+        stats.add_documents(blob_stats.documents)
+        stats.add_failed(blob_stats.failed)
+
+    def run():
+        run_restore_pipeline(
+            manifest_files(backup_dir, manifest),
+            sink.read,
+            write,
+            download_workers=args.download_workers,
+            write_workers=args.write_workers
+        )
+        return stats.documents, manifest_bytes(manifest), {"failed": stats.failed, "complete": stats.documents == manifest["document_count"]}
+
+    return measure("restore", target, run)
+
+
+# Compare the results with a baseline report, returning the regressions beyond the tolerance
+def find_regressions(results, baseline, tolerance):
+    baseline_results = {result["benchmark"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result["benchmark"])
+        if previous is None:
+            continue
+        if result["docs_per_second"] < previous["docs_per_second"] * (1 - tolerance):
+            regressions.append(f"{result['benchmark']}: {result['docs_per_second']:.0f} docs/s, baseline {previous['docs_per_second']:.0f} docs/s")
+        if result["peak_memory_bytes"] and previous.get("peak_memory_bytes") and result["peak_memory_bytes"] > previous["peak_memory_bytes"] * (1 + tolerance):
+            regressions.append(f"{result['benchmark']}: peak memory {result['peak_memory_bytes']} bytes, baseline {previous['peak_memory_bytes']} bytes")
+    return regressions
+
+
+def open_sink(args, root):
+    if not args.blob_connection_string:
+        return LocalSink(root), None
+    container_client = BlobServiceClient.from_connection_string(args.blob_connection_string).get_container_client(args.blob_container)
+    if not container_client.exists():
+        container_client.create_container()
+    return BlobSink(container_client), container_client
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the backup and restore paths against an in-process fake Cosmos DB container.")
+    parser.add_argument("--dataset", choices=sorted(DATASETS), default="10k", help="Predefined dataset size.")
+    parser.add_argument("--documents", type=int, help="Number of documents, overriding --dataset.")
+    parser.add_argument("--partitions", type=int, default=1000, help="Number of distinct partition key values.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic documents.")
+    parser.add_argument("--feed-ranges", type=int, default=4, help="Number of feed ranges of the fake container.")
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="Simulated latency of every request.")
+    parser.add_argument("--provisioned-ru", type=float, default=0, help="Provisioned RU/s of the fake containers (0 never throttles).")
+    parser.add_argument("--ru-budget-fraction", type=float, default=0.8, help="Same as RU_BUDGET_FRACTION.")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="Concurrency limit of the rate controllers.")
+    parser.add_argument("--format", choices=["ndjson", "parquet"], default="ndjson", help="Same as BACKUP_FORMAT.")
+    parser.add_argument("--compression", choices=["gzip", "zstd", "none"], default="gzip", help="Same as BACKUP_COMPRESSION.")
+    parser.add_argument("--segment-size-mb", type=int, default=256, help="Same as SEGMENT_SIZE_MB.")
+    parser.add_argument("--partition-index", action="store_true", help="Same as BACKUP_PARTITION_INDEX=true.")
+    parser.add_argument("--workers", type=int, default=4, help="Same as BACKUP_WORKERS.")
+    parser.add_argument("--page-size", type=int, default=1000, help="Same as EXPORT_PAGE_SIZE.")
+    parser.add_argument("--delta-fraction", type=float, default=0.01, help="Fraction of the dataset added before the incremental backup (0 skips it).")
+    parser.add_argument("--restore-workers", type=int, default=16, help="Same as RESTORE_WORKERS.")
+    parser.add_argument("--download-workers", type=int, default=4, help="Same as RESTORE_DOWNLOAD_WORKERS.")
+    parser.add_argument("--write-workers", type=int, default=2, help="Same as RESTORE_WRITE_WORKERS.")
+    parser.add_argument("--trace-memory", action="store_true", help="Record the peak Python memory of each benchmark with tracemalloc (slower).")
+    parser.add_argument("--blob-connection-string", help="Write the backup to Blob Storage, e.g. Azurite, instead of a temporary directory.")
+    parser.add_argument("--blob-container", default="benchmark", help="Storage container used with --blob-connection-string.")
+    parser.add_argument("--output", help="File receiving the JSON report (printed when omitted).")
+    parser.add_argument("--baseline", help="JSON report to compare with, exiting with status 1 on a regression.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Relative slowdown (or memory growth) tolerated against the baseline.")
+    args = parser.parse_args()
+    args.latency = args.latency_ms / 1000
+
+    dataset = SyntheticDataset(args.documents or DATASETS[args.dataset], args.partitions, args.seed)
+    source = FakeCosmosContainer("benchmark", dataset, args.feed_ranges, args.latency, args.provisioned_ru)
+    run_name = f"benchmark-{datetime.now().strftime('%Y-%m-%d-%H%M%S')}"
+    root = tempfile.mkdtemp(prefix="cosmosdb-benchmark-")
+    sink, container_client = open_sink(args, root)
+    print(f"Benchmarking {dataset.document_count} documents ({args.format}, {args.compression}{', partition key index' if partition_index_paths(args) else ''}) written to {sink.location(run_name)}...")
+
+    if args.trace_memory:
+        tracemalloc.start()
+    try:
+        results = []
+        backup_result, manifest = benchmark_backup(source, sink, f"{run_name}/full", args)
+        results.append(backup_result)
+        results.append(benchmark_restore(sink, f"{run_name}/full", manifest, args))
+        if args.delta_fraction > 0:
+            results.append(benchmark_incremental_backup(source, sink, f"{run_name}/delta", args))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+        if container_client is not None:
+            for blob in container_client.list_blobs(name_starts_with=f"{run_name}/"):
+                container_client.delete_blob(blob.name)
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "blob_connection_string")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, indent=4)
+        print(f"Benchmark report saved at: {args.output}")
+    else:
+        print(json.dumps(report, indent=4))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regression against the baseline.")
+
+
+if __name__ == "__main__":
+    main()
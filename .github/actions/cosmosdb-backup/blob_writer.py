@@ -0,0 +1,144 @@
+import base64
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobBlock
+
+# Default size of the blocks staged to a block blob
+DEFAULT_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+# File-like writer that streams into a block blob: data is cut into blocks staged concurrently
+# while the caller keeps writing, and the block list is committed on close. At most
+# max_in_flight blocks are buffered, so memory stays constant whatever the blob size.
+class BlockBlobWriter:
+    def __init__(self, blob_client, executor, block_size=DEFAULT_BLOCK_SIZE, max_in_flight=2):
+        self.blob_client = blob_client
+        self.executor = executor
+        self.block_size = block_size
+        self.max_in_flight = max_in_flight
+        self.bytes_written = 0
+        self._buffer = bytearray()
+        self._block_ids = []
+        self._in_flight = set()
+        self._closed = False
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._stage(block)
+        return len(data)
+
+    def _stage(self, block):
+        # Wait for a staged block to finish before buffering another one
+        while len(self._in_flight) >= self.max_in_flight:
+            done, self._in_flight = wait(self._in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        block_id = base64.b64encode(f"{len(self._block_ids):08d}".encode()).decode()
+        self._block_ids.append(block_id)
+        self._in_flight.add(self.executor.submit(self.blob_client.stage_block, block_id, block, length=len(block)))
+
+    def _wait_all(self):
+        for future in self._in_flight:
+            future.result()
+        self._in_flight = set()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._buffer:
+            self._stage(bytes(self._buffer))
+            self._buffer = bytearray()
+        self._wait_all()
+        self.blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in self._block_ids])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave the blob uncommitted, Azure discards uncommitted blocks after a week
+            self._closed = True
+            for future in self._in_flight:
+                future.cancel()
+
+
+# Writes backup files (as bytes) under a local directory, uploaded afterwards by the action
+class LocalSink:
+    def __init__(self, root):
+        self.root = root
+
+    def open(self, relative_path):
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return open(path, "wb")
+
+    # Read a file written by a previous run, or None when it does not exist
+    def read(self, relative_path):
+        try:
+            with open(os.path.join(self.root, relative_path), "rb") as existing_file:
+                return existing_file.read()
+        except FileNotFoundError:
+            return None
+
+    # Refresh the modification time of an existing file, returning False when it does not exist
+    def touch(self, relative_path):
+        try:
+            os.utime(os.path.join(self.root, relative_path))
+            return True
+        except FileNotFoundError:
+            return False
+
+    # Relative paths of the files whose path starts with prefix
+    def list_paths(self, prefix):
+        directory = os.path.join(self.root, os.path.dirname(prefix))
+        for parent, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.relpath(os.path.join(parent, name), self.root).replace(os.sep, "/")
+                if path.startswith(prefix):
+                    yield path
+
+    def location(self, relative_path):
+        return os.path.join(self.root, relative_path)
+
+
+# Streams backup files straight into block blobs of the storage container
+class BlobSink:
+    def __init__(self, container_client, block_size=DEFAULT_BLOCK_SIZE, max_concurrency=8):
+        self.container_client = container_client
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    def open(self, relative_path):
+        return BlockBlobWriter(self.container_client.get_blob_client(relative_path), self.executor, self.block_size)
+
+    def read(self, relative_path):
+        try:
+            return self.container_client.get_blob_client(relative_path).download_blob().readall()
+        except ResourceNotFoundError:
+            return None
+
+    # Refresh the last-modified time (and etag) of an existing blob by rewriting its empty metadata,
+    # returning False when it does not exist
+    def touch(self, relative_path):
+        try:
+            self.container_client.get_blob_client(relative_path).set_blob_metadata({})
+            return True
+        except ResourceNotFoundError:
+            return False
+
+    def list_paths(self, prefix):
+        for blob in self.container_client.list_blobs(name_starts_with=prefix):
+            yield blob.name
+
+    def location(self, relative_path):
+        return f"{self.container_client.url}/{relative_path}"
@@ -0,0 +1,115 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from backup_format import segment_writer_for
+from metrics import registry, response_hook, shard_labels, span, timed_pages
+from parallel_export import write_manifest
+from throttle import throttled_pages
+
+# Account level file holding the change feed position of every container
+STATE_FILENAME = "changefeed_state.json"
+
+
+# Read the continuation token pointing at the current end of a feed range change feed
+def read_change_feed_position(container, feed_range):
+    pager = container.query_items_change_feed(feed_range=feed_range, start_time="Now").by_page()
+    for page in pager:
+        list(page)
+    return pager.continuation_token
+
+
+# Capture the change feed position of every feed range, to be stored with a full backup
+def capture_change_feed_positions(container):
+    return [
+        {"feed_range": feed_range, "continuation": read_change_feed_position(container, feed_range)}
+        for feed_range in container.read_feed_ranges()
+    ]
+
+
+# Write the changes of one feed range since its continuation token to a delta shard
+# (with a shard checkpoint, resuming after the last segment recorded by an interrupted run)
+def export_feed_range_changes(container, continuation, sink, shard_prefix, page_size, transform=None, rate_controller=None, compression="gzip", segment_size=0, checkpoint=None, file_format="ndjson", partition_key_paths=None):
+    if checkpoint is not None and checkpoint.done:
+        return checkpoint.segments, checkpoint.continuation
+    if checkpoint is not None and checkpoint.continuation:
+        continuation = checkpoint.continuation
+
+    labels = shard_labels(shard_prefix)
+    with span("shard", **labels):
+        options = {"raw_response_hook": response_hook("backup", labels, rate_controller.hook if rate_controller is not None else None)}
+        pager = container.query_items_change_feed(
+            continuation=continuation,
+            max_item_count=page_size,
+            **options
+        ).by_page()
+        pages = timed_pages(pager, "backup", labels)
+        pages = throttled_pages(pages, rate_controller) if rate_controller is not None else pages
+        resumed_bytes = sum(segment["bytes"] for segment in checkpoint.segments) if checkpoint is not None else 0
+
+        writer_class, write_pages = segment_writer_for(file_format)
+        with writer_class(sink, shard_prefix, compression, segment_size, checkpoint.segments if checkpoint is not None else None, partition_key_paths=partition_key_paths) as writer:
+            on_page = None
+            if checkpoint is not None:
+                def on_page():
+                    if writer.close_full_segment():
+                        checkpoint.record(writer.segments, pager.continuation_token)
+            write_pages(pages, writer, transform=transform, on_page=on_page)
+
+        registry.inc("cosmosdb_bytes_total", sum(segment["bytes"] for segment in writer.segments) - resumed_bytes, operation="backup", **labels)
+        if checkpoint is not None:
+            checkpoint.record(writer.segments, pager.continuation_token, done=True)
+        return writer.segments, pager.continuation_token
+
+
+# Export the documents changed since the stored positions, one delta shard per feed range plus a manifest
+def export_container_changes(container, sink, backup_dir, file_prefix, positions, workers, page_size, transform=None, rate_controller=None, manifest_fields=None, compression="gzip", segment_size=0, checkpoint=None, checkpoint_key=None, file_format="ndjson", partition_key_paths=None):
+    print(f"Reading the change feed of {len(positions)} feed ranges with {workers} workers...")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for index, position in enumerate(positions):
+            future = executor.submit(
+                export_feed_range_changes,
+                container,
+                position["continuation"],
+                sink,
+                f"{backup_dir}/{file_prefix}.delta-{index:04d}",
+                page_size,
+                transform,
+                rate_controller,
+                compression,
+                segment_size,
+                checkpoint.shard(checkpoint_key, index, position["feed_range"]) if checkpoint is not None else None,
+                file_format,
+                partition_key_paths
+            )
+            futures.append((position, future))
+
+        shards = []
+        new_positions = []
+        for position, future in futures:
+            segments, continuation = future.result()
+            shards.append({
+                "feed_range": position["feed_range"],
+                "document_count": sum(segment["document_count"] for segment in segments),
+                "files": segments,
+            })
+            new_positions.append({"feed_range": position["feed_range"], "continuation": continuation})
+
+    manifest = {
+        "format": file_format,
+        "compression": compression,
+        "backup_type": "delta",
+        "document_count": sum(shard["document_count"] for shard in shards),
+        "shards": shards,
+        "change_feed": new_positions,
+    }
+    manifest.update(manifest_fields or {})
+    write_manifest(sink, backup_dir, manifest)
+    return manifest
+
+
+# Load the change feed state from its JSON text, or start an empty state
+def load_state(state_text):
+    if not state_text:
+        return {"containers": {}}
+    return json.loads(state_text)
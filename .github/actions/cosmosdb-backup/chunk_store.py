@@ -0,0 +1,172 @@
+import hashlib
+import json
+import threading
+import time
+
+# Content-addressed storage of backup files: data files are cut into chunks stored once under
+# {account}/chunks/ by their SHA-256, and each file is replaced by a chunk list ({path}.chunks.json).
+# Chunks already uploaded by any previous run are referenced instead of uploaded again. A reused chunk
+# is touched (its last-modified time refreshed), so the garbage collection treats it like a new upload
+# and keeps it for the grace period, until the chunk list of the running backup is written.
+
+CHUNKS_DIRECTORY = "chunks"
+CHUNK_LIST_SUFFIX = ".chunks.json"
+
+# Average size of the chunks cut at document boundaries by NdjsonSegmentWriter
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Backup data files stored as chunks (manifests, indexes, checkpoints and state files are stored as they are)
+DATA_EXTENSIONS = (".ndjson", ".ndjson.gz", ".ndjson.zst", ".parquet")
+
+
+def chunk_path(account_name, digest):
+    return f"{account_name}/{CHUNKS_DIRECTORY}/{digest[:2]}/{digest}"
+
+
+# File-like writer storing its content as chunks. Writers that know a good boundary (the end of a
+# compressed member) call end_chunk(); data without boundaries is cut every max_chunk_size bytes.
+class ChunkedFileWriter:
+    def __init__(self, store, path):
+        self.store = store
+        self.path = path
+        self.chunks = []
+        self._buffer = bytearray()
+        self._checksum = hashlib.sha256()
+        self._size = 0
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.store.max_chunk_size:
+            chunk = bytes(self._buffer[:self.store.max_chunk_size])
+            del self._buffer[:self.store.max_chunk_size]
+            self._put(chunk)
+        return len(data)
+
+    def _put(self, data):
+        self.chunks.append({"sha256": self.store.put(data), "bytes": len(data)})
+        self._checksum.update(data)
+        self._size += len(data)
+
+    def end_chunk(self):
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def close(self):
+        self.end_chunk()
+        chunk_list = {"bytes": self._size, "sha256": self._checksum.hexdigest(), "chunks": self.chunks}
+        with self.store.sink.open(self.path + CHUNK_LIST_SUFFIX) as chunk_list_file:
+            chunk_list_file.write(json.dumps(chunk_list).encode("utf-8"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Without a chunk list the uploaded chunks are unreferenced, the garbage collection removes them
+        if exc_type is None:
+            self.close()
+
+
+# Sink storing backup data files as deduplicated chunks in another sink (LocalSink or BlobSink)
+class DedupSink:
+    def __init__(self, sink, account_name, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.sink = sink
+        self.account_name = account_name
+        # Read by NdjsonSegmentWriter to end a compressed member every chunk_size bytes on average
+        self.chunk_size = chunk_size
+        self.max_chunk_size = chunk_size * 4
+        self.uploaded_bytes = 0
+        self.reused_bytes = 0
+        self._known = set()
+        self._lock = threading.Lock()
+
+    # Register the chunks already stored, with a single listing instead of a request per chunk
+    def load_known_chunks(self):
+        prefix = f"{self.account_name}/{CHUNKS_DIRECTORY}/"
+        self._known.update(path.rsplit("/", 1)[-1] for path in self.sink.list_paths(prefix))
+        return len(self._known)
+
+    # Store a chunk unless it is already stored, returning its digest. A known chunk is touched instead,
+    # and uploaded again when the garbage collection deleted it since the listing.
+    def put(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            known = digest in self._known
+        if known and self.sink.touch(chunk_path(self.account_name, digest)):
+            with self._lock:
+                self.reused_bytes += len(data)
+            return digest
+        with self.sink.open(chunk_path(self.account_name, digest)) as chunk_file:
+            chunk_file.write(data)
+        with self._lock:
+            self._known.add(digest)
+            self.uploaded_bytes += len(data)
+        return digest
+
+    def open(self, relative_path):
+        if relative_path.endswith(DATA_EXTENSIONS):
+            return ChunkedFileWriter(self, relative_path)
+        return self.sink.open(relative_path)
+
+    def read(self, relative_path):
+        return read_backup_file(self.sink.read, relative_path)
+
+    def location(self, relative_path):
+        return self.sink.location(relative_path)
+
+    def summary(self):
+        total = self.uploaded_bytes + self.reused_bytes
+        return (
+            f"{self.uploaded_bytes / 1024 / 1024:.1f} MB of new chunks uploaded, "
+            f"{self.reused_bytes / 1024 / 1024:.1f} MB reused ({self.reused_bytes / max(total, 1):.0%} deduplicated)"
+        )
+
+
+# Read a backup file with read(path) -> bytes or None, assembling it from its chunks when it was deduplicated
+def read_backup_file(read, path):
+    data = read(path)
+    if data is not None or not path.endswith(DATA_EXTENSIONS):
+        return data
+    chunk_list = read(path + CHUNK_LIST_SUFFIX)
+    if chunk_list is None:
+        return None
+    account_name = path.split("/", 1)[0]
+    chunks = []
+    for chunk in json.loads(chunk_list)["chunks"]:
+        data = read(chunk_path(account_name, chunk["sha256"]))
+        if data is None:
+            raise ValueError(f"Chunk {chunk['sha256']} of backup file {path} is missing.")
+        chunks.append(data)
+    return b"".join(chunks)
+
+
+# Delete the chunks no chunk list references any more (storage container client of azure.storage.blob).
+# Chunks written or touched less than grace_seconds ago are kept, since a running backup uploads or reuses
+# chunks before their list. A chunk is only deleted when its etag is unchanged since the listing, so a
+# chunk touched by a backup while the collection runs is kept too.
+def collect_garbage(container_client, account_name, grace_seconds):
+    # Imported here, the chunk store itself does not need the Azure SDK
+    from azure.core import MatchConditions
+    from azure.core.exceptions import ResourceModifiedError, ResourceNotFoundError
+
+    chunks_prefix = f"{account_name}/{CHUNKS_DIRECTORY}/"
+    referenced = set()
+    for blob in container_client.list_blobs(name_starts_with=f"{account_name}/"):
+        if blob.name.endswith(CHUNK_LIST_SUFFIX):
+            chunk_list = json.loads(container_client.get_blob_client(blob.name).download_blob().readall())
+            referenced.update(chunk["sha256"] for chunk in chunk_list["chunks"])
+
+    deleted = 0
+    deleted_bytes = 0
+    for blob in container_client.list_blobs(name_starts_with=chunks_prefix):
+        digest = blob.name.rsplit("/", 1)[-1]
+        if digest in referenced or time.time() - blob.last_modified.timestamp() < grace_seconds:
+            continue
+        try:
+            container_client.delete_blob(blob.name, etag=blob.etag, match_condition=MatchConditions.IfNotModified)
+        except (ResourceModifiedError, ResourceNotFoundError):
+            continue
+        deleted += 1
+        deleted_bytes += blob.size
+    print(f"{deleted} unreferenced chunks deleted ({deleted_bytes / 1024 / 1024:.1f} MB), {len(referenced)} chunks referenced.")
+    return deleted
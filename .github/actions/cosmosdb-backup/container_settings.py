@@ -0,0 +1,97 @@
+from azure.cosmos import ThroughputProperties
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+
+# Partition key used for backups that did not record the container settings
+DEFAULT_PARTITION_KEY = {"paths": ["/partitionKey"], "kind": "Hash"}
+
+# Indexing policy used while a restored container is bulk loaded
+DEFERRED_INDEXING_POLICY = {"indexingMode": "none", "automatic": False}
+
+
+# Settings of a ThroughputProperties (manual or autoscale), or None when there is no dedicated throughput
+def throughput_settings(throughput):
+    if throughput is None:
+        return None
+    if throughput.auto_scale_max_throughput:
+        return {"auto_scale_max_throughput": throughput.auto_scale_max_throughput}
+    return {"offer_throughput": throughput.offer_throughput}
+
+
+# Read the provisioned throughput of a container or database, or None when it has none of its own
+def read_throughput_settings(proxy):
+    try:
+        return throughput_settings(proxy.get_throughput())
+    except Exception:
+        return None
+
+
+# Build the settings of a container from its properties and throughput settings
+def settings_from_properties(properties, throughput, database_throughput):
+    return {
+        "partition_key": {key: value for key, value in properties["partitionKey"].items() if key in ("paths", "kind", "version")},
+        "indexing_policy": properties.get("indexingPolicy"),
+        "unique_key_policy": properties.get("uniqueKeyPolicy"),
+        "conflict_resolution_policy": properties.get("conflictResolutionPolicy"),
+        "default_ttl": properties.get("defaultTtl"),
+        "throughput": throughput,
+        "database_throughput": database_throughput,
+    }
+
+
+# Capture the settings needed to recreate a container: partition key, indexing policy, unique keys, TTL and throughput
+def capture_container_settings(database, container):
+    return settings_from_properties(container.read(), read_throughput_settings(container), read_throughput_settings(database))
+
+
+def throughput_properties(throughput):
+    if not throughput:
+        return None
+    return ThroughputProperties(**throughput)
+
+
+# Whether the indexing of a container can be deferred: unique keys need the index while documents are written
+def can_defer_indexing(settings):
+    return not (settings.get("unique_key_policy") or {}).get("uniqueKeys")
+
+
+# Create the database and container of a restore with the captured settings. Returns the database, the
+# container and whether the container was created (an existing container is used as it is). With
+# defer_indexing the new container starts without indexing and TTL; apply_container_settings sets them.
+def create_container_from_settings(cosmos_client, database_name, container_name, settings, defer_indexing=False):
+    database = cosmos_client.create_database_if_not_exists(
+        id=database_name,
+        offer_throughput=throughput_properties(settings.get("database_throughput"))
+    )
+
+    container = database.get_container_client(container_name)
+    try:
+        container.read()
+        return database, container, False
+    except CosmosResourceNotFoundError:
+        pass
+
+    container = database.create_container(id=container_name, **container_options(settings, defer_indexing))
+    return database, container, True
+
+
+# Options of create_container for the captured settings
+def container_options(settings, defer_indexing=False):
+    return {
+        "partition_key": settings.get("partition_key") or DEFAULT_PARTITION_KEY,
+        "indexing_policy": DEFERRED_INDEXING_POLICY if defer_indexing else settings.get("indexing_policy"),
+        "unique_key_policy": settings.get("unique_key_policy"),
+        "conflict_resolution_policy": settings.get("conflict_resolution_policy"),
+        "default_ttl": None if defer_indexing else settings.get("default_ttl"),
+        "offer_throughput": throughput_properties(settings.get("throughput")),
+    }
+
+
+# Apply the indexing policy and TTL of the source container once the bulk load is done
+def apply_container_settings(database, container, settings):
+    database.replace_container(
+        container,
+        partition_key=settings.get("partition_key") or DEFAULT_PARTITION_KEY,
+        indexing_policy=settings.get("indexing_policy"),
+        default_ttl=settings.get("default_ttl"),
+        conflict_resolution_policy=settings.get("conflict_resolution_policy")
+    )
@@ -0,0 +1,87 @@
+import json
+import os
+
+# Properties added by Cosmos DB to every document, recreated by the destination on restore
+SYSTEM_PROPERTIES = ("_rid", "_self", "_etag", "_attachments", "_ts")
+
+# What to export from a container: a WHERE filter (with optional @parameters), a projection of
+# top-level fields, a single logical partition and whether to strip the system properties
+class ExportSpec:
+    def __init__(self, filter=None, parameters=None, fields=None, partition_key=None, strip_system_properties=False, **unknown):
+        if unknown:
+            raise ValueError(f"Unknown export spec options: {', '.join(unknown)}")
+        for field in fields or []:
+            if not isinstance(field, str) or not field or "/" in field:
+                raise ValueError(f"Invalid projected field: {field}. Only top-level property names are supported.")
+        self.filter = filter
+        self.parameters = parameters or {}
+        self.fields = fields
+        self.partition_key = partition_key
+        self.strip_system_properties = strip_system_properties
+
+    # Whether the spec exports a subset of the documents (which the change feed cannot reproduce)
+    @property
+    def selective(self):
+        return bool(self.filter) or self.partition_key is not None
+
+    def projected_fields(self, partition_key_paths):
+        if not self.fields:
+            return None
+        # The id and the partition key are always exported, so the documents can be restored
+        names = ["id"] + [path.strip("/").split("/")[0] for path in partition_key_paths] + list(self.fields)
+        return list(dict.fromkeys(names))
+
+    # Projected fields are quoted (c["name"]), so reserved words and names that are not identifiers
+    # (value, order, my-field) are valid
+    def query(self, partition_key_paths):
+        fields = self.projected_fields(partition_key_paths)
+        query = f"SELECT {', '.join(f'c[{json.dumps(name)}]' for name in fields)} FROM c" if fields else "SELECT * FROM c"
+        if self.filter:
+            query += f" WHERE {self.filter}"
+        return query
+
+    # Extra query_items options: the @parameters of the filter and the partition key of a scoped export
+    def query_options(self):
+        options = {}
+        if self.parameters:
+            options["parameters"] = [{"name": name, "value": value} for name, value in self.parameters.items()]
+        if self.partition_key is not None:
+            options["partition_key"] = self.partition_key
+        return options
+
+    # Client-side part of the spec, also applied to change feed pages that cannot be projected server-side
+    def transform(self, doc, partition_key_paths):
+        fields = self.projected_fields(partition_key_paths)
+        if fields:
+            doc = {name: doc[name] for name in fields if name in doc}
+        if self.strip_system_properties:
+            for name in SYSTEM_PROPERTIES:
+                doc.pop(name, None)
+        return doc
+
+    def to_dict(self):
+        return {
+            "filter": self.filter,
+            "parameters": self.parameters,
+            "fields": self.fields,
+            "partition_key": self.partition_key,
+            "strip_system_properties": self.strip_system_properties,
+        }
+
+
+# Load the export specs keyed by "database/container", "database/*" or "*", from JSON text or a JSON file
+def load_export_specs(value):
+    if not value:
+        return {}
+    if os.path.isfile(value):
+        with open(value, "r", encoding="utf-8") as spec_file:
+            value = spec_file.read()
+    return {key: ExportSpec(**spec) for key, spec in json.loads(value).items()}
+
+
+# Return the spec of a container, the most specific key winning
+def spec_for(specs, database_name, container_name):
+    for key in (f"{database_name}/{container_name}", f"{database_name}/*", "*"):
+        if key in specs:
+            return specs[key]
+    return ExportSpec()
@@ -1,10 +1,28 @@
 from azure.cosmos import CosmosClient
-from azure.storage.blob import BlobServiceClient
-from azure.mgmt.storage import StorageManagementClient
-from azure.identity import DefaultAzureCredential
+import hashlib
 import json
 import os
+import time
 from datetime import datetime
+from backup_format import resolve_compression
+from parquet_format import require_pyarrow
+from parallel_export import export_container_parallel, export_feed_range, write_manifest
+from blob_writer import DEFAULT_BLOCK_SIZE, BlobSink, LocalSink
+from chunk_store import DedupSink
+from backup_index import container_index_entry, write_backup_index
+from checkpoint import Checkpoint
+from container_settings import capture_container_settings
+from export_spec import load_export_specs, spec_for
+from storage_account import container_client_for, ensure_storage_account
+from metrics import ProgressReporter, span
+from change_feed import STATE_FILENAME, capture_change_feed_positions, export_container_changes, load_state
+from azure.core.exceptions import ResourceNotFoundError
+import threading
+from scheduler import ContainerJob, read_container_usage, run_jobs
+from throttle import rate_controller_for
+from azure.core.pipeline.transport import RequestsTransport
+from concurrent.futures import ThreadPoolExecutor
+import requests
 
 # Cosmos DB configurations
 COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
@@ -16,6 +34,58 @@ RESOURCE_GROUP = os.getenv("RESOURCE_GROUP")
 STORAGE_ACCOUNT_NAME = os.getenv("STORAGE_ACCOUNT_NAME")
 STORAGE_CONTAINER = os.getenv("STORAGE_CONTAINER")
 
+# Backup format: "ndjson" streams one compact document per line, "parquet" writes columnar row groups
+# (requires pyarrow), "json" writes the legacy pretty-printed array
+BACKUP_FORMAT = os.getenv("BACKUP_FORMAT", "ndjson")
+# Maximum number of documents fetched per query page (bounds the memory used by the streaming export)
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+# Compression codec ("gzip", "zstd" or "none"); NDJSON needs the zstandard package for zstd, Parquet compresses it natively
+BACKUP_COMPRESSION = resolve_compression(os.getenv("BACKUP_COMPRESSION", "gzip"), native_zstd=BACKUP_FORMAT == "parquet")
+# Uncompressed size after which a shard is split into a new segment file (0 keeps one file per shard)
+SEGMENT_SIZE = int(os.getenv("SEGMENT_SIZE_MB", "256")) * 1024 * 1024
+# Number of feed ranges drained concurrently per container (1 keeps a single cross-partition query and file)
+BACKUP_WORKERS = int(os.getenv("BACKUP_WORKERS", "4"))
+# Number of containers backed up at the same time, globally and per database
+BACKUP_CONCURRENCY = int(os.getenv("BACKUP_CONCURRENCY", "8"))
+BACKUP_DATABASE_CONCURRENCY = int(os.getenv("BACKUP_DATABASE_CONCURRENCY", "4"))
+# Fraction of the provisioned RU/s the backup may consume (0 disables the RU budget, 429 back-off stays active)
+RU_BUDGET_FRACTION = float(os.getenv("RU_BUDGET_FRACTION", "0.8"))
+# Backup mode: "full" exports every document, "incremental" exports only the changes since the last backup
+BACKUP_MODE = os.getenv("BACKUP_MODE", "full")
+# Upload mode: "local" writes under ./backup for the upload step of the action, "direct" streams into block blobs
+BACKUP_UPLOAD = os.getenv("BACKUP_UPLOAD", "local")
+# Size of the blocks staged to Blob Storage and number of blocks uploaded concurrently in direct mode
+UPLOAD_BLOCK_SIZE = int(os.getenv("UPLOAD_BLOCK_SIZE_MB", "0")) * 1024 * 1024 or DEFAULT_BLOCK_SIZE
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "16"))
+# Per-container export specs (filter, projection, partition key, system properties), as JSON text or a JSON file
+EXPORT_SPECS = load_export_specs(os.getenv("EXPORT_SPECS"))
+# Store the backup files as content-addressed chunks shared by every run, uploading only new chunks
+# (requires BACKUP_UPLOAD=direct), with chunks of DEDUP_CHUNK_SIZE_MB on average
+BACKUP_DEDUP = os.getenv("BACKUP_DEDUP", "false").lower() == "true"
+DEDUP_CHUNK_SIZE = int(os.getenv("DEDUP_CHUNK_SIZE_MB", "4")) * 1024 * 1024
+# Write a sidecar partition key index next to every NDJSON segment, so a restore can read only the parts of the
+# files holding selected partition keys or document ids. Off by default: each writer buffers a sort window of up to
+# twice DEFAULT_PARTITION_INDEX_WINDOW_SIZE (about 16 MB of documents)
+BACKUP_PARTITION_INDEX = os.getenv("BACKUP_PARTITION_INDEX", "false").lower() == "true"
+# Resume an interrupted run whose checkpoint was updated less than this many hours ago (0 always starts a new run)
+BACKUP_RESUME_HOURS = float(os.getenv("BACKUP_RESUME_HOURS", "12"))
+
+# Account level file holding the progress of the current backup run
+CHECKPOINT_FILENAME = "backup_checkpoint.json"
+
+if BACKUP_FORMAT not in ("ndjson", "parquet", "json"):
+    raise ValueError(f"Unsupported BACKUP_FORMAT: {BACKUP_FORMAT}. Use 'ndjson', 'parquet' or 'json'.")
+if BACKUP_FORMAT == "parquet":
+    require_pyarrow()
+if BACKUP_MODE not in ("full", "incremental"):
+    raise ValueError(f"Unsupported BACKUP_MODE: {BACKUP_MODE}. Use 'full' or 'incremental'.")
+if BACKUP_UPLOAD not in ("local", "direct"):
+    raise ValueError(f"Unsupported BACKUP_UPLOAD: {BACKUP_UPLOAD}. Use 'local' or 'direct'.")
+if BACKUP_MODE == "incremental" and BACKUP_FORMAT == "json":
+    raise ValueError("Incremental backups require BACKUP_FORMAT=ndjson or parquet.")
+if BACKUP_DEDUP and (BACKUP_FORMAT == "json" or BACKUP_UPLOAD != "direct"):
+    raise ValueError("Deduplicated backups require BACKUP_FORMAT=ndjson or parquet and BACKUP_UPLOAD=direct.")
+
 # Validate if all required environment variables are set
 required_env_vars = {
     "COSMOS_ENDPOINT": COSMOS_ENDPOINT,
@@ -36,36 +106,289 @@ missing_vars = [key for key, value in required_env_vars.items() if not value]
 if missing_vars:
     raise ValueError(f"The following environment variables are missing: {', '.join(missing_vars)}")
 
-print("Starting authentication with Azure...")
-# Authenticate with Azure using default credentials (make sure you are logged in to Azure CLI)
-credential = DefaultAzureCredential()
-storage_client = StorageManagementClient(credential, SUBSCRIPTION_ID)
-
-print("Checking if the Storage Account already exists...")
-# Check if the Storage Account already exists
-storage_accounts = storage_client.storage_accounts.list_by_resource_group(RESOURCE_GROUP)
-account_exists = any(account.name == STORAGE_ACCOUNT_NAME for account in storage_accounts)
-
-if not account_exists:
-    print(f"Creating Storage Account: {STORAGE_ACCOUNT_NAME}")
-    storage_client.storage_accounts.begin_create(
-        RESOURCE_GROUP,
-        STORAGE_ACCOUNT_NAME,
-        {
-            "location": "eastus",  # Choose the appropriate region
-            "sku": {"name": "Standard_LRS"},
-            "kind": "StorageV2"
-        }
-    ).result()
-    print(f"Storage Account {STORAGE_ACCOUNT_NAME} created successfully.")
+print("Checking the Storage Account...")
+# Create the Storage Account when it does not exist (checked once per run, skipped when its key is known)
+ensure_storage_account(SUBSCRIPTION_ID, RESOURCE_GROUP, STORAGE_ACCOUNT_NAME)
+
+print("Creating Cosmos DB client...")
+# Create a single Cosmos DB client whose connection pool is sized for every concurrent query
+session = requests.Session()
+adapter = requests.adapters.HTTPAdapter(pool_maxsize=BACKUP_CONCURRENCY * max(BACKUP_WORKERS, 1))
+session.mount("https://", adapter)
+client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY, transport=RequestsTransport(session=session, session_owner=False))
+
+# Timestamp shared by every container of this backup run
+backup_timestamp = datetime.now().strftime('%Y-%m-%d-%H%M')
+
+
+# Function to get the client of the backup container in the Storage Account
+def get_storage_container_client():
+    return container_client_for(SUBSCRIPTION_ID, RESOURCE_GROUP, STORAGE_ACCOUNT_NAME, STORAGE_CONTAINER)
+
+
+# Function to read the change feed state saved by the previous backup run
+def read_change_feed_state():
+    try:
+        blob_client = get_storage_container_client().get_blob_client(f"{cosmos_account_name}/{STATE_FILENAME}")
+        return load_state(blob_client.download_blob().readall())
+    except ResourceNotFoundError:
+        print("No change feed state found, every container will get a full backup.")
+        return load_state(None)
+
+
+# Destination of the backup files: a local directory uploaded by the action, or the storage container itself
+if BACKUP_UPLOAD == "direct":
+    print("Backup files will be streamed directly to the Storage Account.")
+    sink = BlobSink(get_storage_container_client(), UPLOAD_BLOCK_SIZE, UPLOAD_CONCURRENCY)
 else:
-    print(f"Storage Account {STORAGE_ACCOUNT_NAME} already exists. Proceeding with the backup...")
+    sink = LocalSink("./backup")
+if BACKUP_DEDUP:
+    sink = DedupSink(sink, cosmos_account_name, DEDUP_CHUNK_SIZE)
+    print(f"{sink.load_known_chunks()} chunks already stored, unchanged data will not be uploaded again.")
 
-STORAGE_ACCOUNT_URL = f"https://{STORAGE_ACCOUNT_NAME}.blob.core.windows.net/"
 
-print("Creating Cosmos DB client...")
-# Create Cosmos DB client
-client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
+# Progress of this run: an unfinished run with the same settings is resumed under its own timestamp
+checkpoint_path = f"{cosmos_account_name}/{CHECKPOINT_FILENAME}"
+run_settings = {
+    "mode": BACKUP_MODE,
+    "format": BACKUP_FORMAT,
+    "compression": BACKUP_COMPRESSION,
+    "segment_size": SEGMENT_SIZE,
+    "export_specs": {key: spec.to_dict() for key, spec in EXPORT_SPECS.items()},
+    "dedup_chunk_size": DEDUP_CHUNK_SIZE if BACKUP_DEDUP else 0,
+}
+
+
+def write_checkpoint(data):
+    with sink.open(checkpoint_path) as checkpoint_file:
+        checkpoint_file.write(data)
+
+
+previous_checkpoint = sink.read(checkpoint_path) if BACKUP_RESUME_HOURS > 0 else None
+previous_checkpoint = json.loads(previous_checkpoint) if previous_checkpoint else None
+if (
+    previous_checkpoint
+    and not previous_checkpoint.get("completed")
+    and previous_checkpoint.get("settings") == run_settings
+    and time.time() - previous_checkpoint.get("updated", 0) < BACKUP_RESUME_HOURS * 3600
+):
+    backup_timestamp = previous_checkpoint["timestamp"]
+    print(f"Resuming the interrupted backup {backup_timestamp}...")
+    checkpoint = Checkpoint(previous_checkpoint, write_checkpoint)
+else:
+    checkpoint = Checkpoint({"timestamp": backup_timestamp, "settings": run_settings, "completed": False}, write_checkpoint)
+
+
+# Change feed positions of every container, updated as the jobs finish
+if BACKUP_MODE == "incremental":
+    print("Reading the change feed state of the previous backup...")
+    change_feed_state = read_change_feed_state()
+else:
+    change_feed_state = load_state(None)
+change_feed_state_lock = threading.Lock()
+
+
+def update_change_feed_state(state_key, entry):
+    with change_feed_state_lock:
+        change_feed_state["containers"][state_key] = entry
+
+
+# Function to back up a single container
+def backup_container(job):
+    database_name = job.database_name
+    container_name = job.container_name
+    print(f"Starting backup for container: {database_name}/{container_name}")
+
+    # Create client for the container
+    database = client.get_database_client(database_name)
+    container = database.get_container_client(container_name)
+    # Partition key, indexing policy, unique keys and throughput, recorded in the backup index to recreate the container
+    settings = capture_container_settings(database, container)
+
+    # Rate controller shared by every job that draws from the same provisioned throughput
+    rate_controller = rate_controller_for(database, container, RU_BUDGET_FRACTION, max(BACKUP_WORKERS, 1))
+
+    # Create directory to store the backup
+    backup_dir = f"{cosmos_account_name}/{backup_timestamp}/{database_name}/{container_name}"
+
+    # Create backup file
+    backup_basename = f"cosmosdb_nosql_backup_{cosmos_account_name}_{database_name}_{container_name}_{backup_timestamp}"
+    backup_filename = f"{backup_dir}/{backup_basename}.json"
+
+    # What to export from this container, and the query that exports it
+    spec = spec_for(EXPORT_SPECS, database_name, container_name)
+    partition_key_paths = settings["partition_key"]["paths"]
+    query = spec.query(partition_key_paths)
+    query_options = spec.query_options()
+    if spec.selective:
+        print(f"Exporting a subset of container {container_name}: {query}")
+    index_paths = partition_key_paths if BACKUP_PARTITION_INDEX and BACKUP_FORMAT == "ndjson" else None
+
+    # Apply the client-side part of the export spec and add the container name as a key in each document
+    def add_container_name(doc):
+        doc = spec.transform(doc, partition_key_paths)
+        doc["container_name"] = container_name
+        return doc
+
+    state_key = f"{database_name}/{container_name}"
+    previous_state = change_feed_state["containers"].get(state_key)
+
+    # Skip the containers finished by an interrupted run, keeping their results
+    progress = checkpoint.container(state_key)
+    if progress.get("done"):
+        print(f"Container {container_name} was already backed up by the interrupted run, skipping it.")
+        if progress["result"]["change_feed_state"] is not None:
+            update_change_feed_state(state_key, progress["result"]["change_feed_state"])
+        return progress["result"]["index_entry"]
+
+    # Record the container as finished and return its backup index entry
+    def complete(manifest, state_entry):
+        if state_entry is not None:
+            update_change_feed_state(state_key, state_entry)
+        index_entry = container_index_entry(database_name, container_name, backup_dir, manifest, settings)
+        checkpoint.complete_container(state_key, {"index_entry": index_entry, "change_feed_state": state_entry})
+        print(f"Backup for container {container_name} saved at: {sink.location(backup_dir)}")
+        print(f"Rate for container {container_name}: {rate_controller.summary()}")
+        return index_entry
+
+    try:
+        # The change feed cannot be filtered, so selective exports are always full
+        if BACKUP_MODE == "incremental" and previous_state and not spec.selective:
+            # Export only the documents changed since the positions stored by the previous run
+            manifest = export_container_changes(
+                container,
+                sink,
+                backup_dir,
+                backup_basename,
+                previous_state["change_feed"],
+                max(BACKUP_WORKERS, 1),
+                EXPORT_PAGE_SIZE,
+                transform=add_container_name,
+                rate_controller=rate_controller,
+                manifest_fields={"base_backup": previous_state["base_backup"], "previous_backup": previous_state["last_backup"]},
+                compression=BACKUP_COMPRESSION,
+                segment_size=SEGMENT_SIZE,
+                checkpoint=checkpoint,
+                checkpoint_key=state_key,
+                file_format=BACKUP_FORMAT,
+                partition_key_paths=index_paths
+            )
+            print(f"{manifest['document_count']} changed documents exported from container {container_name} since the previous backup.")
+            return complete(manifest, {
+                "base_backup": previous_state["base_backup"],
+                "last_backup": backup_timestamp,
+                "change_feed": manifest["change_feed"],
+            })
+
+        # Capture the change feed positions before the export, so the next incremental run sees every change made during it
+        # (a resumed export keeps the positions captured when it started)
+        change_feed = progress.get("change_feed")
+        if change_feed is None and BACKUP_FORMAT != "json" and not spec.selective:
+            change_feed = capture_change_feed_positions(container)
+            with checkpoint.lock:
+                progress["change_feed"] = change_feed
+            checkpoint.save(force=True)
+        manifest_fields = {"backup_type": "full", "change_feed": change_feed, "export_spec": spec.to_dict()}
+
+        # A partition-scoped export reads a single logical partition, which lives in one feed range
+        if BACKUP_FORMAT != "json" and BACKUP_WORKERS > 1 and spec.partition_key is None:
+            # Drain the container feed ranges concurrently, one shard file per range
+            manifest = export_container_parallel(
+                container,
+                sink,
+                backup_dir,
+                backup_basename,
+                BACKUP_WORKERS,
+                EXPORT_PAGE_SIZE,
+                transform=add_container_name,
+                query=query,
+                rate_controller=rate_controller,
+                manifest_fields=manifest_fields,
+                compression=BACKUP_COMPRESSION,
+                segment_size=SEGMENT_SIZE,
+                checkpoint=checkpoint,
+                checkpoint_key=state_key,
+                query_options=query_options,
+                file_format=BACKUP_FORMAT,
+                partition_key_paths=index_paths
+            )
+            print(f"{manifest['document_count']} documents exported from container {container_name} in {len(manifest['shards'])} shards.")
+        elif BACKUP_FORMAT != "json":
+            # Stream the query pages to the backup file as they arrive
+            segments = export_feed_range(
+                container,
+                None,
+                sink,
+                f"{backup_dir}/{backup_basename}",
+                query,
+                EXPORT_PAGE_SIZE,
+                transform=add_container_name,
+                rate_controller=rate_controller,
+                compression=BACKUP_COMPRESSION,
+                segment_size=SEGMENT_SIZE,
+                checkpoint=checkpoint.shard(state_key, 0),
+                query_options=query_options,
+                file_format=BACKUP_FORMAT,
+                partition_key_paths=index_paths
+            )
+            doc_count = sum(segment["document_count"] for segment in segments)
+            print(f"{doc_count} documents exported from container {container_name}.")
+            manifest = {
+                "format": BACKUP_FORMAT,
+                "compression": BACKUP_COMPRESSION,
+                "query": query,
+                "document_count": doc_count,
+                "shards": [{"document_count": doc_count, "files": segments}],
+                **manifest_fields,
+            }
+            write_manifest(sink, backup_dir, manifest)
+        else:
+            # Export container documents to a JSON file
+            if spec.partition_key is None:
+                query_options = {"enable_cross_partition_query": True, **query_options}
+            docs = [add_container_name(doc) for doc in container.query_items(query=query, **query_options)]
+            print(f"{len(docs)} documents found in container {container_name}.")
+
+            # Save the documents to the backup file
+            backup_data = json.dumps(docs, indent=4).encode("utf-8")
+            with sink.open(backup_filename) as backup_file:
+                backup_file.write(backup_data)
+
+            # The legacy format has no manifest, describe its single file for the backup index
+            manifest = {
+                "document_count": len(docs),
+                "shards": [{"files": [{
+                    "file": backup_filename.rsplit("/", 1)[-1],
+                    "document_count": len(docs),
+                    "bytes": len(backup_data),
+                    "sha256": hashlib.sha256(backup_data).hexdigest(),
+                }]}],
+            }
+
+        return complete(manifest, {
+            "base_backup": backup_timestamp,
+            "last_backup": backup_timestamp,
+            "change_feed": change_feed,
+        } if change_feed is not None else None)
+    except Exception as e:
+        print(f"Error while backing up container {container_name}: {e}")
+
+
+# Back up a container within a span, timing it in the metrics
+def traced_backup_container(job):
+    with span("container", database=job.database_name, container=job.container_name):
+        return backup_container(job)
+
+
+# Function to build a backup job with the size metadata used for largest-first ordering
+def plan_container_job(database_name, container_name):
+    try:
+        size_kb, document_count = read_container_usage(client.get_database_client(database_name).get_container_client(container_name))
+    except Exception as e:
+        print(f"Could not read size of container {database_name}/{container_name}, scheduling it last: {e}")
+        size_kb, document_count = 0, 0
+    return ContainerJob(database_name, container_name, size_kb, document_count)
+
 
 print("Listing Cosmos DB databases...")
 # List all databases in the Cosmos DB instance
@@ -74,45 +397,45 @@ databases = list(client.list_databases())
 if not databases:
     print("No databases found in Cosmos DB.")
 else:
+    # List all containers of every database
+    container_names = []
     for database_info in databases:
         database_name = database_info['id']
-        print(f"Starting backup for database: {database_name}")
-        
-        # Create client for the database
-        database = client.get_database_client(database_name)
-        
-        # List all containers in the database
-        containers = list(database.list_containers())
-        
+        containers = list(client.get_database_client(database_name).list_containers())
         if not containers:
             print(f"No containers found in database {database_name}.")
-        else:
-            for container_info in containers:
-                container_name = container_info['id']
-                print(f"Starting backup for container: {container_name}")
-                
-                # Create client for the container
-                container = database.get_container_client(container_name)
-                
-                # Create directory to store the backup
-                backup_dir = f"./backup/{cosmos_account_name}/{datetime.now().strftime('%Y-%m-%d-%H%M')}/{database_name}/{container_name}"
-                os.makedirs(backup_dir, exist_ok=True)
-                
-                # Create backup file
-                backup_filename = f"{backup_dir}/cosmosdb_nosql_backup_{cosmos_account_name}_{database_name}_{container_name}_{datetime.now().strftime('%Y-%m-%d-%H%M')}.json"
-                
-                try:
-                    # Export container documents to a JSON file
-                    docs = list(container.query_items(query="SELECT * FROM c", enable_cross_partition_query=True))
-                    print(f"{len(docs)} documents found in container {container_name}.")
-
-                    # Add the container name as a key in each document
-                    for doc in docs:
-                        doc["container_name"] = container_name
-
-                    # Save the documents to the backup file
-                    with open(backup_filename, "w") as backup_file:
-                        json.dump(docs, backup_file, indent=4)
-                    print(f"Backup for container {container_name} saved at: {backup_filename}")
-                except Exception as e:
-                    print(f"Error while backing up container {container_name}: {e}")
+        for container_info in containers:
+            container_names.append((database_name, container_info['id']))
+
+    # Read the container sizes concurrently to order the jobs largest-first
+    with ThreadPoolExecutor(max_workers=BACKUP_CONCURRENCY) as executor:
+        jobs = list(executor.map(lambda names: plan_container_job(*names), container_names))
+
+    print(f"Backing up {len(jobs)} containers with {BACKUP_CONCURRENCY} concurrent jobs ({BACKUP_DATABASE_CONCURRENCY} per database)...")
+    reporter = ProgressReporter("backup", expected=sum(job.document_count for job in jobs)).start()
+    results = run_jobs(jobs, traced_backup_container, BACKUP_CONCURRENCY, BACKUP_DATABASE_CONCURRENCY)
+    reporter.stop()
+
+    # Index every container backed up by this run, so the restore reads one blob instead of listing all history
+    index_entries = [entry for entry in results.values() if isinstance(entry, dict)]
+    index_location = write_backup_index(sink, cosmos_account_name, backup_timestamp, index_entries)
+    print(f"Backup index with {len(index_entries)} containers saved at: {sink.location(index_location)}")
+
+    # Save the change feed positions next to the backups, for the next incremental run
+    if BACKUP_FORMAT != "json":
+        state_path = f"{cosmos_account_name}/{STATE_FILENAME}"
+        with sink.open(state_path) as state_file:
+            state_file.write(json.dumps(change_feed_state, indent=4).encode("utf-8"))
+        print(f"Change feed state saved at: {sink.location(state_path)}")
+
+    if BACKUP_DEDUP:
+        print(f"Deduplication: {sink.summary()}")
+
+    # A run with failed containers stays resumable, the next run retries only those containers
+    if len(index_entries) == len(jobs):
+        with checkpoint.lock:
+            checkpoint.state["completed"] = True
+        checkpoint.save(force=True)
+    else:
+        print(f"{len(jobs) - len(index_entries)} containers failed, run the backup again to resume them.")
+    print("Backup completed.")
@@ -1,6 +1,9 @@
+import json
 import os
+import random
 import uuid
 from azure.cosmos import CosmosClient, PartitionKey
+from bulk_restore import bulk_upsert
 
 # Configurações de conexão
 COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
@@ -8,61 +11,116 @@ COSMOS_KEY = os.getenv("COSMOS_KEY")
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 CONTAINER_NAME = os.getenv("CONTAINER_NAME")
 
-# Verifica se as variáveis de ambiente estão configuradas
-if not all([COSMOS_ENDPOINT, COSMOS_KEY, DATABASE_NAME, CONTAINER_NAME]):
-    raise EnvironmentError("Certifique-se de que todas as variáveis de ambiente estão configuradas.")
-
-# Inicializa o cliente do Cosmos DB
-client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
-
-# Cria o banco de dados, se não existir
-database = client.create_database_if_not_exists(id=DATABASE_NAME)
-
-# Cria o container, se não existir
-container = database.create_container_if_not_exists(
-    id=CONTAINER_NAME,
-    partition_key=PartitionKey(path="/partitionKey"),
-    offer_throughput=400
-)
-# Função para gerar dados falsos
-def generate_fake_data():
-    return {
-        "id": str(uuid.uuid4()),
-        "name": f"Fake Name {uuid.uuid4().hex[:8]}",
-        "email": f"fake{uuid.uuid4().hex[:6]}@example.com",
-        "age": 30 + (uuid.uuid4().int % 40),  # Random age between 30 and 70
-        "partitionKey": "test-partition",
-        "address": {
-            "street": f"{uuid.uuid4().int % 1000} Fake Street",
-            "city": "Faketown",
-            "state": "FS",
-            "zip": f"{uuid.uuid4().int % 90000 + 10000}"  # Random 5-digit zip
-        },
-        "phone": f"+1-{uuid.uuid4().int % 900 + 100}-{uuid.uuid4().int % 9000 + 1000}",
-        "is_active": (uuid.uuid4().int % 2 == 0),  # Random boolean
-        "signup_date": f"2023-{uuid.uuid4().int % 12 + 1:02d}-{uuid.uuid4().int % 28 + 1:02d}",
-        "preferences": {
-            "newsletter": (uuid.uuid4().int % 2 == 0),
-            "notifications": (uuid.uuid4().int % 2 == 0),
-            "theme": "dark" if (uuid.uuid4().int % 2 == 0) else "light"
-        },
-        "tags": [f"tag{uuid.uuid4().int % 10}" for _ in range(3)],  # Random tags
-        "metadata": {
-            "created_by": "script",
-            "version": "1.0",
-            "notes": "Generated for testing purposes"
+# Configurações da carga: quantidade de documentos, semente (vazia gera dados diferentes a cada execução),
+# tamanho aproximado de cada documento em bytes (0 mantém o tamanho natural), níveis de aninhamento,
+# quantidade de valores distintos de partition key, threads de escrita e RU/s de um container novo
+NUM_DOCUMENTS = int(os.getenv("NUM_DOCUMENTS", "100"))
+FAKE_DATA_SEED = os.getenv("FAKE_DATA_SEED")
+DOCUMENT_SIZE_BYTES = int(os.getenv("DOCUMENT_SIZE_BYTES", "0"))
+NESTING_DEPTH = int(os.getenv("NESTING_DEPTH", "0"))
+PARTITION_COUNT = int(os.getenv("PARTITION_COUNT", "1"))
+LOADER_WORKERS = int(os.getenv("LOADER_WORKERS", "16"))
+CONTAINER_THROUGHPUT = int(os.getenv("CONTAINER_THROUGHPUT", "400"))
+
+# Documentos gerados de uma vez, todos com a mesma partition key, formando um batch transacional
+GENERATION_BATCH_SIZE = 100
+
+
+# Conecta ao Cosmos DB e cria o banco de dados e o container, se não existirem
+# (fora do import, para que o benchmark possa usar generate_fake_data sem credenciais)
+def get_container():
+    # Verifica se as variáveis de ambiente estão configuradas
+    if not all([COSMOS_ENDPOINT, COSMOS_KEY, DATABASE_NAME, CONTAINER_NAME]):
+        raise EnvironmentError("Certifique-se de que todas as variáveis de ambiente estão configuradas.")
+
+    client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
+    database = client.create_database_if_not_exists(id=DATABASE_NAME)
+    return database.create_container_if_not_exists(
+        id=CONTAINER_NAME,
+        partition_key=PartitionKey(path="/partitionKey"),
+        offer_throughput=CONTAINER_THROUGHPUT
+    )
+
+
+# Função para gerar dados falsos (com um random.Random semeado os documentos são reproduzíveis).
+# document_size completa o documento com um campo "payload" até aproximadamente esse tamanho em bytes
+# e nesting_depth aninha o campo "metadata" nessa quantidade de níveis.
+def generate_fake_data(rng=None, partition_key="test-partition", document_size=0, nesting_depth=0):
+    return generate_fake_batch(rng or random.Random(), partition_key, 1, document_size, nesting_depth)[0]
+
+
+# Gera count documentos com a mesma partition key: os ids e o payload de todo o lote são sorteados
+# com uma única chamada ao gerador, em vez de uma por documento
+def generate_fake_batch(rng, partition_key, count, document_size=0, nesting_depth=0):
+    ids = rng.getrandbits(128 * count)
+    documents = []
+    for position in range(count):
+        doc = {
+            "id": str(uuid.UUID(int=(ids >> (128 * position)) & ((1 << 128) - 1), version=4)),
+            "name": f"Fake Name {rng.getrandbits(32):08x}",
+            "email": f"fake{rng.getrandbits(24):06x}@example.com",
+            "age": 30 + rng.randrange(40),  # Random age between 30 and 70
+            "partitionKey": partition_key,
+            "address": {
+                "street": f"{rng.randrange(1000)} Fake Street",
+                "city": "Faketown",
+                "state": "FS",
+                "zip": f"{rng.randrange(90000) + 10000}"  # Random 5-digit zip
+            },
+            "phone": f"+1-{rng.randrange(900) + 100}-{rng.randrange(9000) + 1000}",
+            "is_active": rng.random() < 0.5,  # Random boolean
+            "signup_date": f"2023-{rng.randrange(12) + 1:02d}-{rng.randrange(28) + 1:02d}",
+            "preferences": {
+                "newsletter": rng.random() < 0.5,
+                "notifications": rng.random() < 0.5,
+                "theme": "dark" if rng.random() < 0.5 else "light"
+            },
+            "tags": [f"tag{rng.randrange(10)}" for _ in range(3)],  # Random tags
+            "metadata": {
+                "created_by": "script",
+                "version": "1.0",
+                "notes": "Generated for testing purposes"
+            }
         }
-    }
+        for level in range(nesting_depth, 0, -1):
+            doc["metadata"] = {"level": level, "child": doc["metadata"]}
+        documents.append(doc)
+
+    if document_size:
+        # Todos os documentos do lote têm o mesmo tamanho sem o payload
+        padding = max(document_size - len(json.dumps(documents[0])) - len(', "payload": ""'), 0)
+        payload = rng.randbytes((padding * count + 1) // 2).hex()
+        for position, doc in enumerate(documents):
+            doc["payload"] = payload[position * padding:(position + 1) * padding]
+    return documents
+
+
+# Gera num_items documentos em lotes de GENERATION_BATCH_SIZE, distribuindo os lotes entre
+# partition_count partition keys; com a mesma semente a sequência de documentos é sempre a mesma
+def iter_fake_data(num_items, seed=None, document_size=0, nesting_depth=0, partition_count=1):
+    rng = random.Random(seed)
+    for start in range(0, num_items, GENERATION_BATCH_SIZE):
+        batch_index = start // GENERATION_BATCH_SIZE
+        partition_key = "test-partition" if partition_count <= 1 else f"partition-{batch_index % partition_count:06d}"
+        yield from generate_fake_batch(rng, partition_key, min(GENERATION_BATCH_SIZE, num_items - start), document_size, nesting_depth)
+
+
+# Insere dados falsos no container com batches transacionais concorrentes
+def insert_fake_data(container, num_items=100, seed=None, document_size=0, nesting_depth=0, partition_count=1, workers=16):
+    fake_data = iter_fake_data(num_items, seed, document_size, nesting_depth, partition_count)
+    stats = bulk_upsert(container, fake_data, partition_key_paths=["/partitionKey"], workers=workers)
+    print(stats.summary())
 
-# Insere dados falsos no container
-def insert_fake_data(container, num_items=100):
-    for _ in range(num_items):
-        fake_data = generate_fake_data()
-        container.create_item(body=fake_data)
-        print(f"Inserted item with id: {fake_data['id']}")
 
-# Insere 100 documentos falsos
 if __name__ == "__main__":
-    print("Inserindo dados falsos no Cosmos DB...")
-    insert_fake_data(container, num_items=100)
+    print(f"Inserindo {NUM_DOCUMENTS} documentos falsos no Cosmos DB...")
+    insert_fake_data(
+        get_container(),
+        num_items=NUM_DOCUMENTS,
+        seed=int(FAKE_DATA_SEED) if FAKE_DATA_SEED else None,
+        document_size=DOCUMENT_SIZE_BYTES,
+        nesting_depth=NESTING_DEPTH,
+        partition_count=PARTITION_COUNT,
+        workers=LOADER_WORKERS
+    )
     print("Inserção concluída.")
\ No newline at end of file
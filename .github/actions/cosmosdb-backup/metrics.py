@@ -0,0 +1,269 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from opentelemetry import metrics as otel_metrics, trace as otel_trace
+except ImportError:
+    otel_metrics = None
+    otel_trace = None
+
+# Instrumentation shared by the backup and restore jobs: counters, gauges and latency histograms labelled
+# per container and shard, written as JSON lines and/or a Prometheus textfile and mirrored to OpenTelemetry
+# when its API is installed. A reporter thread prints a progress summary with an ETA.
+#
+# METRICS_FILE             JSON lines file receiving a snapshot every interval and one event per span
+# METRICS_PROMETHEUS_FILE  Prometheus textfile (node_exporter textfile collector), rewritten every interval
+# METRICS_OTEL             "true" mirrors the metrics and spans to the OpenTelemetry API (the SDK and
+#                          exporter are configured by the OTEL_* environment variables)
+# METRICS_INTERVAL         Seconds between progress summaries and snapshots
+METRICS_FILE = os.getenv("METRICS_FILE")
+METRICS_PROMETHEUS_FILE = os.getenv("METRICS_PROMETHEUS_FILE")
+METRICS_OTEL = os.getenv("METRICS_OTEL", "false").lower() == "true"
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", "30"))
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRIC_HELP = {
+    "cosmosdb_documents_total": "Documents exported or restored",
+    "cosmosdb_bytes_total": "Backup bytes written or restored",
+    "cosmosdb_failed_documents_total": "Documents that could not be restored",
+    "cosmosdb_request_charge_total": "Request units consumed",
+    "cosmosdb_throttled_requests_total": "Requests throttled with a 429",
+    "cosmosdb_files_total": "Backup files restored",
+    "cosmosdb_page_latency_seconds": "Latency of query and change feed pages",
+    "cosmosdb_span_seconds": "Duration of containers, shards and backup files",
+    "cosmosdb_queue_depth": "Items waiting in a restore pipeline queue",
+}
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+        self._otel_instruments = {}
+        self._meter = otel_metrics.get_meter("cosmosdb-backup") if METRICS_OTEL and otel_metrics is not None else None
+
+    def _otel(self, kind, name):
+        if name not in self._otel_instruments:
+            create = {"counter": self._meter.create_counter, "histogram": self._meter.create_histogram, "gauge": self._meter.create_up_down_counter}[kind]
+            self._otel_instruments[name] = create(name, description=METRIC_HELP.get(name, ""))
+        return self._otel_instruments[name]
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            if self._meter is not None:
+                self._otel("counter", name).add(value, dict(key[1]))
+
+    def set(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            previous = self.gauges.get(key, 0)
+            self.gauges[key] = value
+            if self._meter is not None:
+                self._otel("gauge", name).add(value - previous, dict(key[1]))
+
+    def observe(self, name, value, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self.histograms.setdefault(key, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+            if self._meter is not None:
+                self._otel("histogram", name).record(value, dict(key[1]))
+
+    # Sum of a counter over every label set, optionally filtered by some labels
+    def total(self, name, **labels):
+        wanted = set(_label_key(labels))
+        with self._lock:
+            return sum(value for (metric, key), value in self.counters.items() if metric == name and wanted <= set(key))
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [{"name": name, "labels": dict(key), "value": value} for (name, key), value in self.counters.items()],
+                "gauges": [{"name": name, "labels": dict(key), "value": value} for (name, key), value in self.gauges.items()],
+                "histograms": [
+                    {"name": name, "labels": dict(key), "buckets": dict(zip(LATENCY_BUCKETS, histogram["buckets"])), "sum": histogram["sum"], "count": histogram["count"]}
+                    for (name, key), histogram in self.histograms.items()
+                ],
+            }
+
+    # Prometheus text exposition format (buckets are cumulative)
+    def prometheus_text(self):
+        def labels_text(key, extra=()):
+            pairs = list(key) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{name}="{str(value)}"'.replace("\n", " ") for name, value in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            for kind, series in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in series}):
+                    lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    lines.extend(f"{name}{labels_text(key)} {value}" for (metric, key), value in series.items() if metric == name)
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# HELP {name} {METRIC_HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} histogram")
+                for (metric, key), histogram in self.histograms.items():
+                    if metric != name:
+                        continue
+                    for bound, count in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                        lines.append(f"{name}_bucket{labels_text(key, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{labels_text(key, [('le', '+Inf')])} {histogram['count']}")
+                    lines.append(f"{name}_sum{labels_text(key)} {histogram['sum']}")
+                    lines.append(f"{name}_count{labels_text(key)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+# Registry shared by every thread of the job
+registry = MetricsRegistry()
+
+_events_lock = threading.Lock()
+
+
+def write_event(event):
+    if not METRICS_FILE:
+        return
+    line = json.dumps({"time": time.time(), **event}, default=str)
+    with _events_lock:
+        with open(METRICS_FILE, "a", encoding="utf-8") as metrics_file:
+            metrics_file.write(line + "\n")
+
+
+def write_prometheus_file():
+    if not METRICS_PROMETHEUS_FILE:
+        return
+    # Write then rename, so the collector never reads a partial file
+    temporary_path = f"{METRICS_PROMETHEUS_FILE}.tmp"
+    with open(temporary_path, "w", encoding="utf-8") as prometheus_file:
+        prometheus_file.write(registry.prometheus_text())
+    os.replace(temporary_path, METRICS_PROMETHEUS_FILE)
+
+
+# Time a unit of work (a container, a shard, a backup file): its duration goes to the span histogram,
+# the JSON lines file and, with METRICS_OTEL, an OpenTelemetry span
+@contextmanager
+def span(name, **labels):
+    tracer_span = None
+    if METRICS_OTEL and otel_trace is not None:
+        tracer_span = otel_trace.get_tracer("cosmosdb-backup").start_as_current_span(name, attributes={key: str(value) for key, value in labels.items()})
+        tracer_span.__enter__()
+    started = time.monotonic()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        seconds = time.monotonic() - started
+        registry.observe("cosmosdb_span_seconds", seconds, span=name, **labels)
+        write_event({"event": "span", "span": name, "seconds": round(seconds, 3), "labels": labels, "error": str(error) if error else None})
+        if tracer_span is not None:
+            tracer_span.__exit__(type(error) if error else None, error, error.__traceback__ if error else None)
+
+
+# Labels of a backup shard from its path prefix ({account}/{timestamp}/{database}/{container}/{file}[.shard-NNNN])
+def shard_labels(shard_prefix):
+    path_parts = shard_prefix.split("/")
+    shard = path_parts[-1].rsplit(".shard-", 1)[1] if ".shard-" in path_parts[-1] else "0000"
+    return {"database": path_parts[2], "container": path_parts[3], "shard": shard} if len(path_parts) >= 5 else {"shard": shard}
+
+
+# Count the documents of query pages and observe the latency of every page request
+def timed_pages(pages, operation, labels):
+    pages = iter(pages)
+    while True:
+        started = time.monotonic()
+        page = next(pages, None)
+        if page is None:
+            return
+        page = list(page)
+        registry.observe("cosmosdb_page_latency_seconds", time.monotonic() - started, operation=operation, **labels)
+        registry.inc("cosmosdb_documents_total", len(page), operation=operation, **labels)
+        yield page
+
+
+# raw_response_hook recording the RU charge and throttling of each response, before calling next_hook
+def response_hook(operation, labels, next_hook=None):
+    def hook(response):
+        http_response = response.http_response
+        charge = float(http_response.headers.get("x-ms-request-charge") or 0)
+        if charge:
+            registry.inc("cosmosdb_request_charge_total", charge, operation=operation, **labels)
+        if http_response.status_code == 429:
+            registry.inc("cosmosdb_throttled_requests_total", 1, operation=operation, **labels)
+        if next_hook is not None:
+            next_hook(response)
+    return hook
+
+
+# Prints a progress summary every interval (done, rate, ETA against the expected total) and writes the snapshots
+class ProgressReporter:
+    def __init__(self, operation, progress_metric="cosmosdb_documents_total", expected=None, unit="documents", interval=METRICS_INTERVAL):
+        self.operation = operation
+        self.progress_metric = progress_metric
+        self.expected = expected
+        self.unit = unit
+        self.interval = interval
+        self.started = time.monotonic()
+        self._last = (self.started, 0)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def summary(self):
+        now = time.monotonic()
+        done = registry.total(self.progress_metric, operation=self.operation)
+        documents = registry.total("cosmosdb_documents_total", operation=self.operation)
+        elapsed = max(now - self.started, 1e-6)
+        recent_rate = (done - self._last[1]) / max(now - self._last[0], 1e-6)
+        self._last = (now, done)
+        text = (
+            f"Progress: {done:.0f}{f'/{self.expected:.0f}' if self.expected else ''} {self.unit}, "
+            f"{documents / elapsed:.0f} docs/s, {registry.total('cosmosdb_bytes_total', operation=self.operation) / elapsed / 1024 / 1024:.1f} MB/s, "
+            f"{registry.total('cosmosdb_request_charge_total', operation=self.operation) / elapsed:.0f} RU/s, "
+            f"{registry.total('cosmosdb_throttled_requests_total', operation=self.operation):.0f} throttled"
+        )
+        eta = None
+        if self.expected and done:
+            # Blend the overall and recent rates so a slow start does not skew the estimate
+            rate = (done / elapsed + recent_rate) / 2 if recent_rate else done / elapsed
+            eta = max(self.expected - done, 0) / max(rate, 1e-6)
+            text += f", ETA {time.strftime('%H:%M:%S', time.gmtime(eta))}"
+        return text, done, eta
+
+    def report(self):
+        text, done, eta = self.summary()
+        print(text)
+        write_event({"event": "progress", "operation": self.operation, "done": done, "expected": self.expected, "unit": self.unit, "eta_seconds": eta, "metrics": registry.snapshot()})
+        write_prometheus_file()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.report()
@@ -0,0 +1,102 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from backup_format import segment_writer_for
+from metrics import registry, response_hook, shard_labels, span, timed_pages
+from throttle import throttled_pages
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+# Drain a single feed range (or the whole container when feed_range is None) into its own NDJSON shard,
+# returning the segments written. query_options adds query_items options (parameters, partition_key)
+# and file_format selects NDJSON or Parquet segments, with a partition key index per NDJSON segment when partition_key_paths is given. With a shard checkpoint, the export resumes after the last segment
+# recorded and records the continuation token every time a segment is complete.
+def export_feed_range(container, feed_range, sink, shard_prefix, query, page_size, transform=None, rate_controller=None, compression="gzip", segment_size=0, checkpoint=None, query_options=None, file_format="ndjson", partition_key_paths=None):
+    if checkpoint is not None and checkpoint.done:
+        return checkpoint.segments
+    labels = shard_labels(shard_prefix)
+    with span("shard", **labels):
+        options = {"raw_response_hook": response_hook("backup", labels, rate_controller.hook if rate_controller is not None else None)}
+        options.update(query_options or {})
+        if feed_range is not None:
+            options["feed_range"] = feed_range
+        elif "partition_key" not in options:
+            options["enable_cross_partition_query"] = True
+        pager = container.query_items(
+            query=query,
+            max_item_count=page_size,
+            **options
+        ).by_page(checkpoint.continuation if checkpoint is not None else None)
+        pages = timed_pages(pager, "backup", labels)
+        pages = throttled_pages(pages, rate_controller) if rate_controller is not None else pages
+        resumed_bytes = sum(segment["bytes"] for segment in checkpoint.segments) if checkpoint is not None else 0
+
+        writer_class, write_pages = segment_writer_for(file_format)
+        with writer_class(sink, shard_prefix, compression, segment_size, checkpoint.segments if checkpoint is not None else None, partition_key_paths=partition_key_paths) as writer:
+            on_page = None
+            if checkpoint is not None:
+                def on_page():
+                    # Every document before the continuation token is in a closed segment
+                    if writer.close_full_segment():
+                        checkpoint.record(writer.segments, pager.continuation_token)
+            write_pages(pages, writer, transform=transform, on_page=on_page)
+
+        registry.inc("cosmosdb_bytes_total", sum(segment["bytes"] for segment in writer.segments) - resumed_bytes, operation="backup", **labels)
+        if checkpoint is not None:
+            checkpoint.record(writer.segments, pager.continuation_token, done=True)
+        return writer.segments
+
+
+# Export a container by draining its feed ranges concurrently, one shard file per range plus a manifest
+def export_container_parallel(container, sink, backup_dir, file_prefix, workers, page_size, transform=None, query="SELECT * FROM c", rate_controller=None, manifest_fields=None, compression="gzip", segment_size=0, checkpoint=None, checkpoint_key=None, query_options=None, file_format="ndjson", partition_key_paths=None):
+    feed_ranges = list(container.read_feed_ranges())
+    print(f"{len(feed_ranges)} feed ranges found. Exporting with {workers} workers...")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for index, feed_range in enumerate(feed_ranges):
+            future = executor.submit(
+                export_feed_range,
+                container,
+                feed_range,
+                sink,
+                f"{backup_dir}/{file_prefix}.shard-{index:04d}",
+                query,
+                page_size,
+                transform,
+                rate_controller,
+                compression,
+                segment_size,
+                checkpoint.shard(checkpoint_key, index, feed_range) if checkpoint is not None else None,
+                query_options,
+                file_format,
+                partition_key_paths
+            )
+            futures.append((feed_range, future))
+
+        # Collect the results in shard order so the manifest is deterministic
+        shards = []
+        for feed_range, future in futures:
+            segments = future.result()
+            shards.append({
+                "feed_range": feed_range,
+                "document_count": sum(segment["document_count"] for segment in segments),
+                "files": segments,
+            })
+
+    manifest = {
+        "format": file_format,
+        "compression": compression,
+        "query": query,
+        "document_count": sum(shard["document_count"] for shard in shards),
+        "shards": shards,
+    }
+    manifest.update(manifest_fields or {})
+    write_manifest(sink, backup_dir, manifest)
+    return manifest
+
+
+# Write the manifest describing the files of a container backup
+def write_manifest(sink, backup_dir, manifest):
+    with sink.open(f"{backup_dir}/{MANIFEST_FILENAME}") as manifest_file:
+        manifest_file.write(json.dumps(manifest, indent=4).encode("utf-8"))
@@ -0,0 +1,236 @@
+import hashlib
+import json
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Column holding, as a JSON object, the fields of a document that do not fit the inferred schema
+OVERFLOW_COLUMN = "_overflow"
+
+# Serialized bytes of the documents buffered before a row group is written (row groups are cut at page
+# boundaries, and are never larger than the segment size)
+ROW_GROUP_BYTES = 4 * 1024 * 1024
+
+# Documents of each page serialized to estimate the size of the page, instead of serializing every document
+ROW_SIZE_SAMPLE = 8
+
+# Parquet codec used for each backup compression setting
+PARQUET_COMPRESSION = {"none": "none", "gzip": "gzip", "zstd": "zstd"}
+
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+def require_pyarrow():
+    if pyarrow is None:
+        raise ValueError("The pyarrow package is required for Parquet backups.")
+
+
+# Name of the Arrow type a JSON value is stored as, or None when it goes to the overflow column
+def scalar_type(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int64" if _INT64_MIN <= value <= _INT64_MAX else None
+    if isinstance(value, float):
+        return "float64"
+    if isinstance(value, str):
+        return "string"
+    return None
+
+
+# Infer the columns of a segment: top-level fields holding a single scalar type in every document.
+# Nested values, nulls and fields with mixed types are kept in the overflow column.
+def infer_columns(docs):
+    types = {}
+    for doc in docs:
+        for key, value in doc.items():
+            types.setdefault(key, set()).add(scalar_type(value))
+    return {
+        key: next(iter(value_types))
+        for key, value_types in types.items()
+        if len(value_types) == 1 and None not in value_types and key != OVERFLOW_COLUMN
+    }
+
+
+def build_schema(columns):
+    arrow_types = {"bool": pyarrow.bool_(), "int64": pyarrow.int64(), "float64": pyarrow.float64(), "string": pyarrow.string()}
+    fields = [pyarrow.field(name, arrow_types[type_name]) for name, type_name in columns.items()]
+    return pyarrow.schema(fields + [pyarrow.field(OVERFLOW_COLUMN, pyarrow.string())])
+
+
+# Convert documents to an Arrow table: a missing value is a null, so explicit nulls go to the overflow column
+def documents_to_table(docs, columns, schema):
+    values = {name: [] for name in columns}
+    overflow = []
+    for doc in docs:
+        extra = {}
+        for key, value in doc.items():
+            if columns.get(key) is not None and columns[key] == scalar_type(value):
+                continue
+            extra[key] = value
+        for name in columns:
+            value = doc.get(name)
+            values[name].append(value if name not in extra else None)
+        overflow.append(json.dumps(extra, separators=(",", ":"), ensure_ascii=False) if extra else None)
+    values[OVERFLOW_COLUMN] = overflow
+    return pyarrow.Table.from_pydict(values, schema=schema)
+
+
+# Rebuild the JSON document of a Parquet row
+def row_to_document(row):
+    overflow = row.pop(OVERFLOW_COLUMN, None)
+    doc = {key: value for key, value in row.items() if value is not None}
+    if overflow:
+        doc.update(json.loads(overflow))
+    return doc
+
+
+# Serialized size of a page, extrapolated from ROW_SIZE_SAMPLE documents spread over the page
+def estimate_page_bytes(docs):
+    if not docs:
+        return 0
+    sample = docs[::max(len(docs) // ROW_SIZE_SAMPLE, 1)]
+    return sum(len(json.dumps(doc, separators=(",", ":"), ensure_ascii=False)) for doc in sample) * len(docs) // len(sample)
+
+
+# File-like adapter handing the Parquet bytes to a sink file, with the size and checksum of the segment
+class _SegmentStream:
+    def __init__(self, file, segment):
+        self.file = file
+        self.segment = segment
+        self.checksum = hashlib.sha256()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.file.write(data)
+        self.checksum.update(data)
+        self.position += len(data)
+        self.segment["bytes"] = self.position
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def writable(self):
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.file.close()
+            self.segment["sha256"] = self.checksum.hexdigest()
+
+
+# Writes documents into Parquet segments of at most segment_size uncompressed bytes (0 disables chunking),
+# one row group per ROW_GROUP_BYTES of buffered documents. Same interface as NdjsonSegmentWriter, fed page by page.
+# Parquet segments have no partition key index (partition_key_paths is ignored), they are restored whole.
+class ParquetSegmentWriter:
+    def __init__(self, sink, path_prefix, compression="gzip", segment_size=0, segments=None, partition_key_paths=None, row_group_bytes=ROW_GROUP_BYTES):
+        require_pyarrow()
+        self.sink = sink
+        self.path_prefix = path_prefix
+        self.compression = compression
+        self.segment_size = segment_size
+        self.row_group_bytes = min(row_group_bytes, segment_size) if segment_size else row_group_bytes
+        self.segments = [dict(segment) for segment in segments or []]
+        self._rows = []
+        self._row_bytes = 0
+        self._stream = None
+        self._writer = None
+        self._columns = None
+        self._schema = None
+        self._segment_closed = False
+
+    def _open_segment(self):
+        suffix = f".part-{len(self.segments):04d}" if self.segment_size else ""
+        path = f"{self.path_prefix}{suffix}.parquet"
+        segment = {"file": path.rsplit("/", 1)[-1], "document_count": 0, "uncompressed_bytes": 0, "bytes": 0}
+        self.segments.append(segment)
+        self._stream = _SegmentStream(self.sink.open(path), segment)
+        # Each segment infers its schema from its first row group
+        self._columns = infer_columns(self._rows)
+        self._schema = build_schema(self._columns)
+        self._writer = pyarrow.parquet.ParquetWriter(
+            pyarrow.PythonFile(self._stream, mode="w"),
+            self._schema,
+            compression=PARQUET_COMPRESSION[self.compression]
+        )
+
+    def _close_segment(self):
+        self._writer.close()
+        self._stream.close()
+        self._writer = None
+        self._stream = None
+        self._segment_closed = True
+
+    def _write_row_group(self):
+        if self._writer is None:
+            self._open_segment()
+        table = documents_to_table(self._rows, self._columns, self._schema)
+        self._writer.write_table(table)
+        segment = self.segments[-1]
+        segment["document_count"] += len(self._rows)
+        segment["uncompressed_bytes"] += table.nbytes
+        self._rows = []
+        self._row_bytes = 0
+        if self.segment_size and segment["uncompressed_bytes"] >= self.segment_size:
+            self._close_segment()
+
+    def write_page(self, docs):
+        self._rows.extend(docs)
+        self._row_bytes += estimate_page_bytes(docs)
+        if self._row_bytes >= self.row_group_bytes:
+            self._write_row_group()
+
+    # Return True when a segment was closed and every document written is in a closed segment
+    def close_full_segment(self):
+        if self._rows or self._writer is not None or not self._segment_closed:
+            return False
+        self._segment_closed = False
+        return True
+
+    def close(self):
+        # Always produce at least one segment, even for an empty container
+        if self._rows or not self.segments:
+            self._write_row_group()
+        if self._writer is not None:
+            self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._stream is not None:
+            self._stream.file.__exit__(exc_type, exc_value, traceback)
+
+
+# Write query pages to a Parquet writer (on_page is called after each page)
+def write_parquet_pages(pages, writer, transform=None, on_page=None):
+    count = 0
+    for page in pages:
+        docs = [transform(doc) for doc in page] if transform is not None else list(page)
+        writer.write_page(docs)
+        count += len(docs)
+        if on_page is not None:
+            on_page()
+    return count
+
+
+# Yield the documents of a Parquet backup file from its byte chunks (the footer is at the end of the file)
+def iter_parquet(chunks):
+    require_pyarrow()
+    parquet_file = pyarrow.parquet.ParquetFile(pyarrow.BufferReader(b"".join(chunks)))
+    for batch in parquet_file.iter_batches():
+        for row in batch.to_pylist():
+            yield row_to_document(row)
@@ -0,0 +1,99 @@
+import json
+import os
+import re
+from datetime import datetime, timedelta
+from azure.core.exceptions import ResourceNotFoundError
+from backup_index import read_backup_index
+from change_feed import STATE_FILENAME
+from chunk_store import collect_garbage
+from storage_account import container_client_for
+
+# Retention of the backup runs of an account: runs older than BACKUP_RETENTION_DAYS are deleted, except
+# the full backups and deltas still needed by a retained run or by the next incremental run. The chunks
+# of deduplicated backups that no remaining run references are then garbage collected.
+
+# Cosmos DB configurations
+COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
+
+# Azure Storage configurations
+SUBSCRIPTION_ID = os.getenv("SUBSCRIPTION_ID")
+RESOURCE_GROUP = os.getenv("RESOURCE_GROUP")
+STORAGE_ACCOUNT_NAME = os.getenv("STORAGE_ACCOUNT_NAME")
+STORAGE_CONTAINER = os.getenv("STORAGE_CONTAINER")
+
+# Age in days after which a backup run is deleted (0 keeps every run and only collects unreferenced chunks)
+BACKUP_RETENTION_DAYS = float(os.getenv("BACKUP_RETENTION_DAYS", "30"))
+# Unreferenced chunks younger than this are kept, a backup running meanwhile may not have written its chunk lists yet
+CHUNK_GC_GRACE_HOURS = float(os.getenv("CHUNK_GC_GRACE_HOURS", "24"))
+
+# Backup runs are stored under {account}/{timestamp}/
+RUN_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}-\d{4}$")
+
+required_env_vars = {
+    "COSMOS_ENDPOINT": COSMOS_ENDPOINT,
+    "SUBSCRIPTION_ID": SUBSCRIPTION_ID,
+    "RESOURCE_GROUP": RESOURCE_GROUP,
+    "STORAGE_ACCOUNT_NAME": STORAGE_ACCOUNT_NAME,
+    "STORAGE_CONTAINER": STORAGE_CONTAINER,
+}
+missing_vars = [key for key, value in required_env_vars.items() if not value]
+if missing_vars:
+    raise ValueError(f"The following environment variables are missing: {', '.join(missing_vars)}")
+
+cosmos_account_name = COSMOS_ENDPOINT.split("//")[1].split(".")[0]
+
+
+def get_storage_container_client():
+    return container_client_for(SUBSCRIPTION_ID, RESOURCE_GROUP, STORAGE_ACCOUNT_NAME, STORAGE_CONTAINER)
+
+
+# Blob names of every backup run of the account, by timestamp
+def list_runs(container_client, account_name):
+    runs = {}
+    for blob in container_client.list_blobs(name_starts_with=f"{account_name}/"):
+        path_parts = blob.name.split("/")
+        if len(path_parts) > 2 and RUN_PATTERN.match(path_parts[1]):
+            runs.setdefault(path_parts[1], []).append(blob.name)
+    return runs
+
+
+# Oldest run still needed: deltas are restored on top of their full backup and every delta in between,
+# and the next incremental run continues from the full backup recorded in the change feed state
+def oldest_needed_run(container_client, account_name, retained_runs):
+    base_backups = []
+    for timestamp in retained_runs:
+        index = read_backup_index(container_client, account_name, timestamp)
+        for entry in (index or {}).get("containers", []):
+            if entry.get("backup_type") == "delta" and entry.get("base_backup"):
+                base_backups.append(entry["base_backup"])
+    try:
+        state = json.loads(container_client.get_blob_client(f"{account_name}/{STATE_FILENAME}").download_blob().readall())
+        base_backups.extend(entry["base_backup"] for entry in state["containers"].values() if entry.get("base_backup"))
+    except ResourceNotFoundError:
+        pass
+    return min(base_backups, default=None)
+
+
+def prune_backups(container_client, account_name):
+    runs = list_runs(container_client, account_name)
+    if BACKUP_RETENTION_DAYS > 0 and runs:
+        cutoff = (datetime.now() - timedelta(days=BACKUP_RETENTION_DAYS)).strftime('%Y-%m-%d-%H%M')
+        # The most recent run is always kept
+        retained = [timestamp for timestamp in runs if timestamp >= cutoff] or [max(runs)]
+        oldest_needed = oldest_needed_run(container_client, account_name, retained)
+        if oldest_needed is not None:
+            cutoff = min(cutoff, oldest_needed)
+        expired = sorted(timestamp for timestamp in runs if timestamp < cutoff and timestamp not in retained)
+        print(f"{len(runs)} backup runs found, deleting {len(expired)} runs older than {cutoff}...")
+        for timestamp in expired:
+            for blob_name in runs[timestamp]:
+                container_client.delete_blob(blob_name)
+            print(f"Backup run {timestamp} deleted ({len(runs[timestamp])} files).")
+
+    print("Collecting unreferenced chunks...")
+    collect_garbage(container_client, account_name, CHUNK_GC_GRACE_HOURS * 3600)
+
+
+if __name__ == "__main__":
+    prune_backups(get_storage_container_client(), cosmos_account_name)
+    print("Prune completed.")
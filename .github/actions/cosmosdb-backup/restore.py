@@ -1,8 +1,11 @@
 from azure.cosmos import CosmosClient
 from azure.storage.blob import BlobServiceClient
 from azure.identity import DefaultAzureCredential
-import json
 import os
+from backup_format import iter_backup_documents, iter_file_chunks
+from bulk_restore import bulk_upsert
+from restore_transform import load_restore_transforms, transform_for
+from throttle import rate_controller_for
 
 # Configurações do Cosmos DB
 COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
@@ -15,6 +18,17 @@ STORAGE_ACCOUNT_NAME = os.getenv("STORAGE_ACCOUNT_NAME")
 STORAGE_CONTAINER = os.getenv("STORAGE_CONTAINER")
 BACKUP_FILENAME = os.getenv("BACKUP_FILENAME")  # Nome do arquivo de backup no Storage
 
+# Quantidade de workers de escrita e de documentos por batch transacional
+RESTORE_WORKERS = int(os.getenv("RESTORE_WORKERS", "16"))
+RESTORE_BATCH_SIZE = int(os.getenv("RESTORE_BATCH_SIZE", "100"))
+# Fração do RU/s provisionado que o restore pode consumir (0 desativa o limite, o back-off em 429 continua ativo)
+RU_BUDGET_FRACTION = float(os.getenv("RU_BUDGET_FRACTION", "0.8"))
+# Quantidade de GETs por intervalo de bytes executados em paralelo no download do backup
+RESTORE_RANGE_CONCURRENCY = int(os.getenv("RESTORE_RANGE_CONCURRENCY", "4"))
+# Transformações aplicadas a cada documento antes da escrita (JSON ou caminho de arquivo JSON); por padrão
+# remove as propriedades de sistema e o campo container_name adicionado pelo backup
+RESTORE_TRANSFORMS = load_restore_transforms(os.getenv("RESTORE_TRANSFORMS"))
+
 # Validar se todas as variáveis de ambiente necessárias estão definidas
 required_env_vars = {
     "COSMOS_ENDPOINT": COSMOS_ENDPOINT,
@@ -43,13 +57,15 @@ blob_client = blob_service_client.get_blob_client(container=STORAGE_CONTAINER, b
 
 local_backup_path = f"./{BACKUP_FILENAME}"
 with open(local_backup_path, "wb") as backup_file:
-    backup_file.write(blob_client.download_blob().readall())
+    # Baixar intervalos do blob em paralelo direto para o arquivo, sem carregar o arquivo inteiro em memória
+    blob_client.download_blob(max_concurrency=RESTORE_RANGE_CONCURRENCY).readinto(backup_file)
 print(f"Backup baixado com sucesso: {local_backup_path}")
 
 print("Carregando dados do arquivo de backup...")
-# Carregar os dados do arquivo de backup
-with open(local_backup_path, "r") as backup_file:
-    documents = json.load(backup_file)
+# Ler os documentos do arquivo de backup sob demanda (NDJSON ou array JSON legado)
+documents = iter_backup_documents(local_backup_path, iter_file_chunks(local_backup_path))
+# Transformar os documentos um a um, à medida que são escritos
+documents = transform_for(RESTORE_TRANSFORMS, DATABASE_NAME, CONTAINER_NAME).apply(documents)
 
 print("Conectando ao Cosmos DB...")
 # Conectar ao Cosmos DB
@@ -58,12 +74,11 @@ database = client.get_database_client(DATABASE_NAME)
 container = database.get_container_client(CONTAINER_NAME)
 
 print("Iniciando restauração dos documentos no Cosmos DB...")
-# Inserir os documentos no Cosmos DB
-for doc in documents:
-    try:
-        container.upsert_item(doc)
-    except Exception as e:
-        print(f"Erro ao restaurar documento {doc.get('id', 'sem ID')}: {e}")
+# Inserir os documentos no Cosmos DB em batches transacionais concorrentes, agrupados por partition key
+rate_controller = rate_controller_for(database, container, RU_BUDGET_FRACTION, RESTORE_WORKERS)
+stats = bulk_upsert(container, documents, workers=RESTORE_WORKERS, batch_size=RESTORE_BATCH_SIZE, rate_controller=rate_controller)
+print(stats.summary())
+print(rate_controller.summary())
 
 print("Restauração concluída com sucesso.")
 print("Removendo arquivo de backup local...")
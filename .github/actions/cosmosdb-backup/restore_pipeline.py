@@ -0,0 +1,62 @@
+import queue
+import threading
+from backup_format import iter_backup_documents
+from metrics import registry
+
+# Marker telling the workers of a stage that no more items will arrive
+_DONE = object()
+
+
+def _run_stage(name, worker_count, input_queue, output_queue, handle):
+    def worker():
+        while True:
+            item = input_queue.get()
+            registry.set("cosmosdb_queue_depth", input_queue.qsize(), queue=name)
+            if item is _DONE:
+                input_queue.put(_DONE)
+                return
+            blob_name, payload = item
+            try:
+                result = handle(blob_name, payload)
+            except Exception as e:
+                print(f"Error processing blob {blob_name}: {e}")
+                continue
+            if output_queue is not None:
+                output_queue.put((blob_name, result))
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(worker_count)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+# Wait for the workers of a stage to drain their input, then signal the next stage
+def _finish_stage(threads, output_queue):
+    for thread in threads:
+        thread.join()
+    if output_queue is not None:
+        output_queue.put(_DONE)
+
+
+# Restore blobs through two overlapping stages (download -> write) connected by a bounded queue, so
+# network transfer and Cosmos DB writes run at the same time. download(blob_name) returns the raw bytes,
+# or an iterator of byte chunks for a file too large to hold in memory, and write(blob_name, documents)
+# stores the documents. The documents are parsed lazily as write consumes them, overlapping with the
+# requests in flight: parsing in worker processes cost as much again to unpickle the documents in this
+# process, and held each file twice in memory.
+def run_restore_pipeline(blob_names, download, write, download_workers=4, write_workers=2, queue_size=4):
+    download_queue = queue.Queue()
+    write_queue = queue.Queue(maxsize=queue_size)
+
+    for blob_name in blob_names:
+        download_queue.put((blob_name, None))
+    download_queue.put(_DONE)
+
+    def parse_and_write(blob_name, data):
+        write(blob_name, iter_backup_documents(blob_name, [data] if isinstance(data, bytes) else data))
+
+    download_threads = _run_stage("download", download_workers, download_queue, write_queue, lambda blob_name, _: download(blob_name))
+    write_threads = _run_stage("write", write_workers, write_queue, None, parse_and_write)
+
+    _finish_stage(download_threads, write_queue)
+    _finish_stage(write_threads, None)
@@ -0,0 +1,63 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class ContainerJob:
+    def __init__(self, database_name, container_name, size_kb=0, document_count=0):
+        self.database_name = database_name
+        self.container_name = container_name
+        self.size_kb = size_kb
+        self.document_count = document_count
+
+    def __repr__(self):
+        return f"ContainerJob({self.database_name}/{self.container_name}, {self.size_kb} KB, {self.document_count} docs)"
+
+
+# Parse the "key=value;key=value" format of the x-ms-resource-usage header
+def parse_resource_usage(header):
+    usage = {}
+    for item in (header or "").split(";"):
+        key, _, value = item.partition("=")
+        if key and value.isdigit():
+            usage[key.strip()] = int(value)
+    return usage
+
+
+# Read the size (KB) and document count of a container from its quota headers
+def read_container_usage(container):
+    headers = {}
+    container.read(populate_quota_info=True, response_hook=lambda response_headers, _: headers.update(response_headers))
+    usage = parse_resource_usage(headers.get("x-ms-resource-usage"))
+    return usage.get("documentsSize", 0), usage.get("documentsCount", 0)
+
+
+# Run the jobs largest-first with a global concurrency limit and a per-database limit
+def run_jobs(jobs, run_job, max_concurrency, max_per_database):
+    pending = sorted(jobs, key=lambda job: (job.size_kb, job.document_count), reverse=True)
+    running = {}
+    running_per_database = {}
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        while pending or running:
+            # Start the largest pending jobs whose database still has free slots
+            index = 0
+            while index < len(pending) and len(running) < max_concurrency:
+                job = pending[index]
+                if running_per_database.get(job.database_name, 0) >= max_per_database:
+                    index += 1
+                    continue
+                pending.pop(index)
+                running_per_database[job.database_name] = running_per_database.get(job.database_name, 0) + 1
+                running[executor.submit(run_job, job)] = job
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                running_per_database[job.database_name] -= 1
+                try:
+                    results[job] = future.result()
+                except Exception as e:
+                    print(f"Job {job} failed: {e}")
+                    results[job] = e
+
+    return results
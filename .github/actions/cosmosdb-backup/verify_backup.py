@@ -0,0 +1,298 @@
+from azure.cosmos import CosmosClient
+from azure.cosmos.exceptions import CosmosResourceNotFoundError
+from azure.core.exceptions import ResourceNotFoundError
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from backup_format import iter_backup_documents, iter_decompressed
+from backup_index import read_backup_index
+from blob_reader import open_backup_file
+from bulk_restore import _MISSING, partition_key_value
+from chunk_store import CHUNK_LIST_SUFFIX, CHUNKS_DIRECTORY, chunk_path
+from export_spec import ExportSpec
+from parallel_export import MANIFEST_FILENAME
+from storage_account import container_client_for
+
+# Integrity check of a backup run without re-reading it whole:
+# - every file of the index is stored with its recorded size (deduplicated files: their chunk list
+#   matches the recorded size and hash, and every chunk exists) with its partition key index, from a single listing
+# - VERIFY_HASH_FILES files per container are streamed to recompute their SHA-256 and document count
+# - the document count of every shard of a full backup is compared with a live count of its feed range
+# - VERIFY_SAMPLE_DOCUMENTS documents per container are read back from the source and their _etag compared
+# - every live container has an entry in the index (a failed container is missing from it)
+# The script exits with status 1 when a check fails.
+
+# Cosmos DB configurations
+COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
+COSMOS_KEY = os.getenv("COSMOS_KEY")
+
+# Azure Storage configurations
+SUBSCRIPTION_ID = os.getenv("SUBSCRIPTION_ID")
+RESOURCE_GROUP = os.getenv("RESOURCE_GROUP")
+STORAGE_ACCOUNT_NAME = os.getenv("STORAGE_ACCOUNT_NAME")
+STORAGE_CONTAINER = os.getenv("STORAGE_CONTAINER")
+
+# Backup run to verify ({account}/{timestamp}/), the most recent run with an index by default
+VERIFY_BACKUP_TIMESTAMP = os.getenv("VERIFY_BACKUP_TIMESTAMP")
+# Files per container downloaded whole to check their SHA-256 and document count
+VERIFY_HASH_FILES = int(os.getenv("VERIFY_HASH_FILES", "1"))
+# Documents per container compared with the source, and the bytes read from the start of a file to sample them
+VERIFY_SAMPLE_DOCUMENTS = int(os.getenv("VERIFY_SAMPLE_DOCUMENTS", "100"))
+VERIFY_SAMPLE_BYTES = int(os.getenv("VERIFY_SAMPLE_KB", "1024")) * 1024
+# Relative difference tolerated between the documents of a shard and its live count (documents change after the backup)
+VERIFY_COUNT_TOLERANCE = float(os.getenv("VERIFY_COUNT_TOLERANCE", "0.05"))
+# Concurrent requests of the spot checks and live counts
+VERIFY_WORKERS = int(os.getenv("VERIFY_WORKERS", "16"))
+
+# Backup runs are stored under {account}/{timestamp}/
+RUN_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}-\d{4}$")
+
+required_env_vars = {
+    "COSMOS_ENDPOINT": COSMOS_ENDPOINT,
+    "COSMOS_KEY": COSMOS_KEY,
+    "SUBSCRIPTION_ID": SUBSCRIPTION_ID,
+    "RESOURCE_GROUP": RESOURCE_GROUP,
+    "STORAGE_ACCOUNT_NAME": STORAGE_ACCOUNT_NAME,
+    "STORAGE_CONTAINER": STORAGE_CONTAINER,
+}
+missing_vars = [key for key, value in required_env_vars.items() if not value]
+if missing_vars:
+    raise ValueError(f"The following environment variables are missing: {', '.join(missing_vars)}")
+
+cosmos_account_name = COSMOS_ENDPOINT.split("//")[1].split(".")[0]
+
+
+def get_storage_container_client():
+    return container_client_for(SUBSCRIPTION_ID, RESOURCE_GROUP, STORAGE_ACCOUNT_NAME, STORAGE_CONTAINER)
+
+
+# Checks of one container, with the failures that make the verification fail
+class ContainerReport:
+    def __init__(self, database_name, container_name):
+        self.name = f"{database_name}/{container_name}"
+        self.failures = []
+        self.notes = []
+
+    def fail(self, message):
+        self.failures.append(message)
+        print(f"[{self.name}] FAILED: {message}")
+
+    def note(self, message):
+        self.notes.append(message)
+        print(f"[{self.name}] {message}")
+
+
+# Most recent backup run of the account that has an index
+def latest_indexed_run(container_client, account_name):
+    runs = sorted(
+        (prefix.name.rstrip("/").rsplit("/", 1)[-1] for prefix in container_client.walk_blobs(name_starts_with=f"{account_name}/", delimiter="/")),
+        reverse=True
+    )
+    for timestamp in runs:
+        if RUN_PATTERN.match(timestamp):
+            index = read_backup_index(container_client, account_name, timestamp)
+            if index is not None:
+                return timestamp, index
+    return None, None
+
+
+def read_json_blob(container_client, blob_name):
+    try:
+        return json.loads(container_client.get_blob_client(blob_name).download_blob().readall())
+    except ResourceNotFoundError:
+        return None
+
+
+# Compare the files of an index entry with the stored blobs (sizes of a single listing of the run)
+def verify_stored_files(container_client, entry, stored_sizes, stored_chunks, report):
+    account_name = entry["files"][0]["path"].split("/", 1)[0] if entry["files"] else None
+    for file in entry["files"]:
+        path = file["path"]
+        if file.get("partition_index") and file["partition_index"] not in stored_sizes:
+            report.fail(f"The partition key index of {path} is missing, a targeted restore reads the whole file.")
+        if path in stored_sizes:
+            if stored_sizes[path] != file["bytes"]:
+                report.fail(f"{path} has {stored_sizes[path]} bytes, {file['bytes']} were written.")
+            continue
+        if path + CHUNK_LIST_SUFFIX not in stored_sizes:
+            report.fail(f"{path} is missing.")
+            continue
+        chunk_list = read_json_blob(container_client, path + CHUNK_LIST_SUFFIX)
+        if chunk_list["bytes"] != file["bytes"] or (file.get("sha256") and chunk_list["sha256"] != file["sha256"]):
+            report.fail(f"The chunk list of {path} does not match the file written ({chunk_list['bytes']} bytes, sha256 {chunk_list['sha256']}).")
+        missing_chunks = [chunk["sha256"] for chunk in chunk_list["chunks"] if chunk_path(account_name, chunk["sha256"]) not in stored_chunks]
+        if missing_chunks:
+            report.fail(f"{len(missing_chunks)} chunks of {path} are missing, the first one is {missing_chunks[0]}.")
+
+
+# Stream a file to recompute its SHA-256 and document count, keeping a sample of its documents
+def verify_file_content(container_client, file, report, sample):
+    backup_file = open_backup_file(container_client, file["path"])
+    if backup_file is None:
+        return
+    _, chunks = backup_file
+    checksum = hashlib.sha256()
+
+    def hashed(chunks):
+        for chunk in chunks:
+            checksum.update(chunk)
+            yield chunk
+
+    document_count = 0
+    try:
+        for doc in iter_backup_documents(file["path"], hashed(chunks)):
+            document_count += 1
+            # Reservoir sampling, the file is read once
+            if len(sample) < VERIFY_SAMPLE_DOCUMENTS:
+                sample.append(doc)
+            elif random.randrange(document_count) < VERIFY_SAMPLE_DOCUMENTS:
+                sample[random.randrange(VERIFY_SAMPLE_DOCUMENTS)] = doc
+    except Exception as e:
+        report.fail(f"{file['path']} cannot be read: {e}")
+        return
+    if file.get("sha256") and checksum.hexdigest() != file["sha256"]:
+        report.fail(f"{file['path']} has sha256 {checksum.hexdigest()}, {file['sha256']} was written.")
+    if document_count != file["document_count"]:
+        report.fail(f"{file['path']} holds {document_count} documents, {file['document_count']} were written.")
+
+
+# Documents of the first VERIFY_SAMPLE_BYTES of an NDJSON file, without downloading the rest
+def sample_file_documents(container_client, file):
+    path = file["path"]
+    if ".ndjson" not in path:
+        return []
+    backup_file = open_backup_file(container_client, path, range_size=VERIFY_SAMPLE_BYTES, concurrency=1)
+    if backup_file is None:
+        return []
+    _, chunks = backup_file
+    data = next(chunks, b"")
+    chunks.close()
+    extension = path.rsplit(".ndjson", 1)[1]
+    if extension:
+        data = b"".join(iter_decompressed([data], extension))
+    # The last line may be cut by the end of the range
+    return [json.loads(line) for line in data.split(b"\n")[:-1] if line.strip()]
+
+
+# Count the live documents of every shard of a full backup and compare them with the backed up shards
+def verify_live_counts(container, manifest, report):
+    spec = ExportSpec(**(manifest.get("export_spec") or {}))
+    query = "SELECT VALUE COUNT(1) FROM c" + (f" WHERE {spec.filter}" if spec.filter else "")
+
+    def live_count(shard):
+        options = spec.query_options()
+        if shard.get("feed_range") is not None:
+            options["feed_range"] = shard["feed_range"]
+        elif "partition_key" not in options:
+            options["enable_cross_partition_query"] = True
+        return sum(container.query_items(query=query, **options))
+
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        counts = list(executor.map(live_count, manifest["shards"]))
+    for index, (shard, count) in enumerate(zip(manifest["shards"], counts)):
+        difference = abs(count - shard["document_count"])
+        if difference > VERIFY_COUNT_TOLERANCE * max(shard["document_count"], 1):
+            report.fail(f"Shard {index:04d} holds {shard['document_count']} documents, the container now has {count} in its range.")
+    report.note(f"{len(counts)} shards counted: {sum(shard['document_count'] for shard in manifest['shards'])} documents backed up, {sum(counts)} live.")
+
+
+# Read the sampled documents back from the source: a backed up version must be the live one or an older one
+def spot_check_documents(container, partition_key_paths, documents, report):
+    documents = [doc for doc in documents if "_etag" in doc and "_ts" in doc]
+    if not documents:
+        report.note("No sampled document has system properties, spot checks skipped.")
+        return
+
+    def check(doc):
+        partition_key = partition_key_value(doc, partition_key_paths)
+        try:
+            live = container.read_item(item=doc["id"], partition_key=None if partition_key is _MISSING else partition_key)
+        except CosmosResourceNotFoundError:
+            return "deleted"
+        if live["_etag"] == doc["_etag"]:
+            return "matching"
+        if live["_ts"] > doc["_ts"]:
+            return "updated"
+        report.fail(f"Document {doc['id']} has _etag {doc['_etag']} in the backup, {live['_etag']} in the container, without a later update.")
+        return "mismatched"
+
+    with ThreadPoolExecutor(max_workers=VERIFY_WORKERS) as executor:
+        results = list(executor.map(check, documents))
+    summary = ", ".join(f"{results.count(result)} {result}" for result in ("matching", "updated", "deleted", "mismatched"))
+    report.note(f"{len(documents)} documents spot checked: {summary} since the backup.")
+
+
+def verify_container(client, container_client, entry, stored_sizes, stored_chunks):
+    report = ContainerReport(entry["database"], entry["container"])
+    container = client.get_database_client(entry["database"]).get_container_client(entry["container"])
+
+    if sum(file["document_count"] for file in entry["files"]) != entry["document_count"]:
+        report.fail(f"The files hold {sum(file['document_count'] for file in entry['files'])} documents, the index records {entry['document_count']}.")
+    verify_stored_files(container_client, entry, stored_sizes, stored_chunks, report)
+
+    sample = []
+    files = [file for file in entry["files"] if file["document_count"]]
+    for file in random.sample(files, min(VERIFY_HASH_FILES, len(files))):
+        verify_file_content(container_client, file, report, sample)
+    # Documents of other files, read from their first bytes only
+    for file in random.sample(files, len(files)):
+        if len(sample) >= VERIFY_SAMPLE_DOCUMENTS:
+            break
+        documents = sample_file_documents(container_client, file)
+        sample.extend(random.sample(documents, min(len(documents), VERIFY_SAMPLE_DOCUMENTS - len(sample))))
+
+    try:
+        if entry.get("backup_type", "full") == "full":
+            manifest = read_json_blob(container_client, f"{entry['files'][0]['path'].rsplit('/', 1)[0]}/{MANIFEST_FILENAME}") if entry["files"] else None
+            if manifest is not None:
+                verify_live_counts(container, manifest, report)
+        partition_key_paths = (entry.get("partition_key") or {}).get("paths") or container.read()["partitionKey"]["paths"]
+        spot_check_documents(container, partition_key_paths, sample, report)
+    except CosmosResourceNotFoundError:
+        report.fail("The source container no longer exists.")
+    return report
+
+
+def verify_backup(client, container_client, account_name, timestamp=None):
+    if timestamp:
+        index = read_backup_index(container_client, account_name, timestamp)
+    else:
+        timestamp, index = latest_indexed_run(container_client, account_name)
+    if index is None:
+        print(f"No backup index found for {timestamp or 'any run'} of account {account_name}.")
+        return False
+    print(f"Verifying backup {account_name}/{timestamp}: {len(index['containers'])} containers, {index['document_count']} documents, {index['bytes'] / 1024 / 1024:.1f} MB...")
+
+    stored_sizes = {blob.name: blob.size for blob in container_client.list_blobs(name_starts_with=f"{account_name}/{timestamp}/")}
+    stored_chunks = set()
+    if any(name.endswith(CHUNK_LIST_SUFFIX) for name in stored_sizes):
+        stored_chunks = {blob.name for blob in container_client.list_blobs(name_starts_with=f"{account_name}/{CHUNKS_DIRECTORY}/")}
+
+    reports = [verify_container(client, container_client, entry, stored_sizes, stored_chunks) for entry in index["containers"]]
+
+    # A container whose backup failed has no index entry
+    indexed = {(entry["database"], entry["container"]) for entry in index["containers"]}
+    missing = [
+        f"{database['id']}/{container['id']}"
+        for database in client.list_databases()
+        for container in client.get_database_client(database["id"]).list_containers()
+        if (database["id"], container["id"]) not in indexed
+    ]
+    for name in missing:
+        print(f"[{name}] FAILED: the container is not in the backup.")
+
+    failed = [report for report in reports if report.failures]
+    print(f"{len(reports) - len(failed)} of {len(reports)} containers verified, {len(missing)} containers not backed up.")
+    return not failed and not missing
+
+
+if __name__ == "__main__":
+    cosmos_client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
+    if not verify_backup(cosmos_client, get_storage_container_client(), cosmos_account_name, VERIFY_BACKUP_TIMESTAMP):
+        print("Backup verification failed.")
+        sys.exit(1)
+    print("Backup verification completed.")
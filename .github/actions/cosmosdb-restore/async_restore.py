@@ -0,0 +1,190 @@
+import os
+import argparse
+import asyncio
+from datetime import datetime
+from functools import partial
+from azure.cosmos.aio import CosmosClient
+from azure.storage.blob import BlobServiceClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+import async_core
+from bulk_restore import RestoreStats
+from destination_index import INDEX_PAGE_SIZE, DestinationIndex, index_query, index_rows
+from partition_index import load_restore_selection
+from restore_plan import RESTORE_INDEX_STORAGES, RESTORE_MODES, plan_restore_blobs, prepare_documents, restore_target
+from restore_transform import load_restore_transforms
+
+# Restore on the asyncio core: the blobs of each layer are downloaded and written from one event loop,
+# with up to RESTORE_MAX_IN_FLIGHT batches in flight per blob. The plan, the container settings and the
+# per-document stage (targeted restore, differential mode, transforms) are the ones of full_restore.py
+# (restore_plan.py); checkpoints and deferred indexing are handled by full_restore.py only.
+
+# Azure Storage configurations
+STORAGE_ACCOUNT_NAME = os.getenv("STORAGE_ACCOUNT_NAME")
+STORAGE_CONTAINER = os.getenv("STORAGE_CONTAINER")
+STORAGE_ACCOUNT_KEY = os.getenv("STORAGE_ACCOUNT_KEY")
+
+# Documents per transactional batch and number of transactional batches in flight per blob
+RESTORE_BATCH_SIZE = int(os.getenv("RESTORE_BATCH_SIZE", "100"))
+RESTORE_MAX_IN_FLIGHT = int(os.getenv("RESTORE_MAX_IN_FLIGHT", "200"))
+# Fraction of the provisioned RU/s the restore may consume (0 disables the RU budget, 429 back-off stays active)
+RU_BUDGET_FRACTION = float(os.getenv("RU_BUDGET_FRACTION", "0.8"))
+# Blobs restored at once
+RESTORE_DOWNLOAD_WORKERS = int(os.getenv("RESTORE_DOWNLOAD_WORKERS", "4"))
+# Ranged reads and streaming of large backup files, as in full_restore.py
+RESTORE_RANGE_SIZE_MB = int(os.getenv("RESTORE_RANGE_SIZE_MB", "8"))
+RESTORE_RANGE_CONCURRENCY = int(os.getenv("RESTORE_RANGE_CONCURRENCY", "4"))
+RESTORE_STREAM_THRESHOLD_MB = int(os.getenv("RESTORE_STREAM_THRESHOLD_MB", "64"))
+# Restore mode, transforms and targeted restore, as in full_restore.py
+RESTORE_MODE = os.getenv("RESTORE_MODE", "full")
+RESTORE_INDEX_STORAGE = os.getenv("RESTORE_INDEX_STORAGE", "memory")
+RESTORE_TRANSFORMS = load_restore_transforms(os.getenv("RESTORE_TRANSFORMS"))
+RESTORE_SELECTION = load_restore_selection(os.getenv("RESTORE_PARTITION_KEYS"), os.getenv("RESTORE_DOCUMENT_IDS"))
+
+# Validate environment variables
+required_env_vars = {
+    "STORAGE_ACCOUNT_NAME": STORAGE_ACCOUNT_NAME,
+    "STORAGE_CONTAINER": STORAGE_CONTAINER,
+    "STORAGE_ACCOUNT_KEY": STORAGE_ACCOUNT_KEY,
+}
+
+missing_vars = [key for key, value in required_env_vars.items() if not value]
+if missing_vars:
+    raise ValueError(f"The following environment variables are missing: {', '.join(missing_vars)}")
+if RESTORE_MODE not in RESTORE_MODES:
+    raise ValueError(f"Unsupported RESTORE_MODE: {RESTORE_MODE}. Use 'full' or 'differential'.")
+if RESTORE_INDEX_STORAGE not in RESTORE_INDEX_STORAGES:
+    raise ValueError(f"Unsupported RESTORE_INDEX_STORAGE: {RESTORE_INDEX_STORAGE}. Use 'memory' or 'disk'.")
+if os.getenv("RESTORE_DEFER_INDEXING", "false").lower() == "true":
+    raise ValueError("RESTORE_DEFER_INDEXING is only supported by full_restore.py.")
+
+
+# Index the documents of an existing destination container for the differential restore, one query per feed range
+async def load_destination_index(destination_index, container, partition_key_paths):
+    query = index_query(partition_key_paths)
+
+    async def load_feed_range(feed_range):
+        pages = container.query_items(query=query, feed_range=feed_range, max_item_count=INDEX_PAGE_SIZE).by_page()
+        async for page in pages:
+            destination_index.add(index_rows([row async for row in page], partition_key_paths))
+
+    await asyncio.gather(*(load_feed_range(feed_range) for feed_range in await async_core.collect(container.read_feed_ranges())))
+    return destination_index.count
+
+
+# Create the destination container of a backup, returning its aio proxies, transform, rate controller and stats
+async def create_restore_target(cosmos_client, database_name, container_name, settings):
+    target = restore_target(RESTORE_TRANSFORMS, database_name, container_name, settings)
+    try:
+        database, container, created = await async_core.create_container_from_settings(cosmos_client, database_name, container_name, target["settings"])
+    except Exception as e:
+        print(f"Error creating container {database_name}/{container_name}: {e}")
+        return None
+
+    partition_key_paths = (await container.read())["partitionKey"]["paths"]
+    if created:
+        print(f"Container {database_name}/{container_name} created with partition key {', '.join(partition_key_paths)}.")
+    else:
+        print(f"Container {database_name}/{container_name} already exists, keeping its settings.")
+        # A new container is empty, only an existing one is worth indexing
+        if RESTORE_MODE == "differential":
+            target["destination_index"] = DestinationIndex(RESTORE_INDEX_STORAGE)
+            print(f"Indexing the documents of container {database_name}/{container_name} for the differential restore...")
+            print(f"{await load_destination_index(target['destination_index'], container, partition_key_paths)} documents indexed.")
+
+    target.update({
+        "container": container,
+        "partition_key_paths": partition_key_paths,
+        "rate_controller": await async_core.rate_controller_for(database, container, RU_BUDGET_FRACTION, RESTORE_MAX_IN_FLIGHT),
+        "stats": RestoreStats(),
+    })
+    return target
+
+
+async def restore_cosmos_db(restore_date, source_account, destination_account):
+    print(f"Starting restore process for the destination Cosmos DB account: {destination_account} based on the backup from the account: {source_account} on date: {restore_date}")
+
+    account_url = f"https://{STORAGE_ACCOUNT_NAME}.blob.core.windows.net/"
+    credential = {"account_name": STORAGE_ACCOUNT_NAME, "account_key": STORAGE_ACCOUNT_KEY}
+
+    # The plan reads a few index blobs, the synchronous client is enough
+    restore_stages, container_settings = plan_restore_blobs(
+        BlobServiceClient(account_url=account_url, credential=credential).get_container_client(STORAGE_CONTAINER),
+        source_account,
+        restore_date
+    )
+    if not restore_stages:
+        print(f"No backup found for date {restore_date} and account {source_account}.")
+        return
+    print(f"{sum(len(stage) for stage in restore_stages)} backup files found in {len(restore_stages)} layers. Starting restoration...")
+
+    COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
+    COSMOS_KEY = os.getenv("COSMOS_KEY")
+    if not COSMOS_ENDPOINT or not COSMOS_KEY:
+        raise ValueError("The environment variables COSMOS_ENDPOINT and COSMOS_KEY are required for the restore.")
+
+    async with CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY) as cosmos_client, AsyncBlobServiceClient(account_url=account_url, credential=credential) as blob_service_client:
+        container_client = blob_service_client.get_container_client(STORAGE_CONTAINER)
+
+        # Blob names follow the pattern {account}/{timestamp}/{database}/{container}/{file}
+        targets = {}
+        for stage in restore_stages:
+            for blob_name in stage:
+                key = tuple(blob_name.split("/")[2:4])
+                if key not in targets:
+                    targets[key] = await create_restore_target(cosmos_client, *key, container_settings.get(key, {}))
+
+        semaphore = asyncio.Semaphore(max(RESTORE_DOWNLOAD_WORKERS, 1))
+
+        async def restore(blob_name):
+            target = targets[tuple(blob_name.split("/")[2:4])]
+            if target is None:
+                return
+            async with semaphore:
+                try:
+                    await async_core.restore_blob(
+                        container_client,
+                        blob_name,
+                        target["container"],
+                        target["partition_key_paths"],
+                        batch_size=RESTORE_BATCH_SIZE,
+                        max_in_flight=RESTORE_MAX_IN_FLIGHT,
+                        stats=target["stats"],
+                        rate_controller=target["rate_controller"],
+                        prepare=partial(prepare_documents, target=target, selection=RESTORE_SELECTION),
+                        selection=RESTORE_SELECTION,
+                        range_size=RESTORE_RANGE_SIZE_MB * 1024 * 1024,
+                        range_concurrency=RESTORE_RANGE_CONCURRENCY,
+                        stream_threshold=RESTORE_STREAM_THRESHOLD_MB * 1024 * 1024
+                    )
+                except Exception as e:
+                    print(f"Error restoring blob {blob_name}: {e}")
+
+        # Each layer completes before the next one starts
+        for stage in restore_stages:
+            await asyncio.gather(*(restore(blob_name) for blob_name in stage))
+
+    for (database_name, container_name), target in targets.items():
+        if target is not None:
+            print(f"Container {database_name}/{container_name}: {target['stats'].summary()}")
+            print(target["rate_controller"].summary())
+            if target["destination_index"] is not None:
+                target["destination_index"].close()
+    print("Restoration completed.")
+
+
+# Configure script arguments
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Script to restore Cosmos DB backups with the asyncio core.")
+    parser.add_argument("--date", required=True, help="Backup date in the format %Y-%m-%d-%H%M.")
+    parser.add_argument("--source", required=True, help="Name of the source Cosmos DB account.")
+    parser.add_argument("--destination", required=True, help="Name of the destination Cosmos DB account.")
+    args = parser.parse_args()
+
+    try:
+        datetime.strptime(args.date, "%Y-%m-%d-%H%M")
+    except ValueError:
+        print("Invalid date format. Use the format %Y-%m-%d-%H%M.")
+        exit(1)
+
+    # Execute the restore process
+    asyncio.run(restore_cosmos_db(args.date, args.source, args.destination))
@@ -0,0 +1,364 @@
+import codecs
+import hashlib
+import json
+import zlib
+from partition_index import DEFAULT_PARTITION_INDEX_BLOCK_SIZE, DEFAULT_PARTITION_INDEX_WINDOW_SIZE, PARTITION_INDEX_SUFFIX, PartitionIndexWriter, document_keys
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compact separators keep every document on a single NDJSON line
+NDJSON_SEPARATORS = (",", ":")
+
+# File extension added by each compression codec
+COMPRESSION_EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+# gzip compression level, balanced for throughput
+GZIP_LEVEL = 6
+
+# Size of the chunks read from local backup files
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+# Serialize one document as a compact NDJSON line
+def dump_ndjson_line(doc):
+    return json.dumps(doc, separators=NDJSON_SEPARATORS, ensure_ascii=False) + "\n"
+
+
+# Return the codec to use: zstd falls back to gzip when the zstandard package is not installed,
+# unless the format compresses it natively (Parquet)
+def resolve_compression(compression, native_zstd=False):
+    if compression not in COMPRESSION_EXTENSIONS:
+        raise ValueError(f"Unsupported compression: {compression}. Use one of {', '.join(COMPRESSION_EXTENSIONS)}.")
+    if compression == "zstd" and zstandard is None and not native_zstd:
+        print("The zstandard package is not installed, using gzip compression.")
+        return "gzip"
+    return compression
+
+
+class _IdentityCompressor:
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b""
+
+
+def get_compressor(compression):
+    if compression == "gzip":
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if compression == "zstd":
+        return zstandard.ZstdCompressor().compressobj()
+    return _IdentityCompressor()
+
+
+# Whether a line ends a compressed member: a content-defined boundary taken on average every chunk_size
+# bytes, decided by the line itself so unchanged documents are cut the same way in every run
+def is_member_boundary(data, member_bytes, chunk_size):
+    if member_bytes < chunk_size // 4:
+        return False
+    return member_bytes >= chunk_size * 2 or zlib.crc32(data) % max(chunk_size // len(data), 1) == 0
+
+
+# Writes NDJSON lines into compressed segments of at most segment_size uncompressed bytes
+# (0 disables chunking). Each segment is an independent file, so it can be restored on its own.
+# segments lists the segments already written by an interrupted run, new segments are numbered after them.
+# When the sink has a chunk_size (chunk_store.DedupSink), segments are written as concatenated members
+# ending at content-defined document boundaries, and the sink file is told where each member ends.
+# With partition_key_paths, each segment also gets a sidecar partition key index (partition_index.py). Lines
+# are then buffered in windows of about index_window_size bytes sorted by partition key and id, so the
+# documents of a partition key share few members, and members end about every index_block_size bytes.
+# Both boundaries are content-defined too, so unchanged documents are still deduplicated across runs.
+class NdjsonSegmentWriter:
+    def __init__(self, sink, path_prefix, compression="gzip", segment_size=0, segments=None, partition_key_paths=None, index_block_size=DEFAULT_PARTITION_INDEX_BLOCK_SIZE, index_window_size=DEFAULT_PARTITION_INDEX_WINDOW_SIZE):
+        self.sink = sink
+        self.path_prefix = path_prefix
+        self.compression = compression
+        self.segment_size = segment_size
+        self.chunk_size = getattr(sink, "chunk_size", 0)
+        self.segments = [dict(segment) for segment in segments or []]
+        self.partition_key_paths = partition_key_paths
+        self.index_block_size = index_block_size
+        self.index_window_size = index_window_size
+        self._file = None
+        self._compressor = None
+        self._index = None
+        self._segment = None
+        self._checksum = None
+        self._member_bytes = 0
+        self._chunk_bytes = 0
+        self._window = []
+        self._window_bytes = 0
+
+    def _open_segment(self):
+        suffix = f".part-{len(self.segments):04d}" if self.segment_size else ""
+        path = f"{self.path_prefix}{suffix}.ndjson{COMPRESSION_EXTENSIONS[self.compression]}"
+        self._file = self.sink.open(path)
+        self._compressor = get_compressor(self.compression)
+        self._member_bytes = 0
+        self._chunk_bytes = 0
+        self._checksum = hashlib.sha256()
+        self._segment = {"file": path.rsplit("/", 1)[-1], "document_count": 0, "uncompressed_bytes": 0, "bytes": 0}
+        self.segments.append(self._segment)
+        if self.partition_key_paths is not None:
+            self._index = PartitionIndexWriter(self.partition_key_paths)
+
+    def _close_segment(self):
+        self._write_compressed(self._compressor.flush())
+        self._file.close()
+        self._file = None
+        # Checksum of the file as stored, to verify downloads
+        self._segment["sha256"] = self._checksum.hexdigest()
+        if self._index is not None:
+            self._index.end_block(self._segment["bytes"])
+            self._segment["partition_index"] = self._segment["file"] + PARTITION_INDEX_SUFFIX
+            with self.sink.open(f"{self.path_prefix.rsplit('/', 1)[0]}/{self._segment['partition_index']}") as index_file:
+                index_file.write(self._index.to_json())
+            self._index = None
+
+    def _write_compressed(self, data):
+        if data:
+            self._file.write(data)
+            self._checksum.update(data)
+            self._segment["bytes"] += len(data)
+
+    # doc is the document serialized in line, recorded in the partition key index. Returns the number of
+    # bytes written (the encoded line, before compression)
+    def write(self, line, doc=None):
+        # Each line is encoded once, the window keeps the bytes that _write_line compresses
+        data = line.encode("utf-8")
+        if self.partition_key_paths is None or doc is None:
+            if self._window:
+                self._flush_window()
+            self._write_line(data, None)
+            return len(data)
+        keys = document_keys(doc, self.partition_key_paths)
+        self._window.append((keys[1:], keys[0], data, keys))
+        self._window_bytes += len(data)
+        if is_member_boundary(data, self._window_bytes, self.index_window_size):
+            self._flush_window()
+        return len(data)
+
+    # Write the buffered lines grouped by partition key; without rollover they all go to the current segment
+    def _flush_window(self, rollover=True):
+        self._window.sort(key=lambda item: item[:2])
+        for _, _, data, keys in self._window:
+            self._write_line(data, keys, rollover)
+        self._window = []
+        self._window_bytes = 0
+
+    # data is an encoded line
+    def _write_line(self, data, keys, rollover=True):
+        if rollover and self._file is not None and self.segment_size and self._segment["uncompressed_bytes"] >= self.segment_size:
+            self._close_segment()
+        if self._file is None:
+            self._open_segment()
+        self._segment["document_count"] += 1
+        self._segment["uncompressed_bytes"] += len(data)
+        self._write_compressed(self._compressor.compress(data))
+        if self._index is not None:
+            # A line written without its document leaves the segment unindexed, it is then restored whole
+            if keys is None:
+                self._index = None
+            else:
+                self._index.add(keys)
+        self._member_bytes += len(data)
+        self._chunk_bytes += len(data)
+        if self.chunk_size and is_member_boundary(data, self._chunk_bytes, self.chunk_size):
+            self._end_member(end_chunk=True)
+        elif self._index is not None and is_member_boundary(data, self._member_bytes, self.index_block_size):
+            self._end_member()
+
+    # End the compressed member, and with end_chunk the chunk of the deduplicated file
+    def _end_member(self, end_chunk=False):
+        self._write_compressed(self._compressor.flush())
+        if end_chunk:
+            self._file.end_chunk()
+            self._chunk_bytes = 0
+        if self._index is not None:
+            self._index.end_block(self._segment["bytes"])
+        self._compressor = get_compressor(self.compression)
+        self._member_bytes = 0
+
+    # Close the current segment once it is full, returning True when every written line is in a closed file
+    def close_full_segment(self):
+        if self._file is None or not self.segment_size or self._segment["uncompressed_bytes"] < self.segment_size:
+            return False
+        # The buffered lines complete the full segment
+        self._flush_window(rollover=False)
+        self._close_segment()
+        return True
+
+    def close(self):
+        self._flush_window()
+        # Always produce at least one segment, even for an empty container
+        if self._file is None and not self.segments:
+            self._open_segment()
+        if self._file is not None:
+            self._close_segment()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.__exit__(exc_type, exc_value, traceback)
+
+
+# Write query pages to a writer, one document per line, as they arrive (on_page is called after each page)
+def write_ndjson_pages(pages, backup_file, transform=None, on_page=None):
+    count = 0
+    for page in pages:
+        for doc in page:
+            if transform is not None:
+                doc = transform(doc)
+            backup_file.write(dump_ndjson_line(doc), doc)
+            count += 1
+        if on_page is not None:
+            on_page()
+    return count
+
+
+# Writer class and page writer of a segmented backup format ("ndjson" or "parquet")
+def segment_writer_for(file_format):
+    if file_format == "parquet":
+        from parquet_format import ParquetSegmentWriter, write_parquet_pages
+        return ParquetSegmentWriter, write_parquet_pages
+    return NdjsonSegmentWriter, write_ndjson_pages
+
+
+def get_decompressor(extension):
+    if extension == ".gz":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if zstandard is None:
+        raise ValueError("The zstandard package is required to read .zst backups.")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+# Decompress a stream of byte chunks, including files made of several concatenated members/frames.
+# A file ending inside a member (a truncated download, a missing gzip trailer) raises ValueError.
+def iter_decompressed(chunks, extension):
+    decompressor = get_decompressor(extension)
+    in_member = False
+    for chunk in chunks:
+        while chunk:
+            in_member = True
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if not decompressor.eof:
+                break
+            # A member ended inside this chunk, continue with the next one
+            chunk = decompressor.unused_data
+            decompressor = get_decompressor(extension)
+            in_member = False
+    if in_member:
+        raise ValueError("Backup file ended inside a compressed member, it is truncated.")
+
+
+# Yield documents from an iterable of byte chunks containing NDJSON
+def iter_ndjson(chunks):
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+            line = buffer[start:end].strip()
+            if line:
+                yield json.loads(line)
+            start = end + 1
+        del buffer[:start]
+    if buffer.strip():
+        yield json.loads(buffer)
+
+
+# Yield the objects of a JSON array (legacy backup format) without parsing the whole payload at once
+def iter_json_array(chunks):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    position = 0
+    started = False
+    exhausted = False
+    incomplete = False
+    chunks = iter(chunks)
+
+    while True:
+        # Skip whitespace and the separators between array elements
+        while position < len(buffer) and buffer[position] in " \t\r\n,":
+            position += 1
+
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != "[":
+                    raise ValueError("Backup file is not a JSON array.")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == "]":
+                return
+            try:
+                doc, position = decoder.raw_decode(buffer, position)
+                yield doc
+                continue
+            except json.JSONDecodeError:
+                # The element is incomplete, read more data below
+                if exhausted:
+                    raise
+                incomplete = True
+
+        if exhausted:
+            if started:
+                raise ValueError("Backup file ended before the JSON array was closed.")
+            return
+
+        # Drop consumed text and pull the next chunks. After a failed decode the pending text is at least
+        # doubled before decoding again, so an element spanning many chunks is decoded and copied a
+        # logarithmic number of times instead of once per chunk.
+        parts = [buffer[position:]]
+        size = len(parts[0])
+        target = 2 * size if incomplete else 0
+        while len(parts) == 1 or size < target:
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+                parts.append(text_decoder.decode(b"", final=True))
+                break
+            text = text_decoder.decode(chunk)
+            parts.append(text)
+            size += len(text)
+        buffer = "".join(parts)
+        position = 0
+        incomplete = False
+
+
+# Yield the documents of a backup file based on its extension
+def iter_backup_documents(name, chunks):
+    for extension in (".gz", ".zst"):
+        if name.endswith(".ndjson" + extension):
+            return iter_ndjson(iter_decompressed(chunks, extension))
+    if name.endswith(".ndjson"):
+        return iter_ndjson(chunks)
+    if name.endswith(".json"):
+        return iter_json_array(chunks)
+    if name.endswith(".parquet"):
+        from parquet_format import iter_parquet
+        return iter_parquet(chunks)
+    raise ValueError(f"Unsupported backup file format: {name}")
+
+
+# Read a local file as an iterator of byte chunks
+def iter_file_chunks(path, chunk_size=READ_CHUNK_SIZE):
+    with open(path, "rb") as backup_file:
+        while True:
+            chunk = backup_file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
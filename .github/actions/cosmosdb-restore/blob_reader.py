@@ -0,0 +1,124 @@
+import json
+from bisect import bisect_right
+from collections import deque
+from itertools import accumulate
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceNotFoundError
+from chunk_store import CHUNK_LIST_SUFFIX, DATA_EXTENSIONS, chunk_path
+from partition_index import PARTITION_INDEX_SUFFIX
+
+# Streaming download of backup files: a file is read as concurrent ranged GETs (or, when it was
+# deduplicated, as concurrent chunk downloads) yielded in order to an incremental parser, so memory
+# stays bounded by the ranges in flight instead of the size of the file.
+
+# Size of each ranged GET
+DEFAULT_RANGE_SIZE = 8 * 1024 * 1024
+# Ranged GETs in flight per file
+DEFAULT_RANGE_CONCURRENCY = 4
+
+
+# Run the fetches (callables returning bytes) on a thread pool and yield their results in order,
+# with at most `concurrency` of them downloading or waiting to be consumed
+def iter_ordered(fetches, concurrency):
+    fetches = iter(fetches)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        try:
+            for fetch in fetches:
+                in_flight.append(executor.submit(fetch))
+                if len(in_flight) >= concurrency:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            # An abandoned iteration does not wait for the ranges nobody will read
+            for future in in_flight:
+                future.cancel()
+
+
+def iter_blob_ranges(blob_client, size, range_size=DEFAULT_RANGE_SIZE, concurrency=DEFAULT_RANGE_CONCURRENCY):
+    def fetch(offset):
+        return lambda: blob_client.download_blob(offset=offset, length=min(range_size, size - offset)).readall()
+
+    return iter_ordered((fetch(offset) for offset in range(0, size, range_size)), concurrency)
+
+
+def iter_chunks(container_client, account_name, chunks, concurrency=DEFAULT_RANGE_CONCURRENCY):
+    def fetch(digest):
+        return lambda: container_client.get_blob_client(chunk_path(account_name, digest)).download_blob().readall()
+
+    return iter_ordered((fetch(chunk["sha256"]) for chunk in chunks), concurrency)
+
+
+# Open a backup file of a storage container (azure.storage.blob), returning its size and an iterator
+# of its bytes; the download starts when the iterator is consumed. Returns None when the file is missing.
+def open_backup_file(container_client, blob_name, range_size=DEFAULT_RANGE_SIZE, concurrency=DEFAULT_RANGE_CONCURRENCY):
+    blob_client = container_client.get_blob_client(blob_name)
+    try:
+        size = blob_client.get_blob_properties().size
+        return size, iter_blob_ranges(blob_client, size, range_size, concurrency)
+    except ResourceNotFoundError:
+        if not blob_name.endswith(DATA_EXTENSIONS):
+            return None
+    # A deduplicated file is read chunk by chunk from its chunk list
+    try:
+        chunk_list = json.loads(container_client.get_blob_client(blob_name + CHUNK_LIST_SUFFIX).download_blob().readall())
+    except ResourceNotFoundError:
+        return None
+    return chunk_list["bytes"], iter_chunks(container_client, blob_name.split("/", 1)[0], chunk_list["chunks"], concurrency)
+
+
+# Split byte ranges (offset, length) into pieces of at most range_size bytes
+def split_ranges(ranges, range_size):
+    for offset, length in ranges:
+        for start in range(offset, offset + length, range_size):
+            yield start, min(range_size, offset + length - start)
+
+
+# Cut byte ranges of a deduplicated file into (digest, offset, length) reads of its chunks
+def chunk_range_slices(chunks, ranges):
+    starts = list(accumulate((chunk["bytes"] for chunk in chunks), initial=0))
+    for offset, length in ranges:
+        end = offset + length
+        index = bisect_right(starts, offset) - 1
+        while offset < end:
+            piece = min(end, starts[index + 1]) - offset
+            yield chunks[index]["sha256"], offset - starts[index], piece
+            offset += piece
+            index += 1
+
+
+# Read byte ranges of a deduplicated file as ranged reads of its chunks
+def iter_chunk_ranges(container_client, account_name, chunks, ranges, concurrency=DEFAULT_RANGE_CONCURRENCY):
+    def fetch(digest, offset, length):
+        return lambda: container_client.get_blob_client(chunk_path(account_name, digest)).download_blob(offset=offset, length=length).readall()
+
+    return iter_ordered((fetch(*piece) for piece in chunk_range_slices(chunks, ranges)), concurrency)
+
+
+# Read byte ranges (offset, length) of a backup file in order, as concurrent ranged GETs of the blob or of
+# the chunks of a deduplicated file. Returns None when the file is missing.
+def open_backup_file_ranges(container_client, blob_name, ranges, range_size=DEFAULT_RANGE_SIZE, concurrency=DEFAULT_RANGE_CONCURRENCY):
+    ranges = list(split_ranges(ranges, range_size))
+    blob_client = container_client.get_blob_client(blob_name)
+    try:
+        blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        try:
+            chunk_list = json.loads(container_client.get_blob_client(blob_name + CHUNK_LIST_SUFFIX).download_blob().readall())
+        except ResourceNotFoundError:
+            return None
+        return iter_chunk_ranges(container_client, blob_name.split("/", 1)[0], chunk_list["chunks"], ranges, concurrency)
+
+    def fetch(offset, length):
+        return lambda: blob_client.download_blob(offset=offset, length=length).readall()
+
+    return iter_ordered((fetch(offset, length) for offset, length in ranges), concurrency)
+
+
+# Sidecar partition key index of a backup file (partition_index.py), or None when it was written without one
+def read_partition_index(container_client, blob_name):
+    try:
+        return json.loads(container_client.get_blob_client(blob_name + PARTITION_INDEX_SUFFIX).download_blob().readall())
+    except ResourceNotFoundError:
+        return None
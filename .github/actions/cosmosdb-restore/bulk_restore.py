@@ -0,0 +1,211 @@
+import json
+import threading
+import time
+from contextlib import nullcontext
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from metrics import registry
+
+# Maximum number of operations accepted by a Cosmos DB transactional batch
+TRANSACTIONAL_BATCH_LIMIT = 100
+# Maximum serialized size of the documents of a transactional batch: the request is limited to 2 MB,
+# some room is left for the operation headers
+TRANSACTIONAL_BATCH_BYTES = 1900 * 1024
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 10
+
+# Marker for documents that do not carry a partition key value
+_MISSING = object()
+
+
+# With labels (database, container), the counts are also recorded in the metrics registry
+class RestoreStats:
+    def __init__(self, labels=None):
+        self.documents = 0
+        self.failed = 0
+        self.skipped = 0
+        self.request_charge = 0.0
+        self.labels = labels
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_documents(self, count):
+        with self._lock:
+            self.documents += count
+        if self.labels is not None:
+            registry.inc("cosmosdb_documents_total", count, operation="restore", **self.labels)
+
+    def add_failed(self, count):
+        with self._lock:
+            self.failed += count
+        if self.labels is not None:
+            registry.inc("cosmosdb_failed_documents_total", count, operation="restore", **self.labels)
+
+    # Documents left out by a differential restore because the destination already holds them
+    def add_skipped(self, count):
+        with self._lock:
+            self.skipped += count
+
+    def add_request_charge(self, charge):
+        with self._lock:
+            self.request_charge += charge
+        if self.labels is not None:
+            registry.inc("cosmosdb_request_charge_total", charge, operation="restore", **self.labels)
+
+    # Hook passed to every request to accumulate the RU charge of each HTTP response
+    def charge_hook(self, response):
+        charge = response.http_response.headers.get("x-ms-request-charge")
+        if charge:
+            self.add_request_charge(float(charge))
+        if self.labels is not None and response.http_response.status_code == 429:
+            registry.inc("cosmosdb_throttled_requests_total", 1, operation="restore", **self.labels)
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        return (
+            f"{self.documents} documents restored, {self.failed} failed"
+            f"{f', {self.skipped} unchanged skipped' if self.skipped else ''} in {elapsed:.1f}s "
+            f"({self.documents / elapsed:.0f} docs/s, {self.request_charge / elapsed:.0f} RU/s, "
+            f"{self.request_charge:.0f} RU total)"
+        )
+
+
+# Extract the partition key value of a document from the container partition key paths
+def partition_key_value(doc, partition_key_paths):
+    values = []
+    for path in partition_key_paths:
+        value = doc
+        for part in path.strip("/").split("/"):
+            if not isinstance(value, dict) or part not in value:
+                return _MISSING
+            value = value[part]
+        values.append(value)
+    return values[0] if len(values) == 1 else values
+
+
+# Group documents by partition key, yielding (partition_key, docs) groups of at most batch_size documents
+# and max_bytes of serialized documents (a larger document is yielded alone and upserted on its own)
+def iter_partition_batches(documents, partition_key_paths, batch_size, max_buffered, max_bytes=TRANSACTIONAL_BATCH_BYTES):
+    # group_key -> [partition key value, documents, serialized bytes]
+    groups = {}
+    buffered = 0
+    for doc in documents:
+        value = partition_key_value(doc, partition_key_paths)
+        if value is _MISSING:
+            yield _MISSING, [doc]
+            continue
+
+        # ASCII-escaped JSON never undercounts the UTF-8 payload
+        size = len(json.dumps(doc, separators=(",", ":")))
+        group_key = json.dumps(value, sort_keys=True)
+        group = groups.get(group_key)
+        if group is not None and group[2] + size > max_bytes:
+            del groups[group_key]
+            buffered -= len(group[1])
+            yield group[0], group[1]
+            group = None
+        if group is None:
+            group = groups[group_key] = [value, [], 0]
+        group[1].append(doc)
+        group[2] += size
+        buffered += 1
+
+        if len(group[1]) >= batch_size:
+            del groups[group_key]
+            buffered -= len(group[1])
+            yield group[0], group[1]
+        elif buffered >= max_buffered:
+            # Too many partially filled groups in memory, flush the largest one
+            group_key = max(groups, key=lambda key: len(groups[key][1]))
+            group = groups.pop(group_key)
+            buffered -= len(group[1])
+            yield group[0], group[1]
+
+    for value, docs, _ in groups.values():
+        yield value, docs
+
+
+# Build the raw_response_hook that feeds the restore stats and the optional rate controller
+def request_hook(stats, rate_controller=None):
+    if rate_controller is None:
+        return stats.charge_hook
+
+    def hook(response):
+        stats.charge_hook(response)
+        rate_controller.hook(response)
+    return hook
+
+
+# Hold a rate controller slot for one request, when a controller is configured
+def request_slot(rate_controller=None):
+    return rate_controller.slot() if rate_controller is not None else nullcontext()
+
+
+# Upsert documents one by one, recording the failures
+def upsert_documents(container, docs, stats, rate_controller=None):
+    hook = request_hook(stats, rate_controller)
+    for doc in docs:
+        try:
+            with request_slot(rate_controller):
+                container.upsert_item(doc, raw_response_hook=hook)
+            stats.add_documents(1)
+        except Exception as e:
+            stats.add_failed(1)
+            print(f"Error restoring document {doc.get('id', 'without ID')}: {e}")
+
+
+# Operations of the transactional batch writing a group of documents sharing a partition key, or None
+# when the group is upserted one document at a time (single documents, documents without a partition key value)
+def batch_operations(partition_key, docs):
+    if partition_key is _MISSING or len(docs) == 1:
+        return None
+    return [("upsert", (doc,)) for doc in docs]
+
+
+# Write a group of documents sharing a partition key as a transactional batch
+def write_partition_batch(container, partition_key, docs, stats, rate_controller=None):
+    operations = batch_operations(partition_key, docs)
+    if operations is None:
+        upsert_documents(container, docs, stats, rate_controller)
+        return
+
+    try:
+        with request_slot(rate_controller):
+            container.execute_item_batch(operations, partition_key=partition_key, raw_response_hook=request_hook(stats, rate_controller))
+        stats.add_documents(len(docs))
+    except Exception as e:
+        # Batches are atomic: fall back to single upserts so one bad document does not drop the others
+        print(f"Transactional batch for partition key {partition_key!r} failed, retrying documents individually: {e}")
+        upsert_documents(container, docs, stats, rate_controller)
+
+
+# Restore documents with concurrent transactional batches grouped by partition key
+def bulk_upsert(container, documents, partition_key_paths=None, workers=16, batch_size=TRANSACTIONAL_BATCH_LIMIT, max_in_flight=None, stats=None, rate_controller=None):
+    if partition_key_paths is None:
+        partition_key_paths = container.read()["partitionKey"]["paths"]
+    batch_size = max(1, min(batch_size, TRANSACTIONAL_BATCH_LIMIT))
+    max_in_flight = max_in_flight or workers * 2
+    stats = stats or RestoreStats()
+    last_report = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        groups = iter_partition_batches(documents, partition_key_paths, batch_size, max_buffered=batch_size * max_in_flight)
+        for partition_key, docs in groups:
+            # Bound the number of batches waiting in memory
+            while len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            in_flight.add(executor.submit(write_partition_batch, container, partition_key, docs, stats, rate_controller))
+
+            if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                print(stats.summary())
+                if rate_controller is not None:
+                    print(rate_controller.summary())
+                last_report = time.monotonic()
+
+        for future in in_flight:
+            future.result()
+
+    return stats
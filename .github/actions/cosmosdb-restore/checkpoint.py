@@ -0,0 +1,84 @@
+import json
+import threading
+import time
+
+# Minimum number of seconds between two saves of a checkpoint (completed work is always saved)
+CHECKPOINT_INTERVAL = 30
+
+
+# Progress of a backup or restore, persisted to a small state blob so an interrupted job can resume.
+# write(data) stores the serialized state; it is called under the lock, so saves never go back in time.
+class Checkpoint:
+    def __init__(self, state, write, interval=CHECKPOINT_INTERVAL):
+        self.state = state
+        self.write = write
+        self.interval = interval
+        self.lock = threading.RLock()
+        self._saved = time.monotonic()
+
+    def save(self, force=False):
+        with self.lock:
+            if not force and time.monotonic() - self._saved < self.interval:
+                return
+            self.state["updated"] = time.time()
+            self.write(json.dumps(self.state).encode("utf-8"))
+            self._saved = time.monotonic()
+
+    # Progress of a container, keyed by "{database}/{container}"
+    def container(self, key):
+        with self.lock:
+            return self.state.setdefault("containers", {}).setdefault(key, {})
+
+    # Store the result of a finished container, so a resumed run skips it
+    def complete_container(self, key, result):
+        with self.lock:
+            self.state.setdefault("containers", {})[key] = {"done": True, "result": result}
+        self.save(force=True)
+
+    # Progress of one shard of a container; progress recorded for another feed range is discarded
+    def shard(self, key, index, feed_range=None):
+        with self.lock:
+            shards = self.container(key).setdefault("shards", {})
+            entry = shards.get(str(index))
+            if entry is None or entry.get("feed_range") != feed_range:
+                entry = shards[str(index)] = {"feed_range": feed_range, "segments": [], "continuation": None, "done": False}
+            return ShardCheckpoint(self, entry)
+
+    # Names of the items (restored blobs) completed so far
+    def completed(self):
+        with self.lock:
+            return set(self.state.setdefault("completed", []))
+
+    def mark_completed(self, name):
+        with self.lock:
+            self.state.setdefault("completed", []).append(name)
+        self.save()
+
+
+# Progress of one shard: the segments already written and the continuation token to resume after them
+class ShardCheckpoint:
+    def __init__(self, checkpoint, entry):
+        self.checkpoint = checkpoint
+        self.entry = entry
+
+    @property
+    def done(self):
+        return self.entry["done"]
+
+    @property
+    def segments(self):
+        return self.entry["segments"]
+
+    @property
+    def continuation(self):
+        return self.entry["continuation"]
+
+    def record(self, segments, continuation, done=False):
+        with self.checkpoint.lock:
+            self.entry.update(segments=[dict(segment) for segment in segments], continuation=continuation, done=done)
+        self.checkpoint.save(force=done)
+
+
+# Load a checkpoint from its JSON text, or start an empty one
+def load_checkpoint(state_text, write, **state):
+    return Checkpoint(json.loads(state_text) if state_text else dict(state), write)
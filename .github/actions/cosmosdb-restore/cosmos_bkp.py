@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+import argparse
+import os
+import runpy
+import sys
+import time
+
+# Single entry point of the backup and restore tools: cosmos-bkp backup|restore|verify|seed|prune|delete.
+# Only the standard library is imported up front, so --help and argument errors return at once; the script
+# of the subcommand (and the Azure SDK modules it needs) is loaded only when it runs. Options are passed to
+# the scripts as the environment variables documented in the README, and any other setting can be given
+# with -e NAME=VALUE. The scripts live in this directory or in the sibling action directory.
+
+ACTION_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_DIRECTORIES = (
+    ACTION_DIRECTORY,
+    os.path.join(os.path.dirname(ACTION_DIRECTORY), "cosmosdb-backup"),
+    os.path.join(os.path.dirname(ACTION_DIRECTORY), "cosmosdb-restore"),
+)
+
+# Option of each subcommand -> (environment variable, help)
+BACKUP_OPTIONS = {
+    "--mode": ("BACKUP_MODE", "full or incremental"),
+    "--format": ("BACKUP_FORMAT", "ndjson, parquet or json"),
+    "--compression": ("BACKUP_COMPRESSION", "gzip, zstd or none"),
+    "--upload": ("BACKUP_UPLOAD", "local or direct"),
+    "--workers": ("BACKUP_WORKERS", "feed ranges drained concurrently per container"),
+    "--concurrency": ("BACKUP_CONCURRENCY", "containers backed up at the same time"),
+    "--export-specs": ("EXPORT_SPECS", "per-container export specs, JSON text or file"),
+    "--dedup": ("BACKUP_DEDUP", "true stores content-addressed chunks shared across runs"),
+    "--partition-index": ("BACKUP_PARTITION_INDEX", "true writes a partition key index next to the segments"),
+}
+RESTORE_OPTIONS = {
+    "--mode": ("RESTORE_MODE", "full or differential"),
+    "--transforms": ("RESTORE_TRANSFORMS", "per-container document transforms, JSON text or file"),
+    "--partition-keys": ("RESTORE_PARTITION_KEYS", "restore only these partition key values, JSON list"),
+    "--document-ids": ("RESTORE_DOCUMENT_IDS", "restore only the documents with these ids, JSON list"),
+    "--workers": ("RESTORE_WORKERS", "concurrent write workers per file"),
+    "--defer-indexing": ("RESTORE_DEFER_INDEXING", "true loads new containers without indexing"),
+}
+VERIFY_OPTIONS = {
+    "--timestamp": ("VERIFY_BACKUP_TIMESTAMP", "backup run to verify, the latest indexed run by default"),
+    "--hash-files": ("VERIFY_HASH_FILES", "files per container downloaded to check their SHA-256"),
+    "--sample-documents": ("VERIFY_SAMPLE_DOCUMENTS", "documents per container compared with the source"),
+    "--count-tolerance": ("VERIFY_COUNT_TOLERANCE", "relative shard count difference tolerated"),
+}
+SEED_OPTIONS = {
+    "--database": ("DATABASE_NAME", "database to seed"),
+    "--container": ("CONTAINER_NAME", "container to seed"),
+    "--documents": ("NUM_DOCUMENTS", "documents to insert"),
+    "--seed": ("FAKE_DATA_SEED", "seed of the generator"),
+    "--document-size": ("DOCUMENT_SIZE_BYTES", "approximate size of each document"),
+    "--nesting-depth": ("NESTING_DEPTH", "extra nesting levels of the metadata field"),
+    "--partitions": ("PARTITION_COUNT", "distinct partition key values"),
+    "--throughput": ("CONTAINER_THROUGHPUT", "RU/s of a new container"),
+}
+PRUNE_OPTIONS = {
+    "--retention-days": ("BACKUP_RETENTION_DAYS", "age in days after which a run is deleted"),
+    "--gc-grace-hours": ("CHUNK_GC_GRACE_HOURS", "age under which unreferenced chunks are kept"),
+}
+
+
+def add_options(parser, options):
+    for option, (variable, help_text) in options.items():
+        parser.add_argument(option, dest=variable, metavar=variable, help=help_text)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="cosmos-bkp", description="Back up, restore and verify Cosmos DB accounts.")
+    parser.add_argument("-e", "--env", action="append", default=[], metavar="NAME=VALUE", help="set any environment variable read by the scripts")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backup = subparsers.add_parser("backup", help="back up every container of the account (full_backup.py)")
+    backup.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio engine (async_backup.py)")
+    add_options(backup, BACKUP_OPTIONS)
+
+    restore = subparsers.add_parser("restore", help="restore a backup run into an account (full_restore.py)")
+    restore.add_argument("--date", required=True, help="backup date in the format %%Y-%%m-%%d-%%H%%M")
+    restore.add_argument("--source", required=True, help="name of the source Cosmos DB account")
+    restore.add_argument("--destination", required=True, help="name of the destination Cosmos DB account")
+    restore.add_argument("--restart", action="store_true", help="ignore the checkpoint of an interrupted restore")
+    restore.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio engine (async_restore.py)")
+    add_options(restore, RESTORE_OPTIONS)
+
+    verify = subparsers.add_parser("verify", help="check a backup run against its index, the stored blobs and the source (verify_backup.py)")
+    add_options(verify, VERIFY_OPTIONS)
+
+    seed = subparsers.add_parser("seed", help="insert synthetic documents into a container (insert_fake_data.py)")
+    add_options(seed, SEED_OPTIONS)
+
+    prune = subparsers.add_parser("prune", help="delete expired runs and unreferenced chunks (prune_backups.py)")
+    add_options(prune, PRUNE_OPTIONS)
+
+    delete = subparsers.add_parser("delete", help="delete every database of the account (delete.py)")
+    delete.add_argument("--yes", action="store_true", help="confirm the deletion")
+    return parser
+
+
+def find_script(filename):
+    for directory in SCRIPT_DIRECTORIES:
+        path = os.path.join(directory, filename)
+        if os.path.isfile(path):
+            return path
+    raise SystemExit(f"cosmos-bkp: {filename} not found in {', '.join(SCRIPT_DIRECTORIES)}.")
+
+
+# Run a script as __main__ with its own directory first on the import path
+def run_script(filename, arguments=()):
+    path = find_script(filename)
+    sys.path.insert(0, os.path.dirname(path))
+    sys.argv = [path, *arguments]
+    started = time.monotonic()
+    try:
+        runpy.run_path(path, run_name="__main__")
+    finally:
+        print(f"cosmos-bkp: {filename} finished in {time.monotonic() - started:.1f}s.")
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    for setting in args.env:
+        name, separator, value = setting.partition("=")
+        if not separator:
+            raise SystemExit(f"cosmos-bkp: invalid -e {setting}, use NAME=VALUE.")
+        os.environ[name] = value
+    for name, value in vars(args).items():
+        if name.isupper() and value is not None:
+            os.environ[name] = value
+
+    if args.command == "backup":
+        run_script("async_backup.py" if args.use_async else "full_backup.py")
+    elif args.command == "restore":
+        # The restore reads the Storage Account key from STORAGE_ACCOUNT_KEY, resolved here when the
+        # subscription and resource group are known
+        if not os.getenv("STORAGE_ACCOUNT_KEY") and all(os.getenv(name) for name in ("SUBSCRIPTION_ID", "RESOURCE_GROUP", "STORAGE_ACCOUNT_NAME")):
+            sys.path.insert(0, os.path.dirname(find_script("storage_account.py")))
+            from storage_account import storage_account_key
+            storage_account_key(os.getenv("SUBSCRIPTION_ID"), os.getenv("RESOURCE_GROUP"), os.getenv("STORAGE_ACCOUNT_NAME"))
+        arguments = ["--date", args.date, "--source", args.source, "--destination", args.destination]
+        if args.restart:
+            if args.use_async:
+                raise SystemExit("cosmos-bkp: the asyncio restore keeps no checkpoint, --restart only applies to full_restore.py.")
+            arguments.append("--restart")
+        if args.use_async and os.getenv("RESTORE_DEFER_INDEXING", "false").lower() == "true":
+            raise SystemExit("cosmos-bkp: deferred indexing only applies to full_restore.py, drop --defer-indexing or --async.")
+        run_script("async_restore.py" if args.use_async else "full_restore.py", arguments)
+    elif args.command == "verify":
+        run_script("verify_backup.py")
+    elif args.command == "seed":
+        run_script("insert_fake_data.py")
+    elif args.command == "prune":
+        run_script("prune_backups.py")
+    elif args.command == "delete":
+        if not args.yes:
+            raise SystemExit("cosmos-bkp: delete removes every database of the account, pass --yes to confirm.")
+        run_script("delete.py")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from bulk_restore import _MISSING, partition_key_value
+from restore_transform import RESTORE_DIGEST_PROPERTY
+
+# Index of the documents already in a destination container, used by the differential restore to skip
+# the backed up documents the destination already holds. The restore stores a digest of the content of
+# every document it writes in RESTORE_DIGEST_PROPERTY; a backed up document is skipped when its digest
+# is the one stored in the destination, so a newer backup and an older one (a rollback) are both written
+# as long as they differ. The _ts of the destination is the time of the last write there, not of the
+# source change, so it cannot be compared with the backup. Each document is a 16-byte digest of its
+# partition key and id mapped to its content digest, kept in a dict ("memory") or in a temporary SQLite
+# file ("disk") for containers too large for the memory of the runner.
+
+# Documents fetched per page of the index query
+INDEX_PAGE_SIZE = 10000
+
+
+def document_key(doc_id, partition_key):
+    key = [doc_id] if partition_key is _MISSING else [doc_id, partition_key]
+    return hashlib.blake2b(json.dumps(key, separators=(",", ":")).encode("utf-8"), digest_size=16).digest()
+
+
+# Hex digest of a transformed document, independent of the order of its properties
+def content_digest(doc):
+    text = json.dumps(doc, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# Query returning the id, content digest and partition key values (aliased pk0, pk1, ...) of every
+# document written by a differential restore; the other documents are missing from the index and rewritten
+def index_query(partition_key_paths):
+    fields = ["c.id", f"c[{json.dumps(RESTORE_DIGEST_PROPERTY)}] AS digest"]
+    for position, path in enumerate(partition_key_paths):
+        fields.append("c" + "".join(f"[{json.dumps(part)}]" for part in path.strip("/").split("/")) + f" AS pk{position}")
+    return f"SELECT {', '.join(fields)} FROM c WHERE IS_DEFINED(c[{json.dumps(RESTORE_DIGEST_PROPERTY)}])"
+
+
+# Index rows (key, digest) of a page of the index query
+def index_rows(page, partition_key_paths):
+    rows = []
+    for row in page:
+        values = [row[f"pk{position}"] if f"pk{position}" in row else _MISSING for position in range(len(partition_key_paths))]
+        partition_key = _MISSING if _MISSING in values else values[0] if len(values) == 1 else values
+        rows.append((document_key(row["id"], partition_key), row["digest"]))
+    return rows
+
+
+class DestinationIndex:
+    def __init__(self, storage="memory"):
+        self.storage = storage
+        self.count = 0
+        self._lock = threading.Lock()
+        if storage == "disk":
+            self._directory = tempfile.mkdtemp(prefix="restore-index-")
+            self._database = sqlite3.connect(os.path.join(self._directory, "index.sqlite"), check_same_thread=False)
+            self._database.execute("PRAGMA journal_mode = OFF")
+            self._database.execute("PRAGMA synchronous = OFF")
+            self._database.execute("CREATE TABLE documents (key BLOB PRIMARY KEY, digest TEXT) WITHOUT ROWID")
+        else:
+            self._digests = {}
+
+    def add(self, rows):
+        with self._lock:
+            if self.storage == "disk":
+                self._database.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?)", rows)
+            else:
+                self._digests.update(rows)
+            self.count += len(rows)
+
+    def digest(self, key):
+        with self._lock:
+            if self.storage == "disk":
+                row = self._database.execute("SELECT digest FROM documents WHERE key = ?", (key,)).fetchone()
+                return row[0] if row else None
+            return self._digests.get(key)
+
+    # Stream the id, digest and partition key of every destination document, one query per feed range
+    # (async_restore.py loads it with the aio client through index_query and index_rows)
+    def load(self, container, partition_key_paths, workers=4):
+        query = index_query(partition_key_paths)
+
+        def load_feed_range(feed_range):
+            pages = container.query_items(query=query, feed_range=feed_range, max_item_count=INDEX_PAGE_SIZE).by_page()
+            for page in pages:
+                self.add(index_rows(page, partition_key_paths))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(load_feed_range, container.read_feed_ranges()))
+        return self.count
+
+    # Keep the transformed documents whose digest differs from the destination copy, stamped with their
+    # digest, calling on_skipped(count) for the documents left out
+    def changed_documents(self, documents, partition_key_paths, on_skipped=None):
+        skipped = 0
+        for doc in documents:
+            digest = content_digest(doc)
+            if self.digest(document_key(doc.get("id"), partition_key_value(doc, partition_key_paths))) == digest:
+                skipped += 1
+                continue
+            doc[RESTORE_DIGEST_PROPERTY] = digest
+            yield doc
+        if on_skipped is not None and skipped:
+            on_skipped(skipped)
+
+    def close(self):
+        if self.storage == "disk":
+            self._database.close()
+            os.remove(os.path.join(self._directory, "index.sqlite"))
+            os.rmdir(self._directory)
@@ -1,16 +1,56 @@
 import os
-import json
 import argparse
 from datetime import datetime
 from azure.cosmos import CosmosClient
 from azure.storage.blob import BlobServiceClient
 from azure.identity import DefaultAzureCredential
+from azure.core.exceptions import ResourceNotFoundError
+from blob_reader import open_backup_file, open_backup_file_ranges, read_partition_index
+from checkpoint import load_checkpoint
+from metrics import ProgressReporter, registry, span
+from partition_index import load_restore_selection
+from destination_index import DestinationIndex
+from restore_transform import load_restore_transforms
+from restore_plan import RESTORE_INDEX_STORAGES, RESTORE_MODES, plan_restore_blobs, prepare_documents, restore_target
+from container_settings import apply_container_settings, can_defer_indexing, create_container_from_settings
+from bulk_restore import RestoreStats, bulk_upsert
+from restore_pipeline import run_restore_pipeline
+from throttle import rate_controller_for
 
 # Azure Storage configurations
 STORAGE_ACCOUNT_NAME = os.getenv("STORAGE_ACCOUNT_NAME")
 STORAGE_CONTAINER = os.getenv("STORAGE_CONTAINER")
 STORAGE_ACCOUNT_KEY = os.getenv("STORAGE_ACCOUNT_KEY")
 
+# Number of concurrent write workers and documents per transactional batch
+RESTORE_WORKERS = int(os.getenv("RESTORE_WORKERS", "16"))
+RESTORE_BATCH_SIZE = int(os.getenv("RESTORE_BATCH_SIZE", "100"))
+# Fraction of the provisioned RU/s the restore may consume (0 disables the RU budget, 429 back-off stays active)
+RU_BUDGET_FRACTION = float(os.getenv("RU_BUDGET_FRACTION", "0.8"))
+# Restore pipeline: concurrent blob downloads, files written at once and files buffered between stages
+RESTORE_DOWNLOAD_WORKERS = int(os.getenv("RESTORE_DOWNLOAD_WORKERS", "4"))
+RESTORE_WRITE_WORKERS = int(os.getenv("RESTORE_WRITE_WORKERS", "2"))
+RESTORE_QUEUE_SIZE = int(os.getenv("RESTORE_QUEUE_SIZE", "4"))
+# Backup files are downloaded as concurrent ranged GETs of RESTORE_RANGE_SIZE_MB, RESTORE_RANGE_CONCURRENCY at a time;
+# files larger than RESTORE_STREAM_THRESHOLD_MB are parsed and written while they download instead of held in memory
+RESTORE_RANGE_SIZE_MB = int(os.getenv("RESTORE_RANGE_SIZE_MB", "8"))
+RESTORE_RANGE_CONCURRENCY = int(os.getenv("RESTORE_RANGE_CONCURRENCY", "4"))
+RESTORE_STREAM_THRESHOLD_MB = int(os.getenv("RESTORE_STREAM_THRESHOLD_MB", "64"))
+# Restore mode: "full" upserts every document, "differential" first indexes the id and content digest of
+# the documents already in an existing destination container and only writes the documents missing or
+# different there.
+# The index is kept in memory or, for very large containers, in a temporary SQLite file ("disk").
+RESTORE_MODE = os.getenv("RESTORE_MODE", "full")
+RESTORE_INDEX_STORAGE = os.getenv("RESTORE_INDEX_STORAGE", "memory")
+# Per-container transforms applied to every document before it is written (renamed properties, rewritten
+# partition key, custom function), as JSON text or a JSON file. System properties and container_name are stripped by default.
+RESTORE_TRANSFORMS = load_restore_transforms(os.getenv("RESTORE_TRANSFORMS"))
+# Targeted restore of selected partition key values and/or document ids (JSON lists, a hierarchical partition key
+# value is a list): only the parts of the files whose partition key index may hold them are downloaded
+RESTORE_SELECTION = load_restore_selection(os.getenv("RESTORE_PARTITION_KEYS"), os.getenv("RESTORE_DOCUMENT_IDS"))
+# Create new containers without indexing and apply the source indexing policy once the documents are loaded
+RESTORE_DEFER_INDEXING = os.getenv("RESTORE_DEFER_INDEXING", "false").lower() == "true"
+
 # Validate environment variables
 required_env_vars = {
     "STORAGE_ACCOUNT_NAME": STORAGE_ACCOUNT_NAME,
@@ -21,9 +61,51 @@ required_env_vars = {
 missing_vars = [key for key, value in required_env_vars.items() if not value]
 if missing_vars:
     raise ValueError(f"The following environment variables are missing: {', '.join(missing_vars)}")
+if RESTORE_MODE not in RESTORE_MODES:
+    raise ValueError(f"Unsupported RESTORE_MODE: {RESTORE_MODE}. Use 'full' or 'differential'.")
+if RESTORE_INDEX_STORAGE not in RESTORE_INDEX_STORAGES:
+    raise ValueError(f"Unsupported RESTORE_INDEX_STORAGE: {RESTORE_INDEX_STORAGE}. Use 'memory' or 'disk'.")
+
+# Function to create the destination database and container of a backup with the settings of the source
+# container, returning its rate controller and stats
+def create_restore_target(cosmos_client, database_name, container_name, settings):
+    target = restore_target(RESTORE_TRANSFORMS, database_name, container_name, settings)
+    settings = target["settings"]
+    defer_indexing = RESTORE_DEFER_INDEXING and bool(settings.get("indexing_policy"))
+    if defer_indexing and not can_defer_indexing(settings):
+        print(f"Container {container_name} has unique keys, its indexing cannot be deferred.")
+        defer_indexing = False
+
+    try:
+        database, container, created = create_container_from_settings(cosmos_client, database_name, container_name, settings, defer_indexing)
+    except Exception as e:
+        print(f"Error creating container {database_name}/{container_name}: {e}")
+        return None
+
+    partition_key_paths = container.read()["partitionKey"]["paths"]
+    if created:
+        print(f"Container {database_name}/{container_name} created with partition key {', '.join(partition_key_paths)}{' and deferred indexing' if defer_indexing else ''}.")
+    else:
+        print(f"Container {database_name}/{container_name} already exists, keeping its settings.")
+        # A new container is empty, only an existing one is worth indexing
+        if RESTORE_MODE == "differential":
+            target["destination_index"] = DestinationIndex(RESTORE_INDEX_STORAGE)
+            print(f"Indexing the documents of container {database_name}/{container_name} for the differential restore...")
+            print(f"{target['destination_index'].load(container, partition_key_paths)} documents indexed.")
+
+    target.update({
+        "database": database,
+        "container": container,
+        "partition_key_paths": partition_key_paths,
+        "deferred_indexing": created and defer_indexing,
+        "rate_controller": rate_controller_for(database, container, RU_BUDGET_FRACTION, RESTORE_WORKERS),
+        "stats": RestoreStats(),
+    })
+    return target
+
 
 # Function to restore data to Cosmos DB
-def restore_cosmos_db(restore_date, source_account, destination_account):
+def restore_cosmos_db(restore_date, source_account, destination_account, restart=False):
     print(f"Starting restore process for the destination Cosmos DB account: {destination_account} based on the backup from the account: {source_account} on date: {restore_date}")
 
     # Connect to Azure Blob Storage
@@ -33,17 +115,30 @@ def restore_cosmos_db(restore_date, source_account, destination_account):
     )
     container_client = blob_service_client.get_container_client(STORAGE_CONTAINER)
 
-    # List blobs in the container for the specified date and source account
-    restore_blobs = [
-        blob.name for blob in container_client.list_blobs()
-        if f"{source_account}/{restore_date}" in blob.name
-    ]
+    # List the base backup and delta layers needed to rebuild the state at the specified date
+    restore_stages, container_settings = plan_restore_blobs(container_client, source_account, restore_date)
 
-    if not restore_blobs:
+    if not restore_stages:
         print(f"No backup found for date {restore_date} and account {source_account}.")
         return
 
-    print(f"{len(restore_blobs)} backup files found. Starting restoration...")
+    print(f"{sum(len(stage) for stage in restore_stages)} backup files found in {len(restore_stages)} layers. Starting restoration...")
+    checkpoint_name = f"restore-{destination_account}"
+    if RESTORE_SELECTION.active:
+        print(f"Restoring only the partition keys {RESTORE_SELECTION.partition_keys} and document ids {RESTORE_SELECTION.document_ids}.")
+        # A targeted restore completes the files for its selection only, it keeps its own checkpoint
+        checkpoint_name += f"-{RESTORE_SELECTION.digest()}"
+
+    # Blobs restored by an interrupted run of the same restore are skipped
+    checkpoint_client = container_client.get_blob_client(f"{source_account}/{restore_date}/{checkpoint_name}.checkpoint.json")
+    try:
+        checkpoint_data = None if restart else checkpoint_client.download_blob().readall()
+    except ResourceNotFoundError:
+        checkpoint_data = None
+    checkpoint = load_checkpoint(checkpoint_data, lambda data: checkpoint_client.upload_blob(data, overwrite=True))
+    completed_blobs = checkpoint.completed()
+    if completed_blobs:
+        print(f"Resuming the interrupted restore: {len(completed_blobs)} backup files were already restored.")
 
     # Connect to the destination Cosmos DB
     COSMOS_ENDPOINT = os.getenv("COSMOS_ENDPOINT")
@@ -53,44 +148,143 @@ def restore_cosmos_db(restore_date, source_account, destination_account):
 
     cosmos_client = CosmosClient(COSMOS_ENDPOINT, COSMOS_KEY)
 
-    # Restore each backup file
-    for blob_name in restore_blobs:
-        print(f"Restoring blob: {blob_name}")
-        blob_client = container_client.get_blob_client(blob_name)
-        blob_data = blob_client.download_blob().readall()
-        backup_data = json.loads(blob_data)
+    # Create every destination database and container once, before the pipeline starts
+    # (blob names follow the pattern {account}/{timestamp}/{database}/{container}/{file})
+    targets = {}
+    for stage in restore_stages:
+        for blob_name in stage:
+            database_name, container_name = blob_name.split("/")[2:4]
+            if (database_name, container_name) not in targets:
+                settings = container_settings.get((database_name, container_name), {})
+                target = create_restore_target(cosmos_client, database_name, container_name, settings)
+                targets[(database_name, container_name)] = target
+                if target is None:
+                    continue
+                # Remember the containers loaded without indexing, so a resumed restore still applies their policy
+                state_key = f"{database_name}/{container_name}"
+                with checkpoint.lock:
+                    deferred_indexing = checkpoint.state.setdefault("deferred_indexing", [])
+                    if target["deferred_indexing"] and state_key not in deferred_indexing:
+                        deferred_indexing.append(state_key)
+                    target["deferred_indexing"] = state_key in deferred_indexing
+    if checkpoint.state.get("deferred_indexing"):
+        checkpoint.save(force=True)
 
-        # Extract information from the blob based on the directory pattern
-        path_parts = blob_name.split("/")
-        database_name = path_parts[-3]  # Database name
-        container_name = path_parts[-2]  # Container name
+    def count_bytes(chunks, database_name, container_name):
+        for chunk in chunks:
+            registry.inc("cosmosdb_bytes_total", len(chunk), operation="restore", database=database_name, container=container_name)
+            yield chunk
 
-        # Create database in the destination Cosmos DB
-        try:
-            database = cosmos_client.create_database_if_not_exists(id=database_name)
-            print(f"Database {database_name} created or already exists.")
-        except Exception as e:
-            print(f"Error creating database {database_name}: {e}")
-            continue
+    # A targeted restore reads only the members of a file its partition key index selects, returning
+    # None for files written without an index
+    def open_selected_ranges(blob_name):
+        partition_index = read_partition_index(container_client, blob_name)
+        if partition_index is None:
+            print(f"Backup file {blob_name} has no partition key index, reading it whole.")
+            return None
+        ranges, selected = RESTORE_SELECTION.ranges(partition_index)
+        size = sum(length for _, length in ranges)
+        print(f"Restoring blob: {blob_name} ({selected} of {len(partition_index['blocks'])} blocks, {size / 1024 / 1024:.1f} MB)")
+        if not ranges:
+            return 0, iter(())
+        chunks = open_backup_file_ranges(container_client, blob_name, ranges, RESTORE_RANGE_SIZE_MB * 1024 * 1024, RESTORE_RANGE_CONCURRENCY)
+        if chunks is None:
+            raise ValueError(f"Backup file {blob_name} not found.")
+        return size, chunks
 
-        # Create container in the destination Cosmos DB
-        try:
-            container = database.create_container_if_not_exists(
-                id=container_name,
-                partition_key={"paths": ["/partitionKey"], "kind": "Hash"}
+    # Small files are downloaded whole, large ones are streamed (deduplicated backup files are read
+    # from their chunks); both are parsed as they are written
+    def download(blob_name):
+        backup_file = None
+        if RESTORE_SELECTION.active and ".ndjson" in blob_name:
+            backup_file = open_selected_ranges(blob_name)
+        if backup_file is None:
+            print(f"Restoring blob: {blob_name}")
+            backup_file = open_backup_file(container_client, blob_name, RESTORE_RANGE_SIZE_MB * 1024 * 1024, RESTORE_RANGE_CONCURRENCY)
+        if backup_file is None:
+            raise ValueError(f"Backup file {blob_name} not found.")
+        size, chunks = backup_file
+        chunks = count_bytes(chunks, *blob_name.split("/")[2:4])
+        # Parquet files are read whole by pyarrow, streaming them would not save memory
+        if size > RESTORE_STREAM_THRESHOLD_MB * 1024 * 1024 and not blob_name.endswith(".parquet"):
+            return chunks
+        return b"".join(chunks)
+
+    # Insert the documents of a parsed blob with concurrent transactional batches
+    def write(blob_name, documents):
+        database_name, container_name = blob_name.split("/")[2:4]
+        target = targets[(database_name, container_name)]
+        if target is None:
+            return
+        # Select and transform the documents one at a time as they are written
+        documents = prepare_documents(documents, target, RESTORE_SELECTION)
+        with span("file", database=database_name, container=container_name, file=blob_name.rsplit("/", 1)[-1]):
+            blob_stats = bulk_upsert(
+                target["container"],
+                documents,
+                partition_key_paths=target["partition_key_paths"],
+                workers=RESTORE_WORKERS,
+                batch_size=RESTORE_BATCH_SIZE,
+                stats=RestoreStats(labels={"database": database_name, "container": container_name}),
+                rate_controller=target["rate_controller"]
             )
-            print(f"Container {container_name} created or already exists.")
-        except Exception as e:
-            print(f"Error creating container {container_name}: {e}")
-            continue
+        registry.inc("cosmosdb_files_total", 1, operation="restore", database=database_name, container=container_name)
+        target["stats"].add_documents(blob_stats.documents)
+        target["stats"].add_failed(blob_stats.failed)
+        target["stats"].add_request_charge(blob_stats.request_charge)
+        # Only a blob restored without failures is skipped by a resumed run
+        if not blob_stats.failed:
+            checkpoint.mark_completed(blob_name)
+
+    # Download, parse and write blobs concurrently; each layer completes before the next one starts
+    reporter = ProgressReporter(
+        "restore",
+        progress_metric="cosmosdb_files_total",
+        expected=sum(1 for stage in restore_stages for blob_name in stage if blob_name not in completed_blobs),
+        unit="files"
+    ).start()
+    for stage in restore_stages:
+        stage = [
+            blob_name for blob_name in stage
+            if blob_name not in completed_blobs and targets[tuple(blob_name.split("/")[2:4])] is not None
+        ]
+        run_restore_pipeline(
+            stage,
+            download,
+            write,
+            download_workers=RESTORE_DOWNLOAD_WORKERS,
+            write_workers=RESTORE_WRITE_WORKERS,
+            queue_size=RESTORE_QUEUE_SIZE
+        )
+    reporter.stop()
+
+    for (database_name, container_name), target in targets.items():
+        if target is not None:
+            print(f"Container {database_name}/{container_name}: {target['stats'].summary()}")
+            print(target["rate_controller"].summary())
+            if target["destination_index"] is not None:
+                target["destination_index"].close()
+
+    # Index the loaded containers with the policy of their source container, the index is built in the background
+    for (database_name, container_name), target in targets.items():
+        if target is not None and target["deferred_indexing"]:
+            try:
+                apply_container_settings(target["database"], target["container"], target["settings"])
+                print(f"Indexing policy applied to container {database_name}/{container_name}, the index is being built in the background.")
+            except Exception as e:
+                print(f"Error applying the indexing policy to container {database_name}/{container_name}: {e}")
 
-        # Insert documents into the container
+    # Keep the checkpoint while some blobs still have to be restored, so the next run resumes them
+    restored_blobs = checkpoint.completed()
+    remaining_blobs = sum(1 for stage in restore_stages for blob_name in stage if blob_name not in restored_blobs)
+    if remaining_blobs:
+        checkpoint.save(force=True)
+        print(f"{remaining_blobs} backup files were not fully restored, run the restore again to resume them.")
+    else:
         try:
-            for doc in backup_data:
-                container.upsert_item(doc)
-            print(f"Restoration of container {container_name} completed successfully.")
-        except Exception as e:
-            print(f"Error restoring documents in container {container_name}: {e}")
+            checkpoint_client.delete_blob()
+        except ResourceNotFoundError:
+            pass
 
     print("Restoration completed.")
 
@@ -100,6 +294,7 @@ if __name__ == "__main__":
     parser.add_argument("--date", required=True, help="Backup date in the format %Y-%m-%d-%H%M.")
     parser.add_argument("--source", required=True, help="Name of the source Cosmos DB account.")
     parser.add_argument("--destination", required=True, help="Name of the destination Cosmos DB account.")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an interrupted restore and restore every file again.")
     args = parser.parse_args()
 
     # Validate date format
@@ -110,4 +305,4 @@ if __name__ == "__main__":
         exit(1)
 
     # Execute the restore process
-    restore_cosmos_db(args.date, args.source, args.destination)
\ No newline at end of file
+    restore_cosmos_db(args.date, args.source, args.destination, args.restart)
\ No newline at end of file
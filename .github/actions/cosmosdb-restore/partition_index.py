@@ -0,0 +1,166 @@
+import base64
+import hashlib
+import json
+from bulk_restore import _MISSING, partition_key_value
+
+# Sidecar index of an NDJSON segment ({segment}.keys.json), used to restore selected partition keys or
+# document ids without reading whole files. The segment is written as independent compressed members of
+# about DEFAULT_PARTITION_INDEX_BLOCK_SIZE uncompressed bytes, and the sidecar records the byte range of
+# each member with a Bloom filter of the partition key values and ids of its documents. Any run of whole
+# members is a valid file, so a restore fetches the matching members with ranged reads; false positives
+# only cost an extra member, the documents read are filtered again after parsing.
+
+PARTITION_INDEX_SUFFIX = ".keys.json"
+PARTITION_INDEX_VERSION = 1
+
+# Average uncompressed bytes per indexed member, and per window of documents sorted by partition key before
+# they are written (a partition key of a window shares one or two members of it, whatever the export order)
+DEFAULT_PARTITION_INDEX_BLOCK_SIZE = 256 * 1024
+DEFAULT_PARTITION_INDEX_WINDOW_SIZE = 8 * 1024 * 1024
+
+# About 1% false positives per member
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASH_COUNT = 7
+
+
+def selection_key(kind, value):
+    return json.dumps([kind, value], separators=(",", ":"), sort_keys=True, ensure_ascii=False)
+
+
+# Keys of a document in the filters: its partition key value (when it has one) and its id
+def document_keys(doc, partition_key_paths):
+    keys = [selection_key("id", doc.get("id"))]
+    value = partition_key_value(doc, partition_key_paths)
+    if value is not _MISSING:
+        keys.append(selection_key("pk", value))
+    return keys
+
+
+class BloomFilter:
+    def __init__(self, size_bits, hash_count=BLOOM_HASH_COUNT, bits=None):
+        self.size_bits = size_bits
+        self.hash_count = hash_count
+        self.bits = bits if bits is not None else bytearray((size_bits + 7) // 8)
+
+    @classmethod
+    def for_keys(cls, keys):
+        bloom = cls(max(len(keys) * BLOOM_BITS_PER_KEY, 64))
+        for key in keys:
+            bloom.add(key)
+        return bloom
+
+    # Double hashing of a 128-bit digest into hash_count bit positions
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        first, second = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((first + i * second) % self.size_bits for i in range(self.hash_count))
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    def to_dict(self):
+        return {"bits": self.size_bits, "hashes": self.hash_count, "filter": base64.b64encode(bytes(self.bits)).decode("ascii")}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["bits"], data["hashes"], base64.b64decode(data["filter"]))
+
+
+# Collects the keys of the member being written by NdjsonSegmentWriter and the byte range of every member
+class PartitionIndexWriter:
+    def __init__(self, partition_key_paths):
+        self.partition_key_paths = partition_key_paths
+        self.blocks = []
+        self._keys = set()
+        self._document_count = 0
+        self._offset = 0
+
+    # Record a document by its keys (document_keys)
+    def add(self, keys):
+        self._keys.update(keys)
+        self._document_count += 1
+
+    # End the current member at offset, the size of the segment once the member is flushed
+    def end_block(self, offset):
+        if self._document_count:
+            self.blocks.append({
+                "offset": self._offset,
+                "bytes": offset - self._offset,
+                "document_count": self._document_count,
+                **BloomFilter.for_keys(self._keys).to_dict(),
+            })
+        self._keys = set()
+        self._document_count = 0
+        self._offset = offset
+
+    def to_json(self):
+        return json.dumps({
+            "version": PARTITION_INDEX_VERSION,
+            "partition_key_paths": self.partition_key_paths,
+            "blocks": self.blocks,
+        }, separators=(",", ":")).encode("utf-8")
+
+
+# Partition key values and/or document ids to restore; a document is selected when it matches both
+# lists that are given (a hierarchical partition key value is a list of its values)
+class RestoreSelection:
+    def __init__(self, partition_keys=None, document_ids=None):
+        self.partition_keys = partition_keys
+        self.document_ids = document_ids
+        self._partition_key_set = {selection_key("pk", value) for value in partition_keys or []}
+        self._document_id_set = {selection_key("id", value) for value in document_ids or []}
+
+    @property
+    def active(self):
+        return self.partition_keys is not None or self.document_ids is not None
+
+    # Short digest of the selection, keeping the checkpoints of different selections apart
+    def digest(self):
+        text = json.dumps([self.partition_keys, self.document_ids], sort_keys=True)
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=6).hexdigest()
+
+    def matches_block(self, block):
+        bloom = BloomFilter.from_dict(block)
+        if self.partition_keys is not None and not any(key in bloom for key in self._partition_key_set):
+            return False
+        return self.document_ids is None or any(key in bloom for key in self._document_id_set)
+
+    def matches(self, doc, partition_key_paths):
+        keys = document_keys(doc, partition_key_paths)
+        if self.partition_keys is not None and not any(key in self._partition_key_set for key in keys[1:]):
+            return False
+        return self.document_ids is None or keys[0] in self._document_id_set
+
+    def filter(self, documents, partition_key_paths):
+        return (doc for doc in documents if self.matches(doc, partition_key_paths))
+
+    # Byte ranges (offset, length) of the members that may hold selected documents, adjacent members merged,
+    # with the number of members selected
+    def ranges(self, partition_index):
+        ranges = []
+        selected = 0
+        for block in partition_index["blocks"]:
+            if not self.matches_block(block):
+                continue
+            selected += 1
+            if ranges and ranges[-1][0] + ranges[-1][1] == block["offset"]:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + block["bytes"])
+            else:
+                ranges.append((block["offset"], block["bytes"]))
+        return ranges, selected
+
+
+# Load the selection of a targeted restore from JSON lists of partition key values and document ids
+def load_restore_selection(partition_keys, document_ids):
+    selection = RestoreSelection(
+        json.loads(partition_keys) if partition_keys else None,
+        json.loads(document_ids) if document_ids else None
+    )
+    for name, values in (("partition key values", selection.partition_keys), ("document ids", selection.document_ids)):
+        if values is not None and not isinstance(values, list):
+            raise ValueError(f"The {name} to restore must be a JSON list.")
+    return selection
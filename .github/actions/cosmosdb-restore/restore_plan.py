@@ -0,0 +1,96 @@
+from itertools import zip_longest
+from backup_index import read_backup_index
+from chunk_store import CHUNK_LIST_SUFFIX
+from partition_index import PARTITION_INDEX_SUFFIX
+from restore_transform import transform_for
+
+# Parts of the restore shared by full_restore.py and async_restore.py: the plan of the backup files to
+# restore, the destination settings of each container, and the per-document stage between parsing and writing.
+
+# Restore modes: "full" upserts every document, "differential" only writes the documents missing or different in the destination
+RESTORE_MODES = ("full", "differential")
+# Storage of the destination index of a differential restore
+RESTORE_INDEX_STORAGES = ("memory", "disk")
+
+# Name of the per-container manifest written next to sharded backups
+MANIFEST_FILENAME = "manifest.json"
+
+
+# List the files of a backup written without an index, using a listing scoped to that backup
+def list_unindexed_backup(container_client, source_account, restore_date):
+    files_by_container = {}
+    for blob in container_client.list_blobs(name_starts_with=f"{source_account}/{restore_date}/"):
+        path_parts = blob.name.split("/")
+        if len(path_parts) != 5 or path_parts[4] == MANIFEST_FILENAME or path_parts[4].endswith(PARTITION_INDEX_SUFFIX):
+            continue
+        # A deduplicated file is listed through its chunk list
+        files_by_container.setdefault((path_parts[2], path_parts[3]), []).append(blob.name.removesuffix(CHUNK_LIST_SUFFIX))
+    # Backups written before the index existed are always full exports
+    return [[sorted(files)] for _, files in sorted(files_by_container.items())]
+
+
+# List the blobs to restore: for every container of the backup at restore_date,
+# its latest full backup followed by every delta layer up to restore_date. The blobs are returned
+# as ordered stages (the k-th layer of every container), so deltas are only applied after their base,
+# together with the settings recorded for each (database, container).
+def plan_restore_blobs(container_client, source_account, restore_date):
+    index = read_backup_index(container_client, source_account, restore_date)
+    container_settings = {}
+    if index is None:
+        print(f"No backup index found for {restore_date}, listing the backup files.")
+        container_layers = list_unindexed_backup(container_client, source_account, restore_date)
+    else:
+        # Follow each delta back to its full backup through the index of the previous runs
+        indexes = {restore_date: index}
+        container_layers = []
+        for entry in index["containers"]:
+            container_settings[(entry["database"], entry["container"])] = entry.get("settings") or {}
+            chain = [entry]
+            while chain[-1]["backup_type"] == "delta":
+                previous_backup = chain[-1].get("previous_backup")
+                if previous_backup not in indexes:
+                    indexes[previous_backup] = read_backup_index(container_client, source_account, previous_backup) if previous_backup else None
+                previous_index = indexes[previous_backup] or {"containers": []}
+                previous_entry = next(
+                    (candidate for candidate in previous_index["containers"] if (candidate["database"], candidate["container"]) == (entry["database"], entry["container"])),
+                    None
+                )
+                if previous_entry is None:
+                    print(f"No full backup found for container {entry['database']}/{entry['container']}, skipping it.")
+                    chain = None
+                    break
+                chain.append(previous_entry)
+            if chain:
+                container_layers.append([[file["path"] for file in layer["files"]] for layer in reversed(chain)])
+
+    restore_stages = [
+        [blob_name for layer in layers if layer for blob_name in layer]
+        for layers in zip_longest(*container_layers)
+    ]
+    return restore_stages, container_settings
+
+
+# Start the description of a restored container: its transform, the settings it is created with (the
+# partition key may be rewritten by the transform) and the partition key paths of the backed up documents.
+# Each engine adds the container, its partition key paths, the destination index, rate controller and stats.
+def restore_target(transforms, database_name, container_name, settings):
+    transform = transform_for(transforms, database_name, container_name)
+    return {
+        "transform": transform,
+        "settings": transform.container_settings(settings),
+        # The selection of a targeted restore applies to the partition key of the backed up documents
+        "source_partition_key_paths": (settings.get("partition_key") or {}).get("paths"),
+        "destination_index": None,
+    }
+
+
+# Per-document stage between parsing and writing: keep the documents selected by a targeted restore,
+# then transform them one at a time; a differential restore leaves out the transformed documents the
+# destination already holds
+def prepare_documents(documents, target, selection=None):
+    if selection is not None and selection.active:
+        documents = selection.filter(documents, target["source_partition_key_paths"] or target["partition_key_paths"])
+    documents = target["transform"].apply(documents)
+    if target["destination_index"] is not None:
+        documents = target["destination_index"].changed_documents(documents, target["partition_key_paths"], target["stats"].add_skipped)
+    return documents
@@ -0,0 +1,121 @@
+import importlib
+import json
+import os
+
+# Per-document transform applied by the restore between parsing and writing, one document at a time:
+# it renames properties, rewrites the partition key, calls an optional custom function, and strips the
+# system properties and the container_name property added by the backup, which Cosmos DB would
+# otherwise store and bill as part of every document, along with the digest left by a differential restore.
+
+# Properties added by Cosmos DB to every document, recreated by the destination on write
+SYSTEM_PROPERTIES = ("_rid", "_self", "_etag", "_attachments", "_ts")
+
+# Property added to every document by full_backup.py
+CONTAINER_NAME_PROPERTY = "container_name"
+
+# Property holding the content digest of the documents written by a differential restore (destination_index.py)
+RESTORE_DIGEST_PROPERTY = "restore_digest"
+
+# Marker for properties a document does not have
+_MISSING = object()
+
+
+def _parts(path):
+    return path.strip("/").split("/")
+
+
+def get_path(doc, path, default=None):
+    value = doc
+    for part in _parts(path):
+        if not isinstance(value, dict) or part not in value:
+            return default
+        value = value[part]
+    return value
+
+
+def pop_path(doc, path, default=None):
+    *parents, name = _parts(path)
+    for part in parents:
+        doc = doc.get(part)
+        if not isinstance(doc, dict):
+            return default
+    return doc.pop(name, default)
+
+
+def set_path(doc, path, value):
+    *parents, name = _parts(path)
+    for part in parents:
+        doc = doc.setdefault(part, {})
+    doc[name] = value
+
+
+# rename maps source property paths to destination paths ("/customer/id": "/customerId"). partition_key
+# rewrites the destination partition key: {"path": "/tenantId"} with a "source" property path to copy
+# or a constant "value". function is a "module:function" called with each document, returning the
+# document to write or None to leave it out.
+class RestoreTransform:
+    def __init__(self, strip_system_properties=True, strip_container_name=True, rename=None, partition_key=None, function=None, **unknown):
+        if unknown:
+            raise ValueError(f"Unknown restore transform options: {', '.join(unknown)}")
+        if partition_key is not None and ("path" not in partition_key or ("source" in partition_key) == ("value" in partition_key)):
+            raise ValueError("A partition_key rewrite needs a path and either a source or a value.")
+        self.strip_system_properties = strip_system_properties
+        self.strip_container_name = strip_container_name
+        self.rename = rename or {}
+        self.partition_key = partition_key
+        self.function = None
+        if function:
+            module_name, function_name = function.split(":")
+            self.function = getattr(importlib.import_module(module_name), function_name)
+
+    # Rename, rewrite the partition key and apply the custom function (None leaves the document out)
+    def reshape(self, doc):
+        for source, destination in self.rename.items():
+            value = pop_path(doc, source, _MISSING)
+            if value is not _MISSING:
+                set_path(doc, destination, value)
+        if self.partition_key is not None:
+            value = self.partition_key["value"] if "value" in self.partition_key else get_path(doc, self.partition_key["source"], _MISSING)
+            if value is not _MISSING:
+                set_path(doc, self.partition_key["path"], value)
+        if self.function is not None:
+            doc = self.function(doc)
+        return doc
+
+    def strip(self, doc):
+        # A digest backed up from a restored container may not match the document anymore
+        doc.pop(RESTORE_DIGEST_PROPERTY, None)
+        if self.strip_system_properties:
+            for name in SYSTEM_PROPERTIES:
+                doc.pop(name, None)
+        if self.strip_container_name:
+            doc.pop(CONTAINER_NAME_PROPERTY, None)
+        return doc
+
+    # Reshape then strip a stream of documents
+    def apply(self, documents):
+        return map(self.strip, (doc for doc in map(self.reshape, documents) if doc is not None))
+
+    # Settings of the destination container, created with the rewritten partition key
+    def container_settings(self, settings):
+        if self.partition_key is None:
+            return settings
+        return {**settings, "partition_key": {**(settings.get("partition_key") or {}), "paths": [self.partition_key["path"]], "kind": "Hash"}}
+
+
+# Load the restore transforms keyed by "database/container", "database/*" or "*", from JSON text or a JSON file
+def load_restore_transforms(value):
+    if not value:
+        return {}
+    if os.path.isfile(value):
+        with open(value, "r", encoding="utf-8") as transform_file:
+            value = transform_file.read()
+    return {key: RestoreTransform(**transform) for key, transform in json.loads(value).items()}
+
+
+# Return the transform of a container, the most specific key winning
+def transform_for(transforms, database_name, container_name):
+    for key in (f"{database_name}/{container_name}", f"{database_name}/*", "*"):
+        if key in transforms:
+            return transforms[key]
+    return RestoreTransform()
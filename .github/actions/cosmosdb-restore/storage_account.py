@@ -0,0 +1,69 @@
+import os
+
+# Storage Account of the backups, resolved once per run: its existence (the backup creates it when it
+# is missing) and its key. The management SDK and the credential are only imported when a lookup is
+# needed. A resolved key is exported as STORAGE_ACCOUNT_KEY, so the later lookups of the process (and of the
+# processes it starts) skip the management API, and a key given in STORAGE_ACCOUNT_KEY skips it altogether.
+
+# Location and SKU of a Storage Account created by the backup
+STORAGE_ACCOUNT_LOCATION = "eastus"  # Choose the appropriate region
+STORAGE_ACCOUNT_SKU = "Standard_LRS"
+
+_storage_clients = {}
+_existing_accounts = set()
+
+
+def _known_key(account_name):
+    if os.getenv("STORAGE_ACCOUNT_KEY") and os.getenv("STORAGE_ACCOUNT_NAME") == account_name:
+        return os.getenv("STORAGE_ACCOUNT_KEY")
+    return None
+
+
+def _storage_client(subscription_id):
+    if subscription_id not in _storage_clients:
+        from azure.identity import DefaultAzureCredential
+        from azure.mgmt.storage import StorageManagementClient
+        _storage_clients[subscription_id] = StorageManagementClient(DefaultAzureCredential(), subscription_id)
+    return _storage_clients[subscription_id]
+
+
+# Create the Storage Account when it does not exist, with a single GET instead of listing the resource group
+def ensure_storage_account(subscription_id, resource_group, account_name):
+    if account_name in _existing_accounts or _known_key(account_name):
+        return
+    from azure.core.exceptions import ResourceNotFoundError
+    storage_client = _storage_client(subscription_id)
+    try:
+        storage_client.storage_accounts.get_properties(resource_group, account_name)
+        print(f"Storage Account {account_name} already exists.")
+    except ResourceNotFoundError:
+        print(f"Creating Storage Account: {account_name}")
+        storage_client.storage_accounts.begin_create(
+            resource_group,
+            account_name,
+            {
+                "location": STORAGE_ACCOUNT_LOCATION,
+                "sku": {"name": STORAGE_ACCOUNT_SKU},
+                "kind": "StorageV2"
+            }
+        ).result()
+        print(f"Storage Account {account_name} created successfully.")
+    _existing_accounts.add(account_name)
+
+
+def storage_account_key(subscription_id, resource_group, account_name):
+    account_key = _known_key(account_name)
+    if account_key is None:
+        account_key = _storage_client(subscription_id).storage_accounts.list_keys(resource_group, account_name).keys[0].value
+        if os.getenv("STORAGE_ACCOUNT_NAME", account_name) == account_name:
+            os.environ["STORAGE_ACCOUNT_NAME"] = account_name
+            os.environ["STORAGE_ACCOUNT_KEY"] = account_key
+    _existing_accounts.add(account_name)
+    return account_key
+
+
+def container_client_for(subscription_id, resource_group, account_name, container_name):
+    from azure.storage.blob import BlobServiceClient
+    account_key = storage_account_key(subscription_id, resource_group, account_name)
+    blob_service_client = BlobServiceClient(account_url=f"https://{account_name}.blob.core.windows.net/", credential=account_key)
+    return blob_service_client.get_container_client(container_name)
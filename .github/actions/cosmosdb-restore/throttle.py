@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+# Back-off used when a throttled response does not carry a retry-after header
+DEFAULT_RETRY_AFTER_SECONDS = 1.0
+
+# Longest sleep of a coroutine waiting for a slot, since releases cannot wake it up
+ASYNC_POLL_SECONDS = 0.05
+
+# Controllers shared by every container that draws from the same provisioned throughput
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+class RateController:
+    def __init__(self, target_ru_per_second, max_concurrency, min_concurrency=1):
+        self.target_ru_per_second = target_ru_per_second
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.concurrency_limit = float(max_concurrency)
+        self.in_flight = 0
+        self.request_charge = 0.0
+        self.throttled_requests = 0
+        self.started = time.monotonic()
+        self._tokens = target_ru_per_second or 0.0
+        self._refilled = self.started
+        self._retry_until = 0.0
+        self._condition = threading.Condition()
+
+    # Add the RU credits accumulated since the last refill, capped at one second of budget
+    def _refill(self, now):
+        if self.target_ru_per_second:
+            self._tokens = min(self.target_ru_per_second, self._tokens + (now - self._refilled) * self.target_ru_per_second)
+        self._refilled = now
+
+    # Seconds to wait before another request may start, or 0 when one can start now
+    def _wait_time(self, now):
+        if now < self._retry_until:
+            return self._retry_until - now
+        if self.target_ru_per_second and self._tokens <= 0:
+            return -self._tokens / self.target_ru_per_second + 0.01
+        if self.in_flight >= int(self.concurrency_limit):
+            return 1.0
+        return 0
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait_time = self._wait_time(now)
+                if not wait_time:
+                    break
+                self._condition.wait(wait_time)
+            self.in_flight += 1
+
+    # Take a slot when one is available, otherwise return the seconds to wait before trying again
+    def try_acquire(self):
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            wait_time = self._wait_time(now)
+            if not wait_time:
+                self.in_flight += 1
+            return wait_time
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    # Hold a concurrency slot for the duration of one request
+    @contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    # Hold a slot from a coroutine, sleeping instead of blocking the event loop
+    @asynccontextmanager
+    async def async_slot(self):
+        while True:
+            wait_time = self.try_acquire()
+            if not wait_time:
+                break
+            await asyncio.sleep(min(wait_time, ASYNC_POLL_SECONDS))
+        try:
+            yield
+        finally:
+            self.release()
+
+    # Record the RU charge of a response and adapt the concurrency limit (AIMD)
+    def record(self, charge, throttled=False, retry_after=None):
+        with self._condition:
+            self.request_charge += charge
+            self._tokens -= charge
+            if throttled:
+                self.throttled_requests += 1
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+                retry_after = retry_after if retry_after is not None else DEFAULT_RETRY_AFTER_SECONDS
+                self._retry_until = max(self._retry_until, time.monotonic() + retry_after)
+            else:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1 / self.concurrency_limit)
+            self._condition.notify_all()
+
+    # raw_response_hook for the Cosmos SDK: sees every HTTP response, including retried 429s
+    def hook(self, response):
+        http_response = response.http_response
+        headers = http_response.headers
+        charge = float(headers.get("x-ms-request-charge") or 0)
+        throttled = http_response.status_code == 429
+        retry_after = headers.get("x-ms-retry-after-ms")
+        self.record(charge, throttled, float(retry_after) / 1000 if retry_after else None)
+
+    @property
+    def achieved_ru_per_second(self):
+        return self.request_charge / max(time.monotonic() - self.started, 1e-6)
+
+    def summary(self):
+        target = f"{self.target_ru_per_second:.0f}" if self.target_ru_per_second else "unlimited"
+        return (
+            f"{self.achieved_ru_per_second:.0f} RU/s achieved (target {target}), "
+            f"{self.throttled_requests} throttled requests, concurrency limit {int(self.concurrency_limit)}"
+        )
+
+
+# Fetch query pages through the rate controller, one slot per page request
+def throttled_pages(pages, controller):
+    pages = iter(pages)
+    while True:
+        with controller.slot():
+            page = next(pages, None)
+            if page is not None:
+                # Materialize the page so its items are read while the slot is held
+                page = list(page)
+        if page is None:
+            return
+        yield page
+
+
+# Read the provisioned RU/s of a container, falling back to its database shared throughput
+def read_provisioned_throughput(database, container):
+    for owner, proxy in ((("container", database.id, container.id), container), (("database", database.id), database)):
+        try:
+            throughput = proxy.get_throughput()
+        except Exception:
+            continue
+        return owner, throughput.auto_scale_max_throughput or throughput.offer_throughput
+    # Serverless accounts have no provisioned throughput
+    return ("container", database.id, container.id), None
+
+
+# Return the rate controller for the throughput that serves the container
+def rate_controller_for(database, container, fraction, max_concurrency):
+    owner, throughput = read_provisioned_throughput(database, container)
+    return controller_for_throughput(owner, throughput, fraction, max_concurrency)
+
+
+# Return the rate controller shared by every container served by the same throughput owner
+def controller_for_throughput(owner, throughput, fraction, max_concurrency):
+    with _controllers_lock:
+        if owner not in _controllers:
+            target = throughput * fraction if throughput and fraction else None
+            _controllers[owner] = RateController(target, max_concurrency)
+        return _controllers[owner]
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The actions are plain script directories: the shared modules are identical in both, the restore-only
+# modules (destination_index, restore_plan, ...) come from cosmosdb-restore
+ACTIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".github", "actions")
+for action in ("cosmosdb-restore", "cosmosdb-backup"):
+    sys.path.insert(0, os.path.join(ACTIONS_DIRECTORY, action))
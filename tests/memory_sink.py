@@ -0,0 +1,41 @@
+import io
+
+
+# In-memory sink with the interface of blob_writer.LocalSink (open, read, list_paths, location)
+class MemorySink:
+    def __init__(self):
+        self.files = {}
+        self.touched = []
+
+    def open(self, relative_path):
+        return _MemoryFile(self, relative_path)
+
+    def read(self, relative_path):
+        return self.files.get(relative_path)
+
+    def touch(self, relative_path):
+        self.touched.append(relative_path)
+        return relative_path in self.files
+
+    def list_paths(self, prefix):
+        return [path for path in self.files if path.startswith(prefix)]
+
+    def location(self, relative_path):
+        return f"memory://{relative_path}"
+
+
+class _MemoryFile(io.BytesIO):
+    def __init__(self, sink, path):
+        super().__init__()
+        self.sink = sink
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            self.sink.files[self.path] = self.getvalue()
+        super().close()
+
+
+# Split data into pieces of size bytes, as a download would yield them
+def pieces(data, size):
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
@@ -0,0 +1,231 @@
+import gzip
+import json
+import random
+
+import pytest
+
+from backup_format import (
+    NdjsonSegmentWriter,
+    dump_ndjson_line,
+    is_member_boundary,
+    iter_backup_documents,
+    iter_decompressed,
+    iter_json_array,
+    iter_ndjson,
+    write_ndjson_pages,
+)
+from chunk_store import DedupSink, read_backup_file
+from partition_index import RestoreSelection
+from tests.memory_sink import MemorySink, pieces
+
+
+def make_documents(count, seed=1, tenants=50):
+    rng = random.Random(seed)
+    return [
+        {"id": f"d{index}", "tenant": f"t{rng.randrange(tenants)}", "name": "é✓" * rng.randrange(5), "pad": rng.randbytes(rng.randrange(20, 200)).hex()}
+        for index in range(count)
+    ]
+
+
+def sorted_ids(docs):
+    return sorted(doc["id"] for doc in docs)
+
+
+# iter_json_array: legacy JSON array backups
+
+@pytest.mark.parametrize("piece_size", [1, 7, 4096])
+def test_json_array_round_trip(piece_size):
+    docs = make_documents(200)
+    data = json.dumps(docs, indent=4, ensure_ascii=False).encode("utf-8")
+    assert list(iter_json_array(pieces(data, piece_size))) == docs
+
+
+def test_json_array_large_element_in_small_pieces():
+    docs = [{"id": "small"}, {"id": "large", "value": "x" * 1_000_000}, {"id": "after"}]
+    data = json.dumps(docs).encode("utf-8")
+    assert list(iter_json_array(pieces(data, 7))) == docs
+
+
+@pytest.mark.parametrize("text", ["[]", "  [ ]  ", "\n[\n]\n"])
+def test_json_array_empty(text):
+    assert list(iter_json_array([text.encode("utf-8")])) == []
+
+
+def test_json_array_rejects_other_documents():
+    with pytest.raises(ValueError, match="not a JSON array"):
+        list(iter_json_array([b'{"id": "1"}']))
+
+
+@pytest.mark.parametrize("cut", [1, 20, -1, -2])
+def test_json_array_truncated(cut):
+    data = json.dumps(make_documents(20)).encode("utf-8")
+    with pytest.raises(ValueError):
+        list(iter_json_array(pieces(data[:cut], 5)))
+
+
+# iter_decompressed and iter_ndjson
+
+def multi_member_gzip(docs, members):
+    lines = [dump_ndjson_line(doc).encode("utf-8") for doc in docs]
+    size = -(-len(lines) // members)
+    return b"".join(gzip.compress(b"".join(lines[start:start + size])) for start in range(0, len(lines), size))
+
+
+@pytest.mark.parametrize("piece_size", [1, 3, 1000, 1 << 20])
+def test_decompress_multi_member_gzip(piece_size):
+    docs = make_documents(300)
+    data = multi_member_gzip(docs, members=5)
+    raw = b"".join(dump_ndjson_line(doc).encode("utf-8") for doc in docs)
+    assert b"".join(iter_decompressed(pieces(data, piece_size), ".gz")) == raw
+    assert list(iter_backup_documents("file.ndjson.gz", pieces(data, piece_size))) == docs
+
+
+@pytest.mark.parametrize("cut", [-1, -8, -30, 100])
+def test_decompress_truncated_gzip(cut):
+    data = multi_member_gzip(make_documents(300), members=3)
+    with pytest.raises(ValueError, match="truncated"):
+        list(iter_backup_documents("file.ndjson.gz", pieces(data[:cut], 64)))
+
+
+def test_decompress_multi_frame_zstd():
+    zstandard = pytest.importorskip("zstandard")
+    docs = make_documents(300)
+    lines = [dump_ndjson_line(doc).encode("utf-8") for doc in docs]
+    data = b"".join(zstandard.ZstdCompressor().compress(b"".join(lines[start:start + 100])) for start in range(0, 300, 100))
+    assert list(iter_backup_documents("file.ndjson.zst", pieces(data, 17))) == docs
+    with pytest.raises(ValueError):
+        list(iter_backup_documents("file.ndjson.zst", [data[:-5]]))
+
+
+def test_ndjson_blank_lines_and_missing_final_newline():
+    assert list(iter_ndjson([b'{"a":1}\n\n  \n{"a', b'":2}'])) == [{"a": 1}, {"a": 2}]
+
+
+def test_ndjson_truncated_line():
+    with pytest.raises(ValueError):
+        list(iter_ndjson([b'{"a":1}\n{"a":']))
+
+
+# Content-defined member boundaries
+
+def test_member_boundary_limits():
+    line = b'{"id":"x"}\n'
+    assert not any(is_member_boundary(line, size, 1024) for size in range(0, 256))
+    assert all(is_member_boundary(line, size, 1024) for size in range(2048, 2100))
+
+
+def test_member_boundary_depends_only_on_the_line():
+    lines = [dump_ndjson_line(doc).encode("utf-8") for doc in make_documents(2000)]
+    first = [is_member_boundary(line, 1000, 1024) for line in lines]
+    assert first == [is_member_boundary(line, 1000, 1024) for line in lines]
+    assert 0 < sum(first) < len(lines)
+
+
+# NdjsonSegmentWriter
+
+def write_backup(sink, docs, compression="gzip", segment_size=0, partition_key_paths=None, page_size=100, **options):
+    with NdjsonSegmentWriter(sink, "acct/run/db/c/file", compression, segment_size, partition_key_paths=partition_key_paths, **options) as writer:
+        write_ndjson_pages([docs[start:start + page_size] for start in range(0, len(docs), page_size)], writer)
+    return writer.segments
+
+
+def read_segments(sink, segments):
+    docs = []
+    for segment in segments:
+        data = read_backup_file(sink.read, f"acct/run/db/c/{segment['file']}")
+        segment_docs = list(iter_backup_documents(segment["file"], pieces(data, 1000)))
+        assert len(segment_docs) == segment["document_count"]
+        docs += segment_docs
+    return docs
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip"])
+@pytest.mark.parametrize("segment_size", [0, 20_000])
+def test_ndjson_writer_round_trip(compression, segment_size):
+    docs = make_documents(500)
+    sink = MemorySink()
+    segments = write_backup(sink, docs, compression, segment_size)
+    assert (len(segments) > 1) == bool(segment_size)
+    assert read_segments(sink, segments) == docs
+    for segment in segments:
+        assert segment["bytes"] == len(sink.read(f"acct/run/db/c/{segment['file']}"))
+
+
+def test_ndjson_writer_empty_container():
+    sink = MemorySink()
+    segments = write_backup(sink, [])
+    assert [segment["document_count"] for segment in segments] == [0]
+    assert read_segments(sink, segments) == []
+
+
+def test_ndjson_writer_close_full_segment():
+    docs = make_documents(400)
+    sink = MemorySink()
+    written = 0
+    with NdjsonSegmentWriter(sink, "acct/run/db/c/file", "gzip", 10_000, partition_key_paths=["/tenant"], index_window_size=4096) as writer:
+        for start in range(0, len(docs), 50):
+            write_ndjson_pages([docs[start:start + 50]], writer)
+            written += 50
+            if writer.close_full_segment():
+                # Every document written so far is in a closed segment
+                assert sum(segment["document_count"] for segment in writer.segments) == written
+    assert sorted_ids(read_segments(sink, writer.segments)) == sorted_ids(docs)
+
+
+def test_partition_index_members_are_independent():
+    docs = make_documents(3000)
+    sink = MemorySink()
+    segments = write_backup(sink, docs, partition_key_paths=["/tenant"], index_block_size=8192, index_window_size=65536)
+    restored = []
+    for segment in segments:
+        data = sink.read(f"acct/run/db/c/{segment['file']}")
+        blocks = json.loads(sink.read(f"acct/run/db/c/{segment['partition_index']}"))["blocks"]
+        assert len(blocks) > 1
+        assert sum(block["bytes"] for block in blocks) == len(data)
+        for block in blocks:
+            block_docs = list(iter_backup_documents(segment["file"], [data[block["offset"]:block["offset"] + block["bytes"]]]))
+            assert len(block_docs) == block["document_count"]
+            restored += block_docs
+    assert sorted_ids(restored) == sorted_ids(docs)
+
+
+def test_partition_index_selection_reads_matching_members():
+    docs = make_documents(3000)
+    sink = MemorySink()
+    segments = write_backup(sink, docs, partition_key_paths=["/tenant"], index_block_size=8192, index_window_size=65536)
+    selection = RestoreSelection(["t3", "t7"], None)
+    selected = []
+    read_bytes = total_bytes = 0
+    for segment in segments:
+        data = sink.read(f"acct/run/db/c/{segment['file']}")
+        ranges, _ = selection.ranges(json.loads(sink.read(f"acct/run/db/c/{segment['partition_index']}")))
+        read_bytes += sum(length for _, length in ranges)
+        total_bytes += len(data)
+        chunks = [data[offset:offset + length] for offset, length in ranges]
+        selected += selection.filter(iter_backup_documents(segment["file"], chunks), ["/tenant"])
+    assert sorted_ids(selected) == sorted_ids(doc for doc in docs if doc["tenant"] in ("t3", "t7"))
+    assert read_bytes < total_bytes / 2
+
+
+@pytest.mark.parametrize("partition_key_paths", [None, ["/tenant"]])
+def test_dedup_reuses_unchanged_chunks(partition_key_paths):
+    docs = make_documents(4000, tenants=200)
+    changed = list(docs)
+    changed.insert(2000, {"id": "new", "tenant": "t1", "pad": "0"})
+    store = MemorySink()
+    options = {"index_block_size": 4096, "index_window_size": 32768} if partition_key_paths else {}
+    for run_docs in (docs, changed):
+        sink = DedupSink(store, "acct", chunk_size=16384)
+        sink.load_known_chunks()
+        segments = write_backup(sink, run_docs, partition_key_paths=partition_key_paths, **options)
+        assert sorted_ids(read_segments(sink, segments)) == sorted_ids(run_docs)
+    assert sink.reused_bytes > 2 * sink.uploaded_bytes
+
+
+@pytest.mark.parametrize("partition_key_paths", [None, ["/tenant"]])
+def test_ndjson_writer_write_returns_encoded_bytes(partition_key_paths):
+    doc = {"id": "1", "tenant": "t", "name": "é✓"}
+    line = dump_ndjson_line(doc)
+    with NdjsonSegmentWriter(MemorySink(), "acct/run/db/c/file", "none", partition_key_paths=partition_key_paths) as writer:
+        assert writer.write(line, doc) == len(line.encode("utf-8")) > len(line)
+    assert writer.segments[0]["uncompressed_bytes"] == len(line.encode("utf-8"))
@@ -0,0 +1,37 @@
+import json
+
+from bulk_restore import _MISSING, TRANSACTIONAL_BATCH_BYTES, batch_operations, iter_partition_batches
+
+
+def batches(documents, batch_size=100, max_buffered=10_000, **options):
+    return list(iter_partition_batches(documents, ["/pk"], batch_size, max_buffered, **options))
+
+
+def test_batches_grouped_by_partition_key_and_count():
+    documents = [{"id": str(index), "pk": index % 3} for index in range(250)]
+    groups = batches(documents, batch_size=40)
+    assert all(len(docs) <= 40 and {doc["pk"] for doc in docs} == {value} for value, docs in groups)
+    assert sorted(doc["id"] for _, docs in groups for doc in docs) == sorted(doc["id"] for doc in documents)
+
+
+def test_batches_capped_by_serialized_size():
+    # 100 documents of 100 KB in one partition: ten times the size limit of a batch
+    documents = [{"id": str(index), "pk": "large", "pad": "x" * 100_000} for index in range(100)]
+    groups = batches(documents)
+    assert len(groups) > 5
+    for _, docs in groups:
+        assert sum(len(json.dumps(doc, separators=(",", ":"))) for doc in docs) <= TRANSACTIONAL_BATCH_BYTES
+    assert [doc["id"] for _, docs in groups for doc in docs] == [doc["id"] for doc in documents]
+
+
+def test_document_larger_than_a_batch_is_upserted_alone():
+    documents = [{"id": "1", "pk": "p"}, {"id": "huge", "pk": "p", "pad": "x" * 3_000_000}, {"id": "2", "pk": "p"}]
+    groups = batches(documents)
+    huge = next((value, docs) for value, docs in groups if docs[0]["id"] == "huge")
+    assert len(huge[1]) == 1 and batch_operations(*huge) is None
+
+
+def test_documents_without_partition_key_are_upserted_alone():
+    groups = batches([{"id": "1"}, {"id": "2"}])
+    assert groups == [(_MISSING, [{"id": "1"}]), (_MISSING, [{"id": "2"}])]
+    assert all(batch_operations(value, docs) is None for value, docs in groups)
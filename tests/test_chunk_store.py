@@ -0,0 +1,74 @@
+import types
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from chunk_store import CHUNK_LIST_SUFFIX, DedupSink, chunk_path, collect_garbage, read_backup_file
+from tests.memory_sink import MemorySink
+
+
+def write_file(sink, path, chunks):
+    with sink.open(path) as backup_file:
+        for chunk in chunks:
+            backup_file.write(chunk)
+            backup_file.end_chunk()
+
+
+def test_reused_chunks_are_touched():
+    store = MemorySink()
+    write_file(DedupSink(store, "acct"), "acct/run1/db/c/file.ndjson", [b"a" * 10, b"b" * 10])
+    sink = DedupSink(store, "acct")
+    assert sink.load_known_chunks() == 2
+    write_file(sink, "acct/run2/db/c/file.ndjson", [b"a" * 10, b"c" * 10])
+    assert len(store.touched) == 1 and store.touched[0].startswith("acct/chunks/")
+    assert (sink.uploaded_bytes, sink.reused_bytes) == (10, 10)
+    assert read_backup_file(store.read, "acct/run2/db/c/file.ndjson") == b"a" * 10 + b"c" * 10
+
+
+def test_chunk_collected_after_listing_is_uploaded_again():
+    store = MemorySink()
+    write_file(DedupSink(store, "acct"), "acct/run1/db/c/file.ndjson", [b"a" * 10])
+    sink = DedupSink(store, "acct")
+    sink.load_known_chunks()
+    # The garbage collection deletes the chunk after the backup listed it
+    del store.files[next(path for path in store.files if path.startswith("acct/chunks/"))]
+    del store.files["acct/run1/db/c/file.ndjson" + CHUNK_LIST_SUFFIX]
+    write_file(sink, "acct/run2/db/c/file.ndjson", [b"a" * 10])
+    assert (sink.uploaded_bytes, sink.reused_bytes) == (10, 0)
+    assert read_backup_file(store.read, "acct/run2/db/c/file.ndjson") == b"a" * 10
+
+
+def test_collect_garbage_keeps_referenced_recent_and_modified_chunks():
+    azure_core = pytest.importorskip("azure.core")
+    from azure.core.exceptions import ResourceModifiedError
+
+    old = datetime.now(timezone.utc) - timedelta(days=3)
+    chunks = {name: chunk_path("acct", name * 64) for name in ("a", "b", "c", "d")}
+    blobs = {
+        "acct/run/db/c/file.ndjson" + CHUNK_LIST_SUFFIX: types.SimpleNamespace(last_modified=old, etag="1", size=10),
+        chunks["a"]: types.SimpleNamespace(last_modified=old, etag="1", size=10),
+        chunks["b"]: types.SimpleNamespace(last_modified=old, etag="1", size=10),
+        chunks["c"]: types.SimpleNamespace(last_modified=datetime.now(timezone.utc), etag="1", size=10),
+        chunks["d"]: types.SimpleNamespace(last_modified=old, etag="1", size=10),
+    }
+
+    class ContainerClient:
+        deleted = []
+
+        def list_blobs(self, name_starts_with):
+            return [types.SimpleNamespace(name=name, **vars(blob)) for name, blob in blobs.items() if name.startswith(name_starts_with)]
+
+        def get_blob_client(self, name):
+            chunk_list = b'{"chunks": [{"sha256": "' + b"a" * 64 + b'", "bytes": 10}]}'
+            return types.SimpleNamespace(download_blob=lambda: types.SimpleNamespace(readall=lambda: chunk_list))
+
+        def delete_blob(self, name, etag, match_condition):
+            assert match_condition == azure_core.MatchConditions.IfNotModified
+            # Chunk d is touched by a running backup after the listing
+            if name == chunks["d"]:
+                raise ResourceModifiedError("modified")
+            self.deleted.append(name)
+
+    container_client = ContainerClient()
+    assert collect_garbage(container_client, "acct", 24 * 3600) == 1
+    assert container_client.deleted == [chunks["b"]]
@@ -0,0 +1,66 @@
+import copy
+
+import pytest
+
+from bulk_restore import RestoreStats
+from destination_index import DestinationIndex, index_query, index_rows
+from restore_transform import RESTORE_DIGEST_PROPERTY, RestoreTransform
+
+
+def backup(versions):
+    return [{"id": doc_id, "tenant": "t", "value": value, "_ts": ts} for doc_id, (value, ts) in versions.items()]
+
+
+# Differential restore of backed up documents into a destination dict, as the query would see it
+def differential_restore(destination, documents, storage):
+    index = DestinationIndex(storage)
+    index.add(index_rows(
+        [{"id": doc["id"], "digest": doc[RESTORE_DIGEST_PROPERTY], "pk0": doc["tenant"]} for doc in destination.values() if RESTORE_DIGEST_PROPERTY in doc],
+        ["/tenant"],
+    ))
+    stats = RestoreStats()
+    # As restore_plan.prepare_documents: transform, then compare with the destination
+    written = list(index.changed_documents(RestoreTransform().apply(copy.deepcopy(documents)), ["/tenant"], stats.add_skipped))
+    index.close()
+    for doc in written:
+        # The destination sets its own _ts, later than every backup
+        destination[doc["id"]] = {**doc, "_ts": 10_000}
+    return sorted(doc["id"] for doc in written), stats.skipped
+
+
+def test_index_query_selects_digest():
+    assert index_query(["/tenant"]) == 'SELECT c.id, c["restore_digest"] AS digest, c["tenant"] AS pk0 FROM c WHERE IS_DEFINED(c["restore_digest"])'
+
+
+@pytest.mark.parametrize("storage", ["memory", "disk"])
+def test_differential_restore_refresh(storage):
+    destination = {}
+    first = backup({"a": (1, 100), "b": (1, 100), "c": (1, 100)})
+    assert differential_restore(destination, first, storage) == (["a", "b", "c"], 0)
+    assert differential_restore(destination, first, storage) == ([], 3)
+    # b changed in the source after the first backup, but before the first restore was written
+    second = backup({"a": (1, 100), "b": (2, 150), "c": (1, 100), "d": (1, 200)})
+    assert differential_restore(destination, second, storage) == (["b", "d"], 2)
+    assert destination["b"]["value"] == 2
+
+
+@pytest.mark.parametrize("storage", ["memory", "disk"])
+def test_differential_restore_rollback(storage):
+    destination = {}
+    older = backup({"a": (1, 100), "b": (1, 100)})
+    newer = backup({"a": (1, 100), "b": (2, 300)})
+    differential_restore(destination, newer, storage)
+    # Rolling back writes the older version of b and skips the unchanged a
+    assert differential_restore(destination, older, storage) == (["b"], 1)
+    assert destination["b"]["value"] == 1
+
+
+def test_documents_without_digest_are_rewritten():
+    destination = {"a": {"id": "a", "tenant": "t", "value": 1}}
+    assert differential_restore(destination, backup({"a": (1, 100)}), "memory") == (["a"], 0)
+    assert RESTORE_DIGEST_PROPERTY in destination["a"]
+
+
+def test_backed_up_digest_is_stripped():
+    doc = {"id": "a", "tenant": "t", "value": 2, RESTORE_DIGEST_PROPERTY: "stale"}
+    assert RESTORE_DIGEST_PROPERTY not in next(iter(RestoreTransform().apply([doc])))
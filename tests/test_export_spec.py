@@ -0,0 +1,26 @@
+import pytest
+
+from export_spec import ExportSpec
+
+
+def test_projected_fields_are_quoted():
+    spec = ExportSpec(fields=["value", "order", "my-field", 'say "hi"'], filter="c.kind = @kind")
+    assert spec.query(["/tenant/id"]) == (
+        'SELECT c["id"], c["tenant"], c["value"], c["order"], c["my-field"], c["say \\"hi\\""] FROM c WHERE c.kind = @kind'
+    )
+
+
+def test_projection_keeps_id_and_partition_key():
+    spec = ExportSpec(fields=["name"], strip_system_properties=True)
+    doc = {"id": "1", "tenant": "t", "name": "n", "other": 1, "_ts": 5}
+    assert spec.transform(doc, ["/tenant"]) == {"id": "1", "tenant": "t", "name": "n"}
+
+
+def test_full_query_without_fields():
+    assert ExportSpec().query(["/tenant"]) == "SELECT * FROM c"
+
+
+@pytest.mark.parametrize("field", ["", "a/b", 3])
+def test_invalid_projected_fields(field):
+    with pytest.raises(ValueError):
+        ExportSpec(fields=[field])
@@ -0,0 +1,90 @@
+import json
+
+import pytest
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.parquet  # noqa: E402
+
+from parquet_format import ParquetSegmentWriter, estimate_page_bytes, iter_parquet, write_parquet_pages  # noqa: E402
+from tests.memory_sink import MemorySink, pieces  # noqa: E402
+
+
+def make_documents(count):
+    return [
+        {
+            "id": str(index),
+            "n": index,
+            "ratio": index / 7,
+            "flag": index % 2 == 0,
+            "text": "é✓" * (index % 5),
+            "nested": {"a": index, "b": [index, None]},
+            # Mixed types and explicit nulls go to the overflow column
+            "mixed": index if index % 3 else str(index),
+            "nullable": None if index % 4 == 0 else "set",
+            "big": 2 ** 70 if index == 3 else 1,
+        }
+        for index in range(count)
+    ]
+
+
+def write_backup(sink, docs, segment_size=0, page_size=100, **options):
+    with ParquetSegmentWriter(sink, "acct/run/db/c/file", "gzip", segment_size, **options) as writer:
+        write_parquet_pages([docs[start:start + page_size] for start in range(0, len(docs), page_size)], writer)
+    return writer.segments
+
+
+def read_segments(sink, segments):
+    docs = []
+    for segment in segments:
+        data = sink.read(f"acct/run/db/c/{segment['file']}")
+        assert segment["bytes"] == len(data)
+        segment_docs = list(iter_parquet(pieces(data, 1000)))
+        assert len(segment_docs) == segment["document_count"]
+        docs += segment_docs
+    return docs
+
+
+def test_parquet_round_trip():
+    docs = make_documents(1000)
+    sink = MemorySink()
+    assert read_segments(sink, write_backup(sink, docs)) == docs
+
+
+def test_parquet_row_groups_cut_by_size():
+    docs = make_documents(2000)
+    sink = MemorySink()
+    segments = write_backup(sink, docs, row_group_bytes=16384)
+    metadata = pyarrow.parquet.ParquetFile(pyarrow.BufferReader(sink.read(f"acct/run/db/c/{segments[0]['file']}"))).metadata
+    assert metadata.num_row_groups > 5
+    assert read_segments(sink, segments) == docs
+
+
+def test_parquet_segments():
+    docs = make_documents(2000)
+    sink = MemorySink()
+    segments = write_backup(sink, docs, segment_size=50_000)
+    assert len(segments) > 1
+    assert read_segments(sink, segments) == docs
+
+
+def test_parquet_empty_container():
+    sink = MemorySink()
+    segments = write_backup(sink, [])
+    assert [segment["document_count"] for segment in segments] == [0]
+    assert read_segments(sink, segments) == []
+
+
+def test_parquet_truncated():
+    sink = MemorySink()
+    segments = write_backup(sink, make_documents(100))
+    data = sink.read(f"acct/run/db/c/{segments[0]['file']}")
+    with pytest.raises(ValueError):
+        list(iter_parquet([data[:-10]]))
+
+
+def test_estimate_page_bytes():
+    docs = make_documents(1000)
+    exact = sum(len(json.dumps(doc, separators=(",", ":"), ensure_ascii=False)) for doc in docs)
+    assert estimate_page_bytes(docs[:5]) == sum(len(json.dumps(doc, separators=(",", ":"), ensure_ascii=False)) for doc in docs[:5])
+    assert abs(estimate_page_bytes(docs) - exact) < exact * 0.2
+    assert estimate_page_bytes([]) == 0